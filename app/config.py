@@ -29,18 +29,53 @@ class Settings(BaseSettings):
     SPREADSHEET_NAME: str = os.getenv('SPREADSHEET_NAME', "Invoice Data")
 
     PDF_DIR: str = os.getenv('PDF_DIR', "pdfs")
+    # Local SQLite database with sync watermarks and the order index
+    STORE_PATH: str = os.getenv('STORE_PATH', "data/invoice_ocr.db")
     TEMPLATES_DIR: str = os.getenv('TEMPLATES_DIR', "templates")
 
     OPENAI_API_KEY: str = os.getenv('OPENAI_API_KEY')
     LANGCHAIN_API_KEY: str = os.getenv('LANGCHAIN_API_KEY')
     # LANGCHAIN_TRACING_V2: str = os.getenv('LANGCHAIN_TRACING_V2')
+    OCR_CONCURRENCY: int = os.getenv('OCR_CONCURRENCY', 4)
+    OCR_CACHE_PATH: str = os.getenv('OCR_CACHE_PATH', "data/ocr_cache.db")
+    OCR_CACHE_TTL: int = os.getenv('OCR_CACHE_TTL', 30 * 24 * 3600)
+    OCR_CACHE_MAX_ENTRIES: int = os.getenv('OCR_CACHE_MAX_ENTRIES', 100000)
+    # OCR model budgets (0 disables either), shared by all OCR requests of the process.
+    # OCR_CONCURRENCY is the ceiling of an adaptive limit that is cut on 429s and on
+    # responses slower than OCR_LATENCY_TARGET seconds
+    OCR_REQUESTS_PER_MINUTE: int = os.getenv('OCR_REQUESTS_PER_MINUTE', 0)
+    OCR_TOKENS_PER_MINUTE: int = os.getenv('OCR_TOKENS_PER_MINUTE', 0)
+    OCR_LATENCY_TARGET: float = os.getenv('OCR_LATENCY_TARGET', 60)
+    OCR_MAX_RETRIES: int = os.getenv('OCR_MAX_RETRIES', 5)
+    # Runs a page may fail with a non-retryable OCR error (e.g. a 400) before it is
+    # kept without shipment info; 0 keeps retrying it
+    OCR_MAX_PAGE_ATTEMPTS: int = os.getenv('OCR_MAX_PAGE_ATTEMPTS', 3)
+
+    # Page rendering for OCR (RENDER_JPEG_QUALITY=0 sends PNG instead of JPEG)
+    RENDER_DPI: int = os.getenv('RENDER_DPI', 100)
+    RENDER_GRAYSCALE: bool = os.getenv('RENDER_GRAYSCALE', True)
+    RENDER_JPEG_QUALITY: int = os.getenv('RENDER_JPEG_QUALITY', 75)
+    RENDER_CROP_TO_CONTENT: bool = os.getenv('RENDER_CROP_TO_CONTENT', False)
+    # Pages with at least this much text skip the vision model (0 disables the text path)
+    TEXT_LAYER_MIN_CHARS: int = os.getenv('TEXT_LAYER_MIN_CHARS', 200)
+
+    # BOL pipeline: processes splitting PDFs and the size of the queues between stages
+    # (OCR_CONCURRENCY and DRIVE_UPLOAD_CONCURRENCY size the OCR and publish stages)
+    SPLIT_CONCURRENCY: int = os.getenv('SPLIT_CONCURRENCY', 2)
+    PIPELINE_QUEUE_SIZE: int = os.getenv('PIPELINE_QUEUE_SIZE', 8)
+    # Most pages ("Page 2 of 3" continuations) grouped into one BOL; 1 disables grouping
+    GROUP_MAX_PAGES: int = os.getenv('GROUP_MAX_PAGES', 4)
 
     DRIVE_FOLDER_ID: str = os.getenv('DRIVE_FOLDER_ID')
+    DRIVE_UPLOAD_CONCURRENCY: int = os.getenv('DRIVE_UPLOAD_CONCURRENCY', 4)
 
     # Seller Cloud configurations
     SELLER_EMAIL_ADDRESS: str = os.getenv('SELLER_EMAIL_ADDRESS')
     SELLER_PWD: str = os.getenv('SELLER_PWD')
     SELLER_CLOUD: str = os.getenv('SELLER_CLOUD')
+    SELLER_CLOUD_CONCURRENCY: int = os.getenv('SELLER_CLOUD_CONCURRENCY', 8)
+    # Maximum Seller Cloud API requests per second (0 disables the limit)
+    SELLER_CLOUD_RATE_LIMIT: float = os.getenv('SELLER_CLOUD_RATE_LIMIT', 5)
 
 
 
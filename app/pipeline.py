@@ -0,0 +1,303 @@
+"""
+path: app/pipeline.py
+
+Staged BOL pipeline. An email fetcher, a PDF splitter running in a process pool,
+a pool of OCR workers and a publisher that uploads pages to Google Drive run
+concurrently and hand work to each other through bounded queues, so a slow stage
+applies backpressure to the ones before it instead of holding the event loop.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import tempfile
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import aclosing
+
+import fitz
+
+from utils.metrics import BYTES, ITEMS, STAGE_SECONDS, track
+from utils.ocr_limiter import OCR_ERROR, RETRYABLE
+from utils.pdf_splitter import (FITZ_LOCK, MAX_GROUP_PAGES, TEXT_LAYER_MIN_CHARS, agroup_pages,
+                                aiter_pages_parallel, aocr_group, write_page_pdf)
+from utils.store import STAGE_FETCHED, STAGE_OCR
+
+logger = logging.getLogger(__name__)
+
+# Queued documents kept open by the publishers to extract page PDFs from
+OPEN_DOCUMENTS = 4
+# Runs a page may fail with OCR_ERROR before it is saved without shipment info
+MAX_OCR_ATTEMPTS = 3
+
+
+def _order_number(bol):
+    return bol.get('shipment_info', {}).get('customer_order_information', {}).get('order_number', "")
+
+
+class BolPipeline:
+    """
+    Run the fetch -> split -> OCR -> publish stages of a scheduler run.
+
+    Every stage checkpoints its output in the job queue of `store`, so work left
+    over by an interrupted run is picked up at the start of the next one.
+
+    Args:
+    - store: LocalStore holding the job queue.
+    - ocr_tool: OCRTool used by the OCR workers.
+    - drive_uploader: DriveUploader used by the publishers.
+    - folder_id: Drive folder the page PDFs are uploaded to.
+    - profile: RenderProfile for the page images.
+    - text_min_chars: text layer threshold passed to split_pdf.
+    - split_workers, ocr_workers, publish_workers: concurrency of each stage.
+    - queue_size: capacity of the queues between stages.
+    - stats: optional Counter for the "text"/"vision" request counts.
+    - max_group_pages: most pages grouped into one BOL; 1 disables grouping.
+    - max_ocr_attempts: runs a page may fail with OCR_ERROR before it is given up
+      on; 0 keeps retrying it.
+    """
+
+    def __init__(self, store, ocr_tool, drive_uploader, folder_id=None, profile=None,
+                 text_min_chars=TEXT_LAYER_MIN_CHARS, split_workers=2, ocr_workers=4,
+                 publish_workers=4, queue_size=8, stats=None, max_group_pages=MAX_GROUP_PAGES,
+                 max_ocr_attempts=MAX_OCR_ATTEMPTS):
+        self.store = store
+        self.ocr_tool = ocr_tool
+        self.drive_uploader = drive_uploader
+        self.folder_id = folder_id
+        self.profile = profile
+        self.text_min_chars = text_min_chars
+        self.split_workers = split_workers
+        self.ocr_workers = ocr_workers
+        self.publish_workers = publish_workers
+        self.queue_size = queue_size
+        self.stats = stats
+        self.max_group_pages = max_group_pages
+        self.max_ocr_attempts = max_ocr_attempts
+        # Items handled per stage in this run; timings go to utils.metrics
+        self.counts = Counter()
+        self._remaining_pages = {}
+        # Pages of each document still to be published, so its open copy can be
+        # closed after the last one
+        self._unpublished = Counter()
+        self._documents = OrderedDict()
+
+    async def run(self, attachments=None):
+        """
+        Queue the attachments yielded by the async iterable `attachments` and process
+        them, together with any unfinished work from earlier runs. With attachments
+        None, e.g. when the mailbox is unreachable, only the unfinished work is done.
+        Returns once every stage is drained.
+        """
+        self.split_queue = asyncio.Queue(self.queue_size)
+        self.ocr_queue = asyncio.Queue(self.queue_size)
+        self.publish_queue = asyncio.Queue(self.queue_size)
+        # Spawned workers do not inherit the scheduler's threads and locks
+        pool = ProcessPoolExecutor(max_workers=self.split_workers,
+                                   mp_context=multiprocessing.get_context("spawn"))
+        workers = (
+            [asyncio.create_task(self._split_worker(pool)) for _ in range(self.split_workers)]
+            + [asyncio.create_task(self._ocr_worker()) for _ in range(self.ocr_workers)]
+            + [asyncio.create_task(self._publish_worker()) for _ in range(self.publish_workers)]
+        )
+        started = time.perf_counter()
+        try:
+            for page in await asyncio.to_thread(self.store.pages_in_stage, STAGE_OCR):
+                self._unpublished[page['sha256']] += 1
+                await self.publish_queue.put(page)
+            for document in await asyncio.to_thread(self.store.documents_in_stage, STAGE_FETCHED):
+                logger.info(f"Resuming '{document['file_name']}' from the job queue")
+                await self.split_queue.put(document)
+            await self._fetch(attachments)
+            # Each queue only gets new items from the stage before it
+            for queue in (self.split_queue, self.ocr_queue, self.publish_queue):
+                await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            pool.shutdown(wait=False, cancel_futures=True)
+            with FITZ_LOCK:
+                for doc in self._documents.values():
+                    doc.close()
+                self._documents.clear()
+            await asyncio.to_thread(self.store.release_documents)
+            logger.info("BOL pipeline finished in %.1fs: %s", time.perf_counter() - started, dict(self.counts))
+
+    async def _fetch(self, attachments):
+        if attachments is None:
+            return
+        waiting = time.perf_counter()
+        async for pdf in attachments:
+            # Time spent waiting on IMAP for this attachment
+            STAGE_SECONDS.observe(time.perf_counter() - waiting, stage="fetch")
+            ITEMS.inc(stage="fetch")
+            document = {'sha256': pdf['sha256'], 'file_name': pdf['file_name'], 'pdf': pdf.pop('binary_data')}
+            BYTES.inc(len(document['pdf']), kind="attachment")
+            queued = await asyncio.to_thread(self.store.enqueue_document, document['sha256'],
+                                             document['file_name'], pdf.get('message_id'), document['pdf'])
+            if not queued:
+                logger.info(f"'{document['file_name']}' is already in the job queue")
+                continue
+            self.counts['fetched'] += 1
+            # Blocks while the splitters are behind
+            await self.split_queue.put(document)
+            waiting = time.perf_counter()
+
+    async def _split_worker(self, pool):
+        while True:
+            document = await self.split_queue.get()
+            sha256 = document['sha256']
+            # The splitter holds one count of each until every BOL of the document is
+            # queued, so the document is not completed or closed before that
+            self._remaining_pages[sha256] = 1
+            self._unpublished[sha256] += 1
+            try:
+                # Pages checkpointed by an interrupted run are not OCR'd again
+                done_pages = await asyncio.to_thread(self.store.queued_pages, sha256)
+                # Small page ranges of one document are spread across the process pool
+                # and their pages queued for OCR as they complete, so the page images
+                # held are bounded by the OCR queue, not the document. Page PDFs are
+                # extracted by the publishers, straight to a temp file
+                pages = aiter_pages_parallel(document.pop('pdf'), pool, self.split_workers, self.profile,
+                                             self.text_min_chars, done_pages, with_pdf=False)
+                async with aclosing(pages):
+                    with track("split"):
+                        # Multi-page BOLs are OCR'd and uploaded as one
+                        async for group in agroup_pages(pages, self.max_group_pages):
+                            ITEMS.inc(len(group), stage="page")
+                            BYTES.inc(sum(len(page.get('image', '')) for page in group), kind="page_image")
+                            self.counts['grouped_pages'] += len(group) - 1
+                            self._remaining_pages[sha256] += 1
+                            self._unpublished[sha256] += 1
+                            await self.ocr_queue.put({'sha256': sha256, 'pdf_name': document['file_name'],
+                                                      'pages': group})
+                self.counts['split'] += 1
+                await self._group_done(sha256)
+            except Exception as e:
+                # The document stays queued and its missing pages are split next run
+                logger.error(f"Error splitting '{document.get('file_name')}': {e}")
+            finally:
+                await self._page_done(sha256)
+                self.split_queue.task_done()
+
+    async def _ocr_worker(self):
+        while True:
+            item = await self.ocr_queue.get()
+            sha256 = item['sha256']
+            try:
+                with track("ocr"):
+                    page = await aocr_group(self.ocr_tool, item['pages'], item['pdf_name'], self.stats)
+                    if page.get('ocr_status') in RETRYABLE and not await self._give_up(sha256, page):
+                        # Not checkpointed, so the page is OCR'd again next run
+                        self.counts['ocr_deferred'] += 1
+                        raise RuntimeError(f"OCR of '{item['pdf_name']}' page {page['page_num']} deferred "
+                                           f"({page['ocr_status']}): {page.get('ocr_error')}")
+                await asyncio.to_thread(self.store.save_page, sha256, page['page_num'], page, None,
+                                        order_number=_order_number(page))
+                self.counts['ocr'] += 1
+                await self._group_done(sha256)
+                await self.publish_queue.put({'sha256': sha256, 'page_num': page['page_num'], 'bol': page})
+            except Exception as e:
+                logger.error(f"Error processing. Error: {e}")
+                # The page will not reach the publishers in this run
+                await self._page_done(sha256)
+            finally:
+                self.ocr_queue.task_done()
+
+    async def _give_up(self, sha256, page):
+        """
+        Count a page that failed with OCR_ERROR against its runs; True once it has
+        failed in max_ocr_attempts runs, so it is saved without shipment info
+        like a page the model could not read instead of being sent again.
+        """
+        if page['ocr_status'] != OCR_ERROR or not self.max_ocr_attempts:
+            return False
+        attempts = await asyncio.to_thread(self.store.record_ocr_failure, sha256, page['page_num'],
+                                           page.get('ocr_error'))
+        if attempts < self.max_ocr_attempts:
+            return False
+        logger.error(f"Giving up on OCR of page {page['page_num']} of document {sha256} after {attempts} runs: "
+                     f"{page.get('ocr_error')}")
+        self.counts['ocr_given_up'] += 1
+        return True
+
+    async def _publish_worker(self):
+        while True:
+            item = await self.publish_queue.get()
+            path = None
+            try:
+                # Pages checkpointed with their PDF by older runs are uploaded as is
+                page_pdf = item.get('pdf')
+                if page_pdf is None:
+                    path = await asyncio.to_thread(self._extract_page, item['sha256'], item['page_num'],
+                                                   item['bol'].get('last_page_num'))
+                    page_pdf = open(path, 'rb')
+                BYTES.inc(os.path.getsize(path) if path is not None else len(page_pdf), kind="drive_upload")
+                try:
+                    with track("drive_upload"):
+                        future = self.drive_uploader.submit(page_pdf, item['bol'].get('file_name'),
+                                                            parent_folder_id=self.folder_id)
+                        pdf_link = await asyncio.wrap_future(future)
+                finally:
+                    if path is not None:
+                        page_pdf.close()
+                await asyncio.to_thread(self.store.set_page_link, item['sha256'], item['page_num'], pdf_link)
+                self.counts['published'] += 1
+            except Exception as e:
+                logger.error(f"Error uploading '{item['bol'].get('file_name')}' to Google Drive: {e}")
+            finally:
+                if path is not None:
+                    os.unlink(path)
+                await self._page_done(item['sha256'])
+                self.publish_queue.task_done()
+
+    async def _group_done(self, sha256):
+        """
+        Count a BOL of a document as OCR'd and mark the document as split once none
+        is left. A document with a failed page stays queued and is retried next run.
+        """
+        self._remaining_pages[sha256] -= 1
+        if self._remaining_pages[sha256] == 0:
+            del self._remaining_pages[sha256]
+            await asyncio.to_thread(self.store.complete_document, sha256, release=False)
+
+    async def _page_done(self, sha256):
+        """
+        Count a page of a document as finished by the publishers and close the
+        document once none of its pages is left.
+        """
+        self._unpublished[sha256] -= 1
+        if self._unpublished[sha256] > 0:
+            return
+        del self._unpublished[sha256]
+        await asyncio.to_thread(self._close_document, sha256)
+
+    def _close_document(self, sha256):
+        with FITZ_LOCK:
+            doc = self._documents.pop(sha256, None)
+            if doc is not None:
+                doc.close()
+
+    def _extract_page(self, sha256, page_num, last_page_num=None):
+        """
+        Write one page (or the pages of one multi-page BOL) of a queued document to a
+        temporary file and return its path.
+        Runs in a worker thread; MuPDF is not thread-safe, so it holds FITZ_LOCK.
+        """
+        with FITZ_LOCK:
+            doc = self._documents.pop(sha256, None)
+            if doc is None:
+                doc = fitz.open(stream=self.store.document_pdf(sha256), filetype="pdf")
+            # Keep the most recently used documents open
+            self._documents[sha256] = doc
+            while len(self._documents) > OPEN_DOCUMENTS:
+                self._documents.pop(next(iter(self._documents))).close()
+            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+                path = tmp.name
+            try:
+                return write_page_pdf(doc, page_num, path, last_page_num)
+            except Exception:
+                os.unlink(path)
+                raise
@@ -5,23 +5,31 @@ path: utils/scheduler.py
 
 import os
 import json
+import asyncio
 import httpx
 import re
+import time
+from collections import Counter
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, timedelta
 
 from utils.ocr import OCRTool
-from utils.pdf_splitter import process_pdf
+from utils.ocr_cache import OCRCache
+from utils.ocr_limiter import OCRLimiter
+from utils.metrics import LAST_RUN_DURATION, LAST_RUN_TIMESTAMP, REGISTRY, run_summary, track
+from utils.render import RenderProfile
 from utils.seller_cloud import *
+from utils.store import LocalStore, STAGE_DRIVE, STAGE_SHEETS, STATUS_UPLOADED
 
 from utils.emailclient import EmailAttachmentExtractor
-from utils.sheet import SheetsClient
-from utils.drive import DriveClient
+from utils.sheet import SheetsClient, SheetExporter, prepare_bol_row
+from utils.drive import DriveClient, DriveUploader
 from app.config import settings
+from app.pipeline import BolPipeline
 import logging
 import pandas as pd
-from tqdm import tqdm
+from tqdm.asyncio import tqdm
 
 logger = logging.getLogger(__name__)
 scheduler = AsyncIOScheduler()
@@ -31,176 +39,285 @@ def clean_phone_number(phone):
                 return re.sub(r'[+\-*_]', '', phone)
             return phone 
 
+def bol_to_row(bol):
+    """
+    Flatten a processed BOL into the row written to the BOL sheet.
+    """
+    shipment_info = bol.get('shipment_info', {})
+    ship_from = shipment_info.get('ship_from', {})
+    ship_to = shipment_info.get('ship_to', {})
+    carrier_info = shipment_info.get('carrier_info', {})
+    customer_order_information = shipment_info.get('customer_order_information', {})
+    return {
+        'ship_from_company_name': ship_from.get('company_name'),
+        'ship_from_contact_person': ship_from.get('contact_person'),
+        'ship_from_contact_number': clean_phone_number(ship_from.get('contact_number')),
+        'ship_from_address': ship_from.get('address'),
+        'ship_to_company_name': ship_to.get('company_name'),
+        'ship_to_contact_person': ship_to.get('contact_person'),
+        'ship_to_contact_number': clean_phone_number(ship_to.get('contact_number')),
+        'ship_to_address': ship_to.get('address'),
+        'carrier_name': carrier_info.get('carrier_name'),
+        'scac': carrier_info.get('scac'),
+        'pro_number': carrier_info.get('pro_number'),
+        'order_number': customer_order_information.get('order_number', ""),
+        'shipment_id': customer_order_information.get('shipment_id'),
+        'pallets': customer_order_information.get('pallets'),
+        'cartons': customer_order_information.get('cartons'),
+        'weight': customer_order_information.get('weight'),
+        'pdf_link': bol.get('pdf_link'),
+    }
+
+def record_bol_rows(store):
+    """
+    Record a BOL row for every page uploaded to Drive and move the pages on to the
+    sheets stage.
+
+    Returns:
+    - Number of rows added and number of pages recorded.
+    """
+    uploaded_pages = store.pages_in_stage(STAGE_DRIVE)
+    added = store.upsert_bol_rows(prepare_bol_row(bol_to_row(page['bol'])) for page in uploaded_pages)
+    store.set_pages_stage([(page['sha256'], page['page_num']) for page in uploaded_pages], STAGE_SHEETS)
+    return added, len(uploaded_pages)
+
+_email_client = None
+
+def get_email_client(store):
+    """
+    Return the email client shared by all scheduler runs, so its authenticated
+    IMAP connection is reused instead of logging in on every run.
+    """
+    global _email_client
+    if _email_client is None:
+        _email_client = EmailAttachmentExtractor(
+            email_address=settings.EMAIL_ADDRESS,
+            password=settings.EMAIL_PASSWORD,
+            imap_server=settings.IMAP_SERVER)
+    _email_client.store = store
+    return _email_client
+
+_ocr_limiter = None
+
+def get_ocr_limiter():
+    """
+    Return the OCR rate limiter shared by all scheduler runs, so the concurrency it
+    learned and the budgets it spent carry over from one run to the next.
+    """
+    global _ocr_limiter
+    if _ocr_limiter is None:
+        _ocr_limiter = OCRLimiter(requests_per_minute=settings.OCR_REQUESTS_PER_MINUTE,
+                                  tokens_per_minute=settings.OCR_TOKENS_PER_MINUTE,
+                                  max_concurrency=settings.OCR_CONCURRENCY,
+                                  latency_target=settings.OCR_LATENCY_TARGET,
+                                  max_retries=settings.OCR_MAX_RETRIES)
+    return _ocr_limiter
+
 async def job():
     """
     Fetch email attachments from the configured email account
     """
-    email_client = EmailAttachmentExtractor(
-        email_address=settings.EMAIL_ADDRESS,
-        password=settings.EMAIL_PASSWORD,
-        imap_server=settings.IMAP_SERVER)
-    if email_client.connect():
-        today = datetime.now().strftime("%d-%b-%Y")
-        yesterday = (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
-        pdfs = email_client.extract_pdf_attachments(num_emails=200,
-                                                subject_contains=settings.WORD_IN_SUBJECT,
-                                                date_from=yesterday,
-                                                date_to=today
-                                                )
+    started_at = time.time()
+    metrics_before = REGISTRY.snapshot()
+    store = None
+    try:
+        store = await asyncio.to_thread(LocalStore, settings.STORE_PATH)
+        # BOL rows are recorded and matched in the store; the BOL sheet is exported from it
+        bol_exporter = SheetExporter(SheetsClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH), store,
+                                     sheet_name=settings.SHEET_NAME,
+                                     spreadsheet_name=settings.SPREADSHEET_NAME)
         try:
-            for pdf in tqdm(pdfs):
-                result = process_pdf(pdf['binary_data'], OCRTool(), pdf['file_name'])
-
-                try:
-                    drive_client = DriveClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
-                    for bol in result:
-                        file_name = bol.get('file_name')
-                        binary_data = bol.get('pdf')
-                        pdf_link = drive_client.upload_pdf(binary_data, file_name, parent_folder_id = settings.DRIVE_FOLDER_ID)
-                        bol['pdf_link'] = pdf_link
-                        ship_from_company_name = bol.get('shipment_info', {}).get('ship_from', {}).get('company_name')
-                        ship_from_contact_person = bol.get('shipment_info', {}).get('ship_from', {}).get('contact_person')
-                        ship_from_contact_number = bol.get('shipment_info', {}).get('ship_from', {}).get('contact_number')
-                        ship_from_address = bol.get('shipment_info', {}).get('ship_from', {}).get('address')
-                        ship_to_company_name = bol.get('shipment_info', {}).get('ship_to', {}).get('company_name')
-                        ship_to_contact_person = bol.get('shipment_info', {}).get('ship_to', {}).get('contact_person')
-                        ship_to_contact_number = bol.get('shipment_info', {}).get('ship_to', {}).get('contact_number')
-                        ship_to_address = bol.get('shipment_info', {}).get('ship_to', {}).get('address')
-                        carrier_name = bol.get('shipment_info', {}).get('carrier_info', {}).get('carrier_name')
-                        scac = bol.get('shipment_info', {}).get('carrier_info', {}).get('scac')
-                        pro_number = bol.get('shipment_info', {}).get('carrier_info', {}).get('pro_number')
-                        order_number = bol.get('shipment_info', {}).get('customer_order_information', {}).get('order_number',"")
-                        shipment_id = bol.get('shipment_info', {}).get('customer_order_information', {}).get('shipment_id')
-                        pallets = bol.get('shipment_info', {}).get('customer_order_information', {}).get('pallets')
-                        cartons = bol.get('shipment_info', {}).get('customer_order_information', {}).get('cartons')
-                        weight = bol.get('shipment_info', {}).get('customer_order_information', {}).get('weight')
-                        pdf_link = bol.get('pdf_link')
-                        data = [
-                                {
-                                    'ship_from_company_name': ship_from_company_name,
-                                    'ship_from_contact_person': ship_from_contact_person,
-                                    'ship_from_contact_number': clean_phone_number(ship_from_contact_number),
-                                    'ship_from_address': ship_from_address,
-                                    'ship_to_company_name': ship_to_company_name,
-                                    'ship_to_contact_person': ship_to_contact_person,
-                                    'ship_to_contact_number': clean_phone_number(ship_to_contact_number),
-                                    'ship_to_address': ship_to_address,
-                                    'carrier_name': carrier_name,
-                                    'scac': scac,
-                                    'pro_number': pro_number,
-                                    'order_number': order_number,
-                                    'shipment_id': shipment_id,
-                                    'pallets': pallets,
-                                    'cartons': cartons,
-                                    'weight': weight,
-                                    'pdf_link': pdf_link,
-                                }
-                            ]
-                        result_dataframe = pd.DataFrame(data)
-                        sheets_client = SheetsClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
-                        sheets_client.add_dataframe(
-                                            data_frame=result_dataframe,
-                                            sheet_name=settings.SHEET_NAME,
-                                            spreadsheet_name=settings.SPREADSHEET_NAME
-                                        )
-                except Exception as e:
-                    logger.error(f"Error processing. Error: {e}")
-                    continue
-
+            # Rows already in the sheet must be known before new ones are recorded, and
+            # rows marked as uploaded by hand before rows are matched
+            await asyncio.to_thread(bol_exporter.pull)
         except Exception as e:
-            logger.error(f"Error processing pdf: {e}")
-
-    #### Seller Cloud Integration
-    try:
-        logger.info("#################Starting Seller Cloud Integration###################")
-        sheets_client = SheetsClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
-        drive_client = DriveClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
-        
-        logger.info("Attempting to get access token - Seller Cloud")
-        bearer = get_access_token()
-        if bearer is None:
-            raise ValueError("Failed to obtain access token - Seller Cloud")
-        logger.info("Access token obtained successfully - Seller Cloud")
-
-        logger.info("Retrieving all orders")
-        data = get_all_orders(bearer)
-        if data is None:
-            raise ValueError("Failed to retrieve order data - Seller Cloud")
-        logger.info(f"Retrieved {len(data)} orders - Seller Cloud")
-
-        logger.info("Parsing order data - Seller Cloud")
-        results = data_parse(data)
-        order_data = pd.DataFrame(results, columns=['order_id', 'order_number'])
-        order_data['order_id'] = order_data['order_id'].astype(str)
-        logger.info(f"Parsed {len(order_data)} orders - Seller Cloud")
-
+            logger.error(f"Error importing the BOL sheet into the local store: {e}")
+        email_client = None
+        try:
+            email_client = await asyncio.to_thread(get_email_client, store)
+            connected = await asyncio.to_thread(email_client.connect)
+        except Exception as e:
+            logger.error(f"Error connecting to the email account: {e}")
+            connected = False
+        pdfs = None
+        if connected:
+            today = datetime.now().strftime("%d-%b-%Y")
+            yesterday = (datetime.now() - timedelta(days=1)).strftime("%d-%b-%Y")
+            pdfs = tqdm(email_client.aiter_pdf_attachments(num_emails=200,
+                                                           subject_contains=settings.WORD_IN_SUBJECT,
+                                                           date_from=yesterday,
+                                                           date_to=today
+                                                           ))
+        else:
+            # Documents already in the job queue are still processed
+            logger.warning("No emails fetched in this run; resuming queued documents only")
+        ocr_cache = OCRCache(settings.OCR_CACHE_PATH,
+                             ttl=settings.OCR_CACHE_TTL,
+                             max_entries=settings.OCR_CACHE_MAX_ENTRIES) if settings.OCR_CACHE_PATH else None
+        ocr_tool = OCRTool(cache=ocr_cache, limiter=get_ocr_limiter())
+        render_profile = RenderProfile(dpi=settings.RENDER_DPI,
+                                       grayscale=settings.RENDER_GRAYSCALE,
+                                       jpeg_quality=settings.RENDER_JPEG_QUALITY,
+                                       crop_to_content=settings.RENDER_CROP_TO_CONTENT)
+        page_stats = Counter()
+        drive_uploader = DriveUploader(DriveClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH),
+                                       max_workers=settings.DRIVE_UPLOAD_CONCURRENCY)
+        pipeline = BolPipeline(store, ocr_tool, drive_uploader,
+                               folder_id=settings.DRIVE_FOLDER_ID,
+                               profile=render_profile,
+                               text_min_chars=settings.TEXT_LAYER_MIN_CHARS,
+                               split_workers=settings.SPLIT_CONCURRENCY,
+                               ocr_workers=settings.OCR_CONCURRENCY,
+                               publish_workers=settings.DRIVE_UPLOAD_CONCURRENCY,
+                               queue_size=settings.PIPELINE_QUEUE_SIZE,
+                               stats=page_stats,
+                               max_group_pages=settings.GROUP_MAX_PAGES,
+                               max_ocr_attempts=settings.OCR_MAX_PAGE_ATTEMPTS)
         try:
-            logger.info(f"Adding data to Google Sheets: {settings.SPREADSHEET_NAME} - Seller Cloud")
-            sheets_client.add_seller_cloud_dataframe(
-                data_frame=order_data,
-                sheet_name=settings.SELLER_CLOUD,
-                spreadsheet_name =settings.SPREADSHEET_NAME
-            )
-            logger.info("Successfully added data to Google Sheets - Seller Cloud")
+            # Attachments are OCR'd as they arrive instead of after the whole download
+            await pipeline.run(pdfs)
+            if connected:
+                # Fetched documents are in the queue now, so the emails are done; after a
+                # failed fetch mark_processed leaves the ledger and watermark alone
+                await asyncio.to_thread(email_client.mark_processed)
         except Exception as e:
-            logger.error(f"Failed to add data to Google Sheets: {str(e)} - Seller Cloud")
-            raise
+            logger.error(f"Error processing pdf: {e}")
+        finally:
+            try:
+                added, pages = await asyncio.to_thread(record_bol_rows, store)
+                logger.info(f"Recorded {added} new BOL rows from {pages} pages")
+            except Exception as e:
+                logger.error(f"Error recording BOL rows: {e}")
+            await asyncio.to_thread(drive_uploader.shutdown)
+            logger.info("Drive upload stats: %s", drive_uploader.stats())
+            logger.info("OCR requests by extraction path: %d text layer, %d vision; %d pages grouped into multi-page BOLs",
+                        page_stats["text"], page_stats["vision"], page_stats["grouped"])
+            logger.info("OCR limiter: %s", ocr_tool.limiter.stats())
+            logger.info("Job queue pages by stage: %s", await asyncio.to_thread(store.count_pages_by_stage))
+            if ocr_cache is not None:
+                logger.info("OCR cache stats: %s", await asyncio.to_thread(ocr_cache.stats))
+                ocr_cache.close()
 
+        #### Seller Cloud Integration
         try:
+            logger.info("#################Starting Seller Cloud Integration###################")
+            sheets_client = SheetsClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
+            drive_client = DriveClient(credentials_file_path=settings.CREDENTIALS_FILE_PATH)
+
+            seller_cloud = SellerCloudClient(settings.SELLER_EMAIL_ADDRESS, settings.SELLER_PWD,
+                                             pool_size=settings.SELLER_CLOUD_CONCURRENCY,
+                                             requests_per_second=settings.SELLER_CLOUD_RATE_LIMIT)
+
+            logger.info("Attempting to get access token - Seller Cloud")
+            bearer = await asyncio.to_thread(seller_cloud.get_access_token)
+            if bearer is None:
+                raise ValueError("Failed to obtain access token - Seller Cloud")
+            logger.info("Access token obtained successfully - Seller Cloud")
+
+            if await asyncio.to_thread(store.get_state, ORDERS_WATERMARK_KEY) is None:
+                # First incremental sync: seed the index with the orders already in the tab
+                existing_orders = await asyncio.to_thread(sheets_client.get_dataframe_with_row_ids,
+                                                          settings.SELLER_CLOUD, settings.SPREADSHEET_NAME)
+                if {'order_id', 'order_number'}.issubset(existing_orders.columns):
+                    existing_orders['order_id'] = pd.to_numeric(existing_orders['order_id'], errors='coerce')
+                    existing_orders = existing_orders.dropna(subset=['order_id'])
+                    seeded = await asyncio.to_thread(
+                        store.upsert_orders,
+                        zip(existing_orders['order_id'], existing_orders['order_number'].astype(str)), exported=True)
+                    logger.info(f"Seeded local order index with {seeded} orders from the sheet - Seller Cloud")
+
+            logger.info("Syncing orders incrementally - Seller Cloud")
+            try:
+                with track("seller_cloud_sync"):
+                    await asyncio.to_thread(sync_orders, seller_cloud, store)
+            except OrderSyncIncomplete as e:
+                # Counted as a seller_cloud_sync error in the run summary; orders already
+                # fetched are still exported and matched
+                logger.error(f"{e} - Seller Cloud")
+            new_orders = await asyncio.to_thread(store.unexported_orders)
+            order_data = pd.DataFrame(new_orders, columns=['order_id', 'order_number'])
+            order_data['order_id'] = order_data['order_id'].astype(str)
+            order_data['current_datetime'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            logger.info(f"{len(order_data)} orders to add to the sheet "
+                        f"({await asyncio.to_thread(store.count_orders)} indexed) - Seller Cloud")
+
+            try:
+                logger.info(f"Adding data to Google Sheets: {settings.SPREADSHEET_NAME} - Seller Cloud")
+                await asyncio.to_thread(
+                    sheets_client.append_dataframe,
+                    sheet_name=settings.SELLER_CLOUD,
+                    spreadsheet_name=settings.SPREADSHEET_NAME,
+                    data_frame=order_data
+                )
+                await asyncio.to_thread(store.mark_orders_exported, [order_id for order_id, _ in new_orders])
+                logger.info("Successfully added data to Google Sheets - Seller Cloud")
+            except Exception as e:
+                logger.error(f"Failed to add data to Google Sheets: {str(e)} - Seller Cloud")
+                raise
+
             logger.info("Matching and updating status")
-            _, to_be_uploaded = sheets_client.match_and_update_status(
-                settings.SHEET_NAME, settings.SELLER_CLOUD, settings.SPREADSHEET_NAME, 'order_number', 'order_number'
-            )
+            to_be_uploaded = await asyncio.to_thread(store.match_bol_rows)
             logger.info(f"{len(to_be_uploaded)} items to be uploaded - Seller Cloud")
-        except Exception as e:
-            logger.error(f"Failed to match and update status: {str(e)} - Seller Cloud")
-            raise
 
-        for index, item in enumerate(to_be_uploaded, 1):
-            try:
-                logger.info(f"Processing item {index} of {len(to_be_uploaded)}")
+            def prepare(item):
                 file_url = item.get('pdf_link')
                 order_id = item.get('order_id')
                 order_number = item.get('order_number')
                 if not file_url or not order_id:
                     logger.warning(f"Missing file_url or order_id for item: {item} - Seller Cloud")
-                    continue
+                    return None
 
                 logger.info(f"Downloading and encoding file for order_id: {order_id} - Seller Cloud")
-
                 base64_content, file_id = drive_client.download_and_encode(file_url)
                 if not base64_content or not file_id:
                     logger.warning(f"Failed to download and encode file for order_id: {order_id} - Seller Cloud")
-                    continue
-
-                file_name = f"Order-NO{order_number}.pdf"
-                logger.info(f"File downloaded and encoded successfully for order_id: {order_id} - Seller Cloud")
+                    return None
 
                 logger.info(f"Uploading file to SellerCloud for order_id: {order_id} - Seller Cloud")
-                upload_response = upload_to_sellercloud(bearer, int(order_id), base64_content, file_name)
-                if upload_response == 200:
-                    logger.info(f"File uploaded successfully for order_id {order_id} - Seller Cloud")
-                    try:
-                        sheets_client.update_column_by_identifier(
-                            settings.SHEET_NAME,settings.SPREADSHEET_NAME, 'order_number', order_number, 'status', 'Uploaded')
-                    except Exception as e:
-                        logger.error(f"Failed to update status for order_id {order_id}: {str(e)} - Seller Cloud")
-                        continue
-                else:
-                    logger.error(f"Failed to upload file for order_id {order_id} - Seller Cloud")
+                return int(order_id), base64_content, f"Order-NO{order_number}.pdf"
 
-            except Exception as e:
-                logger.error(f"Error processing item {index} (order_id: {order_id}): {str(e)} - Seller Cloud")
-                continue
+            # Statuses are recorded in one batch once all uploads are done
+            uploaded = []
+            try:
+                with track("seller_cloud_upload"):
+                    statuses = await asyncio.to_thread(seller_cloud.upload_documents, to_be_uploaded, prepare,
+                                                       max_workers=settings.SELLER_CLOUD_CONCURRENCY)
+                for item, upload_response in zip(to_be_uploaded, statuses):
+                    order_id = item.get('order_id')
+                    if upload_response == 200:
+                        logger.info(f"File uploaded successfully for order_id {order_id} - Seller Cloud")
+                        uploaded.append(item.get('order_number'))
+                    else:
+                        logger.error(f"Failed to upload file for order_id {order_id} - Seller Cloud")
+            finally:
+                await asyncio.to_thread(store.set_bol_status, uploaded, STATUS_UPLOADED)
+                await asyncio.to_thread(store.mark_orders_pushed, uploaded)
 
-        logger.info("Order processing completed successfully - Seller Cloud")
+            logger.info("Order processing completed successfully - Seller Cloud")
 
-    except Exception as e:
-        logger.error(f"An error occurred during order processing: {str(e)} - Seller Cloud")
-        # Handle the error appropriately (e.g., send an alert, retry, or exit)
+        except Exception as e:
+            logger.error(f"An error occurred during order processing: {str(e)} - Seller Cloud")
+            # Handle the error appropriately (e.g., send an alert, retry, or exit)
+        finally:
+            logger.info("Order processing script finished execution - Seller Cloud")
+            try:
+                with track("sheets"):
+                    await bol_exporter.aexport()
+                logger.info("BOL rows by status: %s", await asyncio.to_thread(store.count_bol_rows_by_status))
+            except Exception as e:
+                logger.error(f"Error exporting BOL rows to Google Sheets: {e}")
     finally:
-        logger.info("Order processing script finished execution - Seller Cloud")
-        # Perform any necessary cleanup operations here
+        duration = time.time() - started_at
+        summary = run_summary(metrics_before, REGISTRY.snapshot())
+        LAST_RUN_TIMESTAMP.set(time.time())
+        LAST_RUN_DURATION.set(duration)
+        logger.info(f"Run finished in {duration:.1f}s: {json.dumps(summary)}")
+        if store is not None:
+            try:
+                await asyncio.to_thread(store.record_run, started_at, duration, summary)
+            except Exception as e:
+                logger.error(f"Failed to record run summary: {e}")
+            store.close()
 def start():
     """
     Start the scheduler
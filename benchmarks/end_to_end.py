@@ -0,0 +1,218 @@
+"""
+End-to-end benchmark of scheduler runs without any live service. app.scheduler.job()
+runs unchanged against the stand-ins in benchmarks.fakes: an IMAP mailbox seeded
+with the test_documents PDFs, a stub model, an in-memory Drive, Sheets with a
+request quota and a mock Seller Cloud API.
+
+Each run delivers --emails-per-run new emails (job() reads at most 200 per run)
+and calls job() until the emails for --bols BOLs are processed. Every scale runs in
+a fresh subprocess, so peak RSS only reflects that scale. The report has BOL
+throughput, p50/p95/p99 latency per pipeline stage and peak memory; --json keeps
+the full results to compare against a previous build.
+
+Concurrency settings (OCR_CONCURRENCY, SPLIT_CONCURRENCY, ...) are read from the
+environment as usual, while the stand-ins' latencies are set on the command line.
+
+    python -m benchmarks.end_to_end --bols 1000 10000 100000 --model-latency 2
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from functools import partial
+from unittest import mock
+
+STAGES = ("fetch", "split", "ocr", "drive_upload", "sheets", "seller_cloud_sync", "seller_cloud_upload")
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+
+async def run_jobs(job, mailbox, messages, emails_per_run):
+    """
+    Deliver emails and run the scheduler job until all `messages` are processed;
+    returns the duration of every run.
+    """
+    runs = []
+    while mailbox.delivered < messages:
+        mailbox.deliver(min(emails_per_run, messages - mailbox.delivered))
+        started = time.perf_counter()
+        await job()
+        runs.append(time.perf_counter() - started)
+    return runs
+
+
+def child(args):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    import imaplib
+    import logging
+
+    from app import scheduler
+    from app.config import settings
+    from benchmarks.fakes import (FakeDrive, FakeDriveClient, FakeMailbox, FakeSellerCloud, FakeSellerCloudClient,
+                                  FakeSheets, FakeSheetsClient, StubModel, load_documents)
+    from utils.metrics import REGISTRY, STAGE_SECONDS, run_summary
+    from utils.ocr import OCRTool
+    from utils.store import LocalStore
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="invoice-ocr-benchmark-")
+    settings.STORE_PATH = os.path.join(workdir, "store.db")
+    # Pages of the repeated seed documents would all be cache hits
+    settings.OCR_CACHE_PATH = os.path.join(workdir, "ocr_cache.db") if args.ocr_cache else ""
+    settings.WORD_IN_SUBJECT = "BOL"
+    settings.SPREADSHEET_NAME = "Invoice Data"
+    settings.SHEET_NAME = "BOL"
+    settings.SELLER_CLOUD = "Seller Cloud"
+    settings.DRIVE_FOLDER_ID = "benchmark"
+
+    mailbox = FakeMailbox(load_documents(sorted(glob.glob(args.documents))), subject=settings.WORD_IN_SUBJECT,
+                          latency=args.imap_latency)
+    messages = mailbox.messages_for(args.bols)
+    seller_cloud = FakeSellerCloud(latency=args.seller_cloud_latency, match_rate=args.match_rate)
+    model = StubModel(latency=args.model_latency, failure_rate=args.model_failure_rate,
+                      on_order=seller_cloud.register)
+    sheets = FakeSheets(latency=0, quota_per_minute=0)
+    # The spreadsheet and its tabs exist before the first run, with the default grid size
+    spreadsheet = sheets.create(settings.SPREADSHEET_NAME)
+    for title in (settings.SHEET_NAME, settings.SELLER_CLOUD):
+        spreadsheet.add_worksheet(title, rows=1000, cols=26)
+    sheets.requests.clear()
+    sheets.latency, sheets.quota_per_minute = args.sheets_latency, args.sheets_quota
+    drive = FakeDrive(latency=args.drive_latency)
+
+    def make_ocr_tool(cache=None, limiter=None):
+        ocr_tool = OCRTool(cache=cache, limiter=limiter)
+        ocr_tool.runnable = ocr_tool.text_runnable = ocr_tool.group_runnable = model
+        return ocr_tool
+
+    # Keep every stage latency besides the histogram buckets, for exact percentiles
+    samples = defaultdict(list)
+    observe = STAGE_SECONDS.observe
+
+    def record(value, **labels):
+        samples[labels["stage"]].append(value)
+        observe(value, **labels)
+
+    with ExitStack() as stack:
+        stack.enter_context(mock.patch.object(imaplib, "IMAP4_SSL", mailbox.connect))
+        stack.enter_context(mock.patch.object(scheduler, "_email_client", None))
+        stack.enter_context(mock.patch.object(scheduler, "_ocr_limiter", None))
+        stack.enter_context(mock.patch.object(scheduler, "OCRTool", make_ocr_tool))
+        stack.enter_context(mock.patch.object(scheduler, "SheetsClient", partial(FakeSheetsClient, sheets)))
+        stack.enter_context(mock.patch.object(scheduler, "DriveClient", partial(FakeDriveClient, drive)))
+        stack.enter_context(mock.patch.object(scheduler, "SellerCloudClient",
+                                              partial(FakeSellerCloudClient, seller_cloud)))
+        stack.enter_context(mock.patch.object(STAGE_SECONDS, "observe", record))
+        baseline = peak_rss_mb()
+        before = REGISTRY.snapshot()
+        started = time.perf_counter()
+        runs = asyncio.run(run_jobs(scheduler.job, mailbox, messages, args.emails_per_run))
+        elapsed = time.perf_counter() - started
+        summary = run_summary(before, REGISTRY.snapshot())
+
+    store = LocalStore(settings.STORE_PATH)
+    pages_by_stage = store.count_pages_by_stage()
+    store.close()
+    published = summary["stages"].get("drive_upload", {}).get("items", 0)
+    result = {
+        "bols": mailbox.pages_in(messages),
+        "emails": messages,
+        "runs": len(runs),
+        "seconds": round(elapsed, 2),
+        "bols_per_second": round(published / elapsed, 2) if elapsed else 0.0,
+        "run_seconds": {"p50": percentile(runs, 0.5), "max": max(runs, default=0.0)},
+        "stages": {
+            stage: {"count": len(values), "p50": percentile(values, 0.5),
+                    "p95": percentile(values, 0.95), "p99": percentile(values, 0.99)}
+            for stage, values in samples.items()
+        },
+        "published": published,
+        "pages_by_stage": pages_by_stage,
+        "errors": {stage: values["errors"] for stage, values in summary["stages"].items() if values.get("errors")},
+        "bytes": summary["bytes"],
+        "tokens": summary["tokens"],
+        "model_calls": model.calls,
+        "imap_commands": dict(mailbox.commands),
+        "sheets_requests": dict(sheets.requests),
+        "sheets_quota_waits": sheets.quota_waits,
+        "sheets_quota_wait_seconds": round(sheets.quota_wait_seconds, 2),
+        "drive_uploads": len(drive.files),
+        "seller_cloud_orders": len(seller_cloud.orders),
+        "seller_cloud_uploads": seller_cloud.uploads,
+        "baseline_rss_mb": round(baseline, 1),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "peak_worker_rss_mb": round(peak_rss_mb(resource.RUSAGE_CHILDREN), 1),
+    }
+    print(json.dumps(result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bols", type=int, nargs="+", default=[1000], help="BOLs (pages) to process per scale")
+    parser.add_argument("--documents", default="test_documents/*.pdf", help="Seed PDFs attached to the emails")
+    parser.add_argument("--emails-per-run", type=int, default=200)
+    parser.add_argument("--model-latency", type=float, default=0.5, help="Mean seconds per model call")
+    parser.add_argument("--model-failure-rate", type=float, default=0.0)
+    parser.add_argument("--imap-latency", type=float, default=0.005)
+    parser.add_argument("--drive-latency", type=float, default=0.1)
+    parser.add_argument("--sheets-latency", type=float, default=0.2)
+    parser.add_argument("--sheets-quota", type=int, default=60, help="Sheets requests per minute (0 disables)")
+    parser.add_argument("--seller-cloud-latency", type=float, default=0.05)
+    parser.add_argument("--match-rate", type=float, default=0.7, help="Share of BOLs with a Seller Cloud order")
+    parser.add_argument("--ocr-cache", action="store_true", help="Keep the OCR cache enabled")
+    parser.add_argument("--verbose", action="store_true", help="Show the scheduler's INFO logs")
+    parser.add_argument("--json", help="Also write the results to this file")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(argparse.Namespace(**json.loads(args.child)))
+        return
+
+    results = []
+    print(f"{'BOLs':>8} {'runs':>5} {'seconds':>9} {'BOL/s':>7} {'peak MB':>8} {'worker MB':>10}  "
+          + " ".join(f"{stage + ' p50/p95/p99':>36}" for stage in STAGES[:4]))
+    for bols in args.bols:
+        options = dict(vars(args), bols=bols, child=None)
+        output = subprocess.run(
+            [sys.executable, "-m", "benchmarks.end_to_end", "--child", json.dumps(options)],
+            check=True, stdout=subprocess.PIPE, text=True,
+        ).stdout.strip().splitlines()[-1]
+        result = json.loads(output)
+        results.append(result)
+        latencies = []
+        for stage in STAGES[:4]:
+            stats = result["stages"].get(stage)
+            latencies.append(f"{stats['p50']:.3f}/{stats['p95']:.3f}/{stats['p99']:.3f}s" if stats else "-")
+        print(f"{result['bols']:>8} {result['runs']:>5} {result['seconds']:>9.1f} {result['bols_per_second']:>7.2f} "
+              f"{result['peak_rss_mb']:>8.0f} {result['peak_worker_rss_mb']:>10.0f}  "
+              + " ".join(f"{latency:>36}" for latency in latencies))
+        later = {stage: result["stages"][stage] for stage in STAGES[4:] if stage in result["stages"]}
+        print(f"{'':>8} published {result['published']}, errors {result['errors'] or 0}, "
+              f"Sheets quota waits {result['sheets_quota_waits']} ({result['sheets_quota_wait_seconds']}s), "
+              f"Seller Cloud uploads {result['seller_cloud_uploads']}, "
+              + ", ".join(f"{stage} p50 {stats['p50']:.2f}s" for stage, stats in later.items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,602 @@
+"""
+Local stand-ins for the services a scheduler run talks to, used by the offline
+benchmarks. Each one keeps the interface the repository code calls, so the real
+EmailAttachmentExtractor, OCRTool, SheetExporter, DriveUploader and
+SellerCloudClient run unchanged on top of them:
+
+- FakeMailbox serves generated BOL emails through an imaplib.IMAP4_SSL lookalike
+  (UID SEARCH, BODYSTRUCTURE and partial BODY.PEEK fetches with literals).
+- StubModel replaces the structured-output runnables of OCRTool.
+- FakeSheets is an in-memory gspread client with a per-minute request quota.
+- FakeDrive stores uploaded files in memory.
+- FakeSellerCloud answers the Seller Cloud REST calls of SellerCloudClient.
+
+Every stand-in takes a per-request latency in seconds.
+"""
+import asyncio
+import base64
+import io
+import itertools
+import random
+import re
+import threading
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from functools import lru_cache
+from urllib.parse import urlparse
+
+import fitz
+import gspread
+from langchain_core.messages import AIMessage
+
+from utils.drive import UPLOAD_RETRIES, DriveClient
+from utils.schema import Address, CarrierInfo, CustomerOrderInformation, Shipment
+from utils.seller_cloud import ORDERS_UPDATED_FROM_PARAM, SellerCloudClient
+from utils.sheet import SheetsClient
+
+# Tokens billed for one page image at the default render size
+IMAGE_TOKENS = 765
+
+
+def load_documents(paths):
+    """
+    Read the seed PDFs and return (file name, bytes, page count) tuples.
+    """
+    documents = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        with fitz.open(stream=data, filetype="pdf") as doc:
+            documents.append((path.rsplit("/", 1)[-1], data, doc.page_count))
+    if not documents:
+        raise ValueError("No seed documents found")
+    return documents
+
+
+class FakeMailbox:
+    """
+    An INBOX whose n-th message carries the n-th seed document (cycling through
+    them) as a base64 PDF attachment. A comment is appended after %%EOF so every
+    attachment has its own hash, like real BOLs would.
+
+    Messages become visible to UID SEARCH as they are delivered with deliver(), so
+    successive scheduler runs see a growing mailbox. Only the SUBJECT and UID
+    search criteria are applied; dates are ignored.
+    """
+
+    def __init__(self, documents, subject="BOL", latency=0.0):
+        self.documents = documents
+        self.subject = subject
+        self.latency = latency
+        self.uidvalidity = 1
+        self.delivered = 0
+        self.commands = Counter()
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def messages_for(self, bols):
+        """
+        Number of messages needed for at least `bols` pages in total.
+        """
+        pages = 0
+        for count in itertools.count(1):
+            pages += self.documents[(count - 1) % len(self.documents)][2]
+            if pages >= bols:
+                return count
+
+    def pages_in(self, messages):
+        return sum(self.documents[i % len(self.documents)][2] for i in range(messages))
+
+    def deliver(self, count):
+        self.delivered += count
+
+    @lru_cache(maxsize=32)
+    def message(self, uid):
+        name, data, _ = self.documents[(uid - 1) % len(self.documents)]
+        file_name = f"{uid:06d}-{name}"
+        pdf = data + b"\n%benchmark message " + str(uid).encode() + b"\n"
+        attachment = base64.encodebytes(pdf).replace(b"\n", b"\r\n")
+        text = b"BOLs attached.\r\n"
+        structure = (
+            f'(("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" {len(text)} 1 NIL NIL NIL NIL)'
+            f'("APPLICATION" "PDF" ("NAME" "{file_name}") NIL NIL "BASE64" {len(attachment)} NIL '
+            f'("ATTACHMENT" ("FILENAME" "{file_name}")) NIL NIL) "MIXED" ("BOUNDARY" "b{uid}") NIL NIL NIL)'
+        )
+        header = f"Message-ID: <bol-{uid}@benchmark.local>\r\nSubject: {self.subject} {uid}\r\n\r\n".encode()
+        return {"structure": structure, "header": header, "sections": {"1": text, "2": attachment}}
+
+    def connect(self, host=None, *args, **kwargs):
+        """
+        Drop-in for imaplib.IMAP4_SSL.
+        """
+        return FakeIMAPConnection(self)
+
+
+class FakeIMAPConnection:
+    def __init__(self, mailbox):
+        self.mailbox = mailbox
+        self.state = "NONAUTH"
+        self._responses = {}
+
+    def _command(self, name):
+        with self.mailbox._lock:
+            self.mailbox.commands[name] += 1
+        if self.mailbox.latency:
+            time.sleep(self.mailbox.latency)
+
+    def login(self, user, password):
+        self._command("LOGIN")
+        self.state = "AUTH"
+        return "OK", [b"Logged in"]
+
+    def noop(self):
+        self._command("NOOP")
+        return "OK", [b"NOOP completed"]
+
+    def select(self, mailbox="INBOX"):
+        self._command("SELECT")
+        self.state = "SELECTED"
+        self._responses["UIDVALIDITY"] = [str(self.mailbox.uidvalidity).encode()]
+        return "OK", [str(self.mailbox.delivered).encode()]
+
+    def response(self, code):
+        return code, self._responses.pop(code, [None])
+
+    def close(self):
+        self._command("CLOSE")
+        self.state = "AUTH"
+        return "OK", [b"Closed"]
+
+    def logout(self):
+        self._command("LOGOUT")
+        self.state = "LOGOUT"
+        return "BYE", [b"Logging out"]
+
+    def uid(self, command, *args):
+        self._command(f"UID {command}")
+        if command == "SEARCH":
+            return self._search(args[1])
+        if command == "FETCH":
+            return self._fetch(args[0], args[1])
+        return "NO", [f"Unsupported command {command}".encode()]
+
+    def _search(self, criteria):
+        subject = re.search(r'SUBJECT "([^"]*)"', criteria)
+        if subject and subject.group(1).lower() not in self.mailbox.subject.lower():
+            return "OK", [b""]
+        first = re.search(r"UID (\d+):\*", criteria)
+        first = int(first.group(1)) if first else 1
+        last = self.mailbox.delivered
+        # Like a real server, "n:*" matches the newest message even below n
+        uids = range(min(first, last), last + 1) if last else []
+        return "OK", [" ".join(str(uid) for uid in uids).encode()]
+
+    def _fetch(self, uid_set, items):
+        data = []
+        for uid in (int(uid) for uid in uid_set.split(",")):
+            if not 1 <= uid <= self.mailbox.delivered:
+                continue
+            message = self.mailbox.message(uid)
+            if "BODYSTRUCTURE" in items:
+                name = "BODY[HEADER.FIELDS (MESSAGE-ID SUBJECT)]"
+                prefix = f"{uid} (UID {uid} BODYSTRUCTURE {message['structure']} {name}"
+                body = message["header"]
+            else:
+                match = re.search(r"BODY\.PEEK\[(\d+)\](?:<(\d+)\.(\d+)>)?", items)
+                body = message["sections"][match.group(1)]
+                name = f"BODY[{match.group(1)}]"
+                if match.group(2):
+                    offset, length = int(match.group(2)), int(match.group(3))
+                    body = body[offset:offset + length]
+                    name += f"<{offset}>"
+                prefix = f"{uid} (UID {uid} {name}"
+            with self.mailbox._lock:
+                self.mailbox.bytes_sent += len(body)
+            data.extend([(f"{prefix} {{{len(body)}}}".encode(), body), b")"])
+        return "OK", data
+
+
+class StubModel:
+    """
+    Replaces the runnable, text_runnable and group_runnable of an OCRTool. Every
+    call waits for a latency drawn around `latency` and answers in the shape of
+    with_structured_output(include_raw=True): a Shipment with a new order number,
+    or a parsing error for a `failure_rate` share of calls.
+
+    on_order is called with every order number handed out, e.g. to create the
+    matching Seller Cloud order.
+    """
+
+    def __init__(self, latency=0.5, jitter=0.25, failure_rate=0.0, on_order=None, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.on_order = on_order
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._order_numbers = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _respond(self, payload):
+        with self._lock:
+            self.calls += 1
+            delay = max(0.0, self._random.gauss(self.latency, self.latency * self.jitter))
+            failed = self._random.random() < self.failure_rate
+            order_number = f"112-{next(self._order_numbers):07d}"
+        raw = AIMessage(content="", usage_metadata={
+            "input_tokens": _input_tokens(payload), "output_tokens": 150, "total_tokens": _input_tokens(payload) + 150,
+        })
+        if failed:
+            return delay, {"raw": raw, "parsed": None, "parsing_error": ValueError("Stub model returned invalid JSON")}
+        if self.on_order is not None:
+            self.on_order(order_number)
+        return delay, {"raw": raw, "parsed": _shipment(order_number), "parsing_error": None}
+
+    def invoke(self, payload, config=None):
+        delay, response = self._respond(payload)
+        time.sleep(delay)
+        return response
+
+    async def ainvoke(self, payload, config=None):
+        delay, response = self._respond(payload)
+        await asyncio.sleep(delay)
+        return response
+
+
+def _input_tokens(payload):
+    """
+    Rough prompt size: a fixed cost per page image, four characters per token of text.
+    """
+    if isinstance(payload, dict):
+        return sum(_input_tokens(value) for value in payload.values())
+    if isinstance(payload, (list, tuple)):
+        return sum(_input_tokens(value) for value in payload)
+    if hasattr(payload, "content"):
+        return _input_tokens(payload.content)
+    if isinstance(payload, str):
+        return IMAGE_TOKENS if payload.startswith("data:image") else len(payload) // 4
+    return 0
+
+
+def _shipment(order_number):
+    return Shipment(
+        ship_from=Address(company_name="Benchmark Shipper", contact_person="Dock 1",
+                          contact_number="+1-555-0100", address="1 Warehouse Way, Reno, NV"),
+        ship_to=Address(company_name="Benchmark Consignee", contact_person="Receiving",
+                        contact_number="+1-555-0199", address="99 Market St, Columbus, OH"),
+        carrier_info=CarrierInfo(carrier_name="Benchmark Freight", scac="BNCH", pro_number=order_number[4:]),
+        customer_order_information=CustomerOrderInformation(order_number=order_number, shipment_id=f"S{order_number[4:]}",
+                                                            pallets=1, cartons=12, weight=480.0),
+    )
+
+
+class FakeSheets:
+    """
+    In-memory stand-in for a gspread client. Every spreadsheet or worksheet call
+    counts as one API request; once `quota_per_minute` requests were made in the
+    last minute, further requests wait for the window to free up. The real API
+    answers those with HTTP 429 instead, so quota waits flag runs that would fail.
+    """
+
+    def __init__(self, latency=0.2, quota_per_minute=60):
+        self.latency = latency
+        self.quota_per_minute = quota_per_minute
+        self.spreadsheets = {}
+        self.requests = Counter()
+        self.quota_waits = 0
+        self.quota_wait_seconds = 0.0
+        self._window = deque()
+        self._lock = threading.Lock()
+
+    def _request(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+            now = time.monotonic()
+            while self._window and self._window[0] <= now - 60:
+                self._window.popleft()
+            wait = 0.0
+            if self.quota_per_minute and len(self._window) >= self.quota_per_minute:
+                wait = self._window[-self.quota_per_minute] + 60 - now
+                self.quota_waits += 1
+                self.quota_wait_seconds += wait
+            self._window.append(now + wait)
+        time.sleep(wait + self.latency)
+
+    def open(self, title):
+        self._request("read")
+        if title not in self.spreadsheets:
+            raise gspread.exceptions.SpreadsheetNotFound(title)
+        return self.spreadsheets[title]
+
+    def open_by_key(self, key):
+        self._request("read")
+        return next(s for s in self.spreadsheets.values() if s.id == key)
+
+    def create(self, title):
+        self._request("write")
+        spreadsheet = self.spreadsheets[title] = FakeSpreadsheet(self, title, f"spreadsheet-{len(self.spreadsheets) + 1}")
+        return spreadsheet
+
+
+class FakeSpreadsheet:
+    def __init__(self, backend, title, spreadsheet_id):
+        self.backend = backend
+        self.title = title
+        self.id = spreadsheet_id
+        self.worksheets = {}
+
+    def worksheet(self, title):
+        self.backend._request("read")
+        if title not in self.worksheets:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return self.worksheets[title]
+
+    def get_worksheet_by_id(self, sheet_id):
+        self.backend._request("read")
+        return next(w for w in self.worksheets.values() if w.id == sheet_id)
+
+    def add_worksheet(self, title, rows, cols):
+        self.backend._request("write")
+        worksheet = self.worksheets[title] = FakeWorksheet(self, title, len(self.worksheets), int(rows), int(cols))
+        return worksheet
+
+    def share(self, *args, **kwargs):
+        self.backend._request("write")
+
+    def values_get(self, range_name, params=None):
+        self.backend._request("read")
+        title = range_name.strip("'").replace("''", "'")
+        return {"values": self.worksheets[title].values()}
+
+
+class FakeWorksheet:
+    def __init__(self, spreadsheet, title, sheet_id, rows, cols):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self._rows = rows
+        self._cols = cols
+        self._grid = []
+
+    @property
+    def row_count(self):
+        return max(self._rows, len(self._grid))
+
+    @property
+    def col_count(self):
+        return max([self._cols] + [len(row) for row in self._grid])
+
+    def values(self):
+        rows = [list(row) for row in self._grid]
+        while rows and not any(rows[-1]):
+            rows.pop()
+        return rows
+
+    def _set(self, row, col, value):
+        while len(self._grid) < row:
+            self._grid.append([])
+        cells = self._grid[row - 1]
+        cells.extend([""] * (col - len(cells)))
+        cells[col - 1] = "" if value is None else str(value)
+
+    def _request(self, kind):
+        self.spreadsheet.backend._request(kind)
+
+    def resize(self, rows=None, cols=None):
+        self._request("write")
+        if rows is not None:
+            self._rows = int(rows)
+            del self._grid[self._rows:]
+        if cols is not None:
+            self._cols = int(cols)
+            for row in self._grid:
+                del row[self._cols:]
+
+    def add_cols(self, cols):
+        self._request("write")
+        self._cols = self.col_count + int(cols)
+
+    def update_cells(self, cells, value_input_option=None):
+        self._request("write")
+        for cell in cells:
+            self._set(cell.row, cell.col, cell.value)
+
+    def update_cell(self, row, col, value):
+        self._request("write")
+        self._set(row, col, value)
+
+    def batch_update(self, data, value_input_option=None):
+        self._request("write")
+        for update in data:
+            row, col = gspread.utils.a1_to_rowcol(update["range"].split("!")[-1].split(":")[0])
+            if col + max((len(values) for values in update["values"]), default=0) - 1 > self.col_count:
+                raise ValueError(f"Range {update['range']} exceeds grid limits")
+            for i, values in enumerate(update["values"]):
+                for j, value in enumerate(values):
+                    self._set(row + i, col + j, value)
+
+    def append_rows(self, rows, value_input_option=None, table_range=None, **kwargs):
+        self._request("write")
+        start = len(self.values())
+        for i, values in enumerate(rows):
+            for j, value in enumerate(values):
+                self._set(start + i + 1, j + 1, value)
+        last = gspread.utils.rowcol_to_a1(start + len(rows), max((len(values) for values in rows), default=1))
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start + 1}:{last}", "updatedRows": len(rows)}}
+
+    def row_values(self, row):
+        self._request("read")
+        values = self.values()
+        return list(values[row - 1]) if row <= len(values) else []
+
+    def col_values(self, col):
+        self._request("read")
+        return [row[col - 1] if col <= len(row) else "" for row in self.values()]
+
+    def batch_get(self, ranges, **kwargs):
+        self._request("read")
+        values = self.values()
+        result = []
+        for range_name in ranges:
+            col = gspread.utils.a1_to_rowcol(f"{range_name.split(':')[0]}1")[1]
+            column = [[row[col - 1]] if col <= len(row) and row[col - 1] else [] for row in values]
+            while column and not column[-1]:
+                column.pop()
+            result.append(column)
+        return result
+
+    def get_all_values(self):
+        self._request("read")
+        width = max((len(row) for row in self._grid), default=0)
+        return [row + [""] * (width - len(row)) for row in self.values()]
+
+    def get_all_records(self):
+        values = self.get_all_values()
+        if not values:
+            return []
+        header = values[0]
+        return [dict(zip(header, gspread.utils.numericise_all(row))) for row in values[1:]]
+
+
+class FakeSheetsClient(SheetsClient):
+    """
+    SheetsClient on top of a FakeSheets backend instead of service-account credentials.
+    """
+
+    def __init__(self, backend, credentials_file_path=None, scope=None):
+        self.credentials_file_path = credentials_file_path
+        self.scope = scope
+        self.credentials = None
+        self.gc = backend
+
+
+class FakeDrive:
+    """
+    In-memory Drive. Only the size of uploaded files is kept, so the benchmark's
+    memory figures are not inflated by the stand-in; downloads return zero bytes
+    of the same size.
+    """
+
+    def __init__(self, latency=0.1):
+        self.latency = latency
+        self.files = {}
+        self.bytes_uploaded = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def upload(self, name, size):
+        time.sleep(self.latency)
+        with self._lock:
+            file_id = f"benchmark{next(self._ids):08d}"
+            self.files[file_id] = (name, size)
+            self.bytes_uploaded += size
+        return f"https://drive.google.com/file/d/{file_id}/view"
+
+    def download(self, file_id):
+        time.sleep(self.latency)
+        return bytes(self.files[file_id][1])
+
+
+class FakeDriveClient(DriveClient):
+    """
+    DriveClient that uploads to and downloads from a FakeDrive.
+    """
+
+    def __init__(self, drive, credentials_file_path=None, scope=None):
+        self.drive = drive
+        self.credentials_file_path = credentials_file_path
+        self.scope = scope
+        self.credentials = None
+
+    def upload_pdf(self, file_data, file_name, parent_folder_id=None, num_retries=UPLOAD_RETRIES):
+        stream = io.BytesIO(file_data) if isinstance(file_data, (bytes, bytearray)) else file_data
+        stream.seek(0)
+        size = 0
+        # Read the stream the way the media upload would
+        while chunk := stream.read(1024 * 1024):
+            size += len(chunk)
+        return self.drive.upload(file_name, size)
+
+    def download_file(self, file_id):
+        return self.drive.download(file_id)
+
+
+class FakeSellerCloud:
+    """
+    Seller Cloud REST API with an order for a `match_rate` share of the order
+    numbers registered with it, so BOLs match Seller Cloud orders at that rate.
+    """
+
+    def __init__(self, latency=0.05, match_rate=0.7, seed=0):
+        self.latency = latency
+        self.match_rate = match_rate
+        self.orders = []
+        self.requests = Counter()
+        self.uploads = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def register(self, order_number):
+        with self._lock:
+            if self._random.random() < self.match_rate:
+                updated = datetime.now(timezone.utc).replace(tzinfo=None)
+                self.orders.append({"ID": 1_000_000 + len(self.orders), "OrderSourceOrderID": order_number,
+                                    "LastUpdate": updated})
+
+    def handle(self, method, url, params=None, json=None):
+        time.sleep(self.latency)
+        path = urlparse(url).path.rsplit("/api/", 1)[-1]
+        with self._lock:
+            self.requests[f"{method} {path.split('/')[0]}"] += 1
+        if path == "token":
+            return _FakeResponse(200, {"access_token": "benchmark-token"})
+        if method == "GET" and path == "Orders":
+            return _FakeResponse(200, self._orders_page(params or {}))
+        if method == "POST" and path.endswith("/UploadDocument"):
+            with self._lock:
+                self.uploads += 1
+            return _FakeResponse(200, {})
+        return _FakeResponse(404, {})
+
+    def _orders_page(self, params):
+        size = int(params.get("model.pageSize", 50))
+        number = int(params.get("model.pageNumber", 1))
+        with self._lock:
+            orders = list(self.orders)
+        if ORDERS_UPDATED_FROM_PARAM in params:
+            since = datetime.strptime(params[ORDERS_UPDATED_FROM_PARAM], "%Y-%m-%dT%H:%M:%S")
+            orders = [order for order in orders if order["LastUpdate"] >= since]
+        page = orders[(number - 1) * size:number * size]
+        items = [{"ID": order["ID"], "OrderSourceOrderID": order["OrderSourceOrderID"]} for order in page]
+        return {"Items": items, "TotalResults": len(orders)}
+
+
+class _FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self._payload = payload
+
+    def json(self):
+        return self._payload
+
+
+class _FakeSession:
+    def __init__(self, server):
+        self.server = server
+
+    def post(self, url, json=None, **kwargs):
+        return self.server.handle("POST", url, json=json)
+
+    def request(self, method, url, params=None, json=None, **kwargs):
+        return self.server.handle(method, url, params=params, json=json)
+
+
+class FakeSellerCloudClient(SellerCloudClient):
+    """
+    SellerCloudClient whose HTTP session is answered by a FakeSellerCloud.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.session = _FakeSession(server)
@@ -0,0 +1,82 @@
+"""
+Construction cost of DriveClient and SheetsClient, with and without the shared
+client registry in utils.google_clients.
+
+Runs entirely offline: a throwaway service-account key file stands in for the real
+one, and clients are only constructed, never used, so no request leaves the machine.
+
+    python -m benchmarks.google_clients --iterations 50
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import gspread
+import rsa
+from googleapiclient.discovery import build
+from oauth2client.service_account import ServiceAccountCredentials as SAC
+
+from utils import google_clients
+from utils.drive import DriveClient
+from utils.sheet import SheetsClient
+
+DRIVE_SCOPE = ['https://www.googleapis.com/auth/drive', 'https://www.googleapis.com/auth/drive.file']
+SHEETS_SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+
+def write_stub_credentials(directory):
+    _, private_key = rsa.newkeys(2048)
+    path = os.path.join(directory, "service_account.json")
+    with open(path, "w") as f:
+        json.dump({
+            "type": "service_account",
+            "project_id": "benchmark",
+            "private_key_id": "benchmark",
+            "private_key": private_key.save_pkcs1().decode("utf-8"),
+            "client_email": "benchmark@benchmark.iam.gserviceaccount.com",
+            "client_id": "0",
+            "token_uri": "https://oauth2.googleapis.com/token",
+        }, f)
+    return path
+
+
+def legacy_drive(path):
+    credentials = SAC.from_json_keyfile_name(path, DRIVE_SCOPE)
+    return build('drive', 'v3', credentials=credentials)
+
+
+def legacy_sheets(path):
+    credentials = SAC.from_json_keyfile_name(path, SHEETS_SCOPE)
+    return gspread.authorize(credentials)
+
+
+def timed(fn, path, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(path)
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = write_stub_credentials(directory)
+        cases = [
+            ("Drive, per-call build", legacy_drive),
+            ("Drive, registry", lambda p: DriveClient(credentials_file_path=p).service),
+            ("Sheets, per-call authorize", legacy_sheets),
+            ("Sheets, registry", lambda p: SheetsClient(credentials_file_path=p)),
+        ]
+        google_clients.clear()
+        print(f"{'client':<28} {'ms/construction':>16}")
+        for name, fn in cases:
+            print(f"{name:<28} {timed(fn, path, args.iterations):>16.2f}")
+
+
+if __name__ == "__main__":
+    main()
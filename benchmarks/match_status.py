@@ -0,0 +1,91 @@
+"""
+Synthetic benchmark of the BOL / Seller Cloud status match, comparing the original
+iterrows implementation with the hash join in utils.sheet.match_status.
+
+The iterrows version is O(n * m), so by default it only runs up to 10k rows;
+raise --legacy-max-rows to time it on larger sizes. Wherever both run, their
+outputs are checked to be identical.
+
+    python -m benchmarks.match_status --rows 10000 100000 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from utils.sheet import match_status
+
+
+def legacy_match_status(df1, df2, tab1_column, tab2_column):
+    df1 = df1.copy()
+    if 'status' not in df1.columns:
+        df1['status'] = 'Not Uploaded'
+    df1['status'] = df1['status'].astype(object)
+    matched_ids = []
+    for index, row in df1.iterrows():
+        match = df2[df2[tab2_column] == row[tab1_column]]
+        if not match.empty:
+            if not (df1.at[index, 'status'] == 'Uploaded' or df1.at[index, 'status'] == 'TRUE'):
+                df1.at[index, 'status'] = 'Not Uploaded'
+                matched_row = match.iloc[0]
+                matched_ids.append({
+                    'order_id': str(matched_row['order_id']).replace(".0", ""),
+                    'pdf_link': row['pdf_link'],
+                    'order_number': row['order_number']
+                })
+        else:
+            df1.at[index, 'status'] = 'Unmatched'
+    return df1, matched_ids
+
+
+def make_frames(rows, seed=0):
+    """
+    BOL rows and Seller Cloud orders where roughly 70% of BOLs have an order,
+    some orders are duplicated and some BOLs are already uploaded.
+    """
+    rng = np.random.default_rng(seed)
+    order_numbers = np.array([f"112-{i:07d}" for i in range(rows)], dtype=object)
+    df1 = pd.DataFrame({
+        'order_number': order_numbers,
+        'pdf_link': [f"https://drive.google.com/file/d/{i}/view" for i in range(rows)],
+        'status': rng.choice(np.array(['Uploaded', 'Not Uploaded', 'Unmatched', 'TRUE', np.nan], dtype=object), rows),
+    })
+    matched = rng.random(rows) < 0.7
+    df2 = pd.DataFrame({
+        'order_id': rng.integers(1_000_000, 9_999_999, matched.sum()).astype(float),
+        'order_number': order_numbers[matched],
+    })
+    df2 = pd.concat([df2, df2.sample(frac=0.05, random_state=seed)], ignore_index=True)
+    return df1, df2.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--legacy-max-rows", type=int, default=10_000)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'iterrows s':>12} {'hash join s':>12} {'speedup':>9} {'to upload':>10}")
+    for rows in args.rows:
+        df1, df2 = make_frames(rows)
+        new_time, (new_df, new_ids) = timed(match_status, df1, df2, 'order_number', 'order_number')
+        legacy = "-"
+        speedup = "-"
+        if rows <= args.legacy_max_rows:
+            legacy_time, (legacy_df, legacy_ids) = timed(legacy_match_status, df1, df2, 'order_number', 'order_number')
+            assert legacy_ids == new_ids, "matched ids differ"
+            pd.testing.assert_frame_equal(legacy_df, new_df)
+            legacy = f"{legacy_time:.2f}"
+            speedup = f"{legacy_time / new_time:.0f}x"
+        print(f"{rows:>10} {legacy:>12} {new_time:>12.3f} {speedup:>9} {len(new_ids):>10}")
+
+
+if __name__ == "__main__":
+    main()
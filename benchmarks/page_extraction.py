@@ -0,0 +1,68 @@
+"""
+Output size and time per page of extracting single-page PDFs from the bundled
+test_documents: the previous plain write(), write() with PAGE_WRITE_OPTIONS, and
+write_page_pdf saving straight to a temporary file as the pipeline's publishers do.
+
+    python -m benchmarks.page_extraction
+"""
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import fitz
+
+from utils.pdf_splitter import write_page_pdf
+
+
+def plain_write(doc, page_num):
+    new_doc = fitz.open()
+    new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
+    data = new_doc.write()
+    new_doc.close()
+    return len(data)
+
+
+def options_write(doc, page_num):
+    return len(write_page_pdf(doc, page_num))
+
+
+def temp_file(doc, page_num):
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        path = tmp.name
+    try:
+        write_page_pdf(doc, page_num, path)
+        return os.path.getsize(path)
+    finally:
+        os.unlink(path)
+
+
+MODES = {"plain write": plain_write, "write(options)": options_write, "temp file": temp_file}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", default="test_documents/*.pdf")
+    parser.add_argument("--rounds", type=int, default=3, help="Best of this many rounds is reported")
+    args = parser.parse_args()
+
+    print(f"{'document':<50} {'mode':<16} {'pages':>6} {'source KB':>10} {'pages KB':>10} {'ms/page':>8}")
+    for path in sorted(glob.glob(args.documents)):
+        doc = fitz.open(path)
+        name = os.path.basename(path)[:48]
+        source_kb = os.path.getsize(path) / 1024
+        for mode, extract in MODES.items():
+            best = None
+            for _ in range(args.rounds):
+                started = time.perf_counter()
+                size = sum(extract(doc, page_num) for page_num in range(doc.page_count))
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{name:<50} {mode:<16} {doc.page_count:>6} {source_kb:>10.0f} {size / 1024:>10.0f} "
+                  f"{best / doc.page_count * 1000:>8.2f}")
+        doc.close()
+
+
+if __name__ == "__main__":
+    main()
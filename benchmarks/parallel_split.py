@@ -0,0 +1,70 @@
+"""
+Rendering throughput of splitting the bundled test_documents PDFs serially with
+split_pdf versus asplit_pdf_parallel on a process pool, by worker count.
+
+Pools are warmed up before timing so process start-up is not counted. Use
+--repeat to concatenate each document with itself and simulate large batches.
+
+    python -m benchmarks.parallel_split --workers 1 2 4 --repeat 5
+"""
+import argparse
+import asyncio
+import glob
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+from utils.pdf_splitter import asplit_pdf_parallel, split_pdf
+
+
+def build_document(path, repeat):
+    src = fitz.open(path)
+    doc = fitz.open()
+    for _ in range(repeat):
+        doc.insert_pdf(src)
+    data = doc.tobytes()
+    doc.close()
+    src.close()
+    return data
+
+
+def time_serial(data):
+    started = time.perf_counter()
+    pages = len(split_pdf(data))
+    return pages, time.perf_counter() - started
+
+
+def time_parallel(data, executor, workers):
+    started = time.perf_counter()
+    pages = len(asyncio.run(asplit_pdf_parallel(data, executor, workers)))
+    return pages, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--repeat", type=int, default=1, help="Concatenate each document this many times")
+    parser.add_argument("--documents", default="test_documents/*.pdf")
+    args = parser.parse_args()
+
+    print(f"{os.cpu_count()} CPUs")
+    print(f"{'document':<50} {'mode':<12} {'pages':>6} {'seconds':>9} {'pages/s':>9}")
+    for path in sorted(glob.glob(args.documents)):
+        data = build_document(path, args.repeat)
+        name = os.path.basename(path)[:48]
+        pages, seconds = time_serial(data)
+        print(f"{name:<50} {'serial':<12} {pages:>6} {seconds:>9.2f} {pages / seconds:>9.1f}")
+        for workers in args.workers:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                # Start every worker process before timing
+                list(executor.map(abs, range(workers)))
+                pages, seconds = time_parallel(data, executor, workers)
+            mode = f"{workers} workers"
+            print(f"{name:<50} {mode:<12} {pages:>6} {seconds:>9.2f} {pages / seconds:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
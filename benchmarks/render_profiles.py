@@ -0,0 +1,94 @@
+"""
+Compare page render profiles on the bundled test_documents PDFs: payload size sent
+to the model, render time per page and, optionally, extraction agreement.
+
+There is no ground truth for the sample documents, so with --ocr every profile is
+scored by the share of Shipment fields that match the extraction from the first
+(reference) profile. That mode calls the OCR model and needs OPENAI_API_KEY.
+
+    python -m benchmarks.render_profiles
+    python -m benchmarks.render_profiles --ocr --pages 3
+"""
+import argparse
+import base64
+import glob
+import os
+import time
+
+import fitz
+
+from utils.render import RenderProfile
+
+PROFILES = [
+    RenderProfile(dpi=200, grayscale=False, jpeg_quality=0),
+    RenderProfile(dpi=72, grayscale=False, jpeg_quality=0),
+    RenderProfile(dpi=100, grayscale=True, jpeg_quality=75),
+    RenderProfile(dpi=150, grayscale=True, jpeg_quality=75),
+    RenderProfile(dpi=150, grayscale=True, jpeg_quality=75, crop_to_content=True),
+    RenderProfile(dpi=200, grayscale=True, jpeg_quality=60, crop_to_content=True),
+]
+
+
+def flatten(data, prefix=""):
+    fields = {}
+    for key, value in (data or {}).items():
+        if isinstance(value, dict):
+            fields.update(flatten(value, f"{prefix}{key}."))
+        else:
+            fields[f"{prefix}{key}"] = value
+    return fields
+
+
+def agreement(result, reference):
+    reference = flatten(reference)
+    if not reference:
+        return None
+    result = flatten(result)
+    return sum(result.get(key) == value for key, value in reference.items()) / len(reference)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", default="test_documents/*.pdf")
+    parser.add_argument("--pages", type=int, default=None, help="Only use the first N pages of each document")
+    parser.add_argument("--ocr", action="store_true", help="Also run OCR and score field agreement")
+    args = parser.parse_args()
+
+    ocr_tool = None
+    if args.ocr:
+        from utils.ocr import OCRTool
+        ocr_tool = OCRTool()
+
+    pages = []
+    for path in sorted(glob.glob(args.documents)):
+        doc = fitz.open(path)
+        count = min(doc.page_count, args.pages or doc.page_count)
+        pages.extend((os.path.basename(path), doc, page_num) for page_num in range(count))
+
+    reference = {}
+    print(f"{'profile':<32} {'pages':>6} {'avg KB':>9} {'ms/page':>9} {'agreement':>10}")
+    for profile in PROFILES:
+        payload = 0
+        elapsed = 0.0
+        scores = []
+        for name, doc, page_num in pages:
+            page = doc.load_page(page_num)
+            start = time.perf_counter()
+            image_base64 = base64.b64encode(profile.render(page)).decode("utf-8")
+            elapsed += time.perf_counter() - start
+            payload += len(image_base64)
+            if ocr_tool is not None:
+                result = ocr_tool.run(image_base64, profile.mime_type).shipment
+                if profile is PROFILES[0]:
+                    reference[(name, page_num)] = result
+                else:
+                    score = agreement(result, reference.get((name, page_num)))
+                    if score is not None:
+                        scores.append(score)
+        score = f"{sum(scores) / len(scores):.1%}" if scores else "-"
+        print(f"{profile.name:<32} {len(pages):>6} {payload / len(pages) / 1024:>9.1f} "
+              f"{elapsed / len(pages) * 1000:>9.1f} {score:>10}")
+
+
+if __name__ == "__main__":
+    main()
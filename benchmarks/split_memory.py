@@ -0,0 +1,104 @@
+"""
+Peak memory of splitting the bundled test_documents PDFs, eagerly with split_pdf
+versus lazily with iter_pages, and on a process pool with asplit_pdf_parallel
+(every page at once) versus aiter_pages_parallel (pages streamed as their ranges
+complete, as the pipeline does).
+
+Each measurement runs in a fresh subprocess so ru_maxrss only reflects that mode.
+Use --repeat to concatenate a document with itself and simulate large batches.
+
+    python -m benchmarks.split_memory --repeat 10
+"""
+import argparse
+import asyncio
+import glob
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import fitz
+
+MODES = ("split_pdf", "iter_pages", "asplit_pdf_parallel", "aiter_pages_parallel")
+# Process pool size of the parallel modes
+WORKERS = 2
+
+
+def peak_rss_mb():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def build_document(path, repeat, out_path):
+    src = fitz.open(path)
+    doc = fitz.open()
+    for _ in range(repeat):
+        doc.insert_pdf(src)
+    doc.save(out_path)
+    doc.close()
+    src.close()
+
+
+async def split_parallel(mode, data, executor):
+    from utils.pdf_splitter import aiter_pages_parallel, asplit_pdf_parallel
+
+    if mode == "asplit_pdf_parallel":
+        for page in await asplit_pdf_parallel(data, executor, WORKERS):
+            len(page["image"])
+    else:
+        async for page in aiter_pages_parallel(data, executor, WORKERS):
+            len(page["image"])
+
+
+def child(mode, path):
+    from utils.pdf_splitter import iter_pages, split_pdf
+
+    with open(path, "rb") as f:
+        data = f.read()
+    pages = fitz.open(stream=data, filetype="pdf").page_count
+    baseline = peak_rss_mb()
+    if mode == "split_pdf":
+        for page in split_pdf(data):
+            len(page["image"])
+    elif mode == "iter_pages":
+        for page in iter_pages(data):
+            len(page["image"])
+    else:
+        with ProcessPoolExecutor(WORKERS, mp_context=multiprocessing.get_context("spawn")) as executor:
+            asyncio.run(split_parallel(mode, data, executor))
+    print(f"{pages}\t{baseline:.1f}\t{peak_rss_mb():.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=1, help="Concatenate each document this many times")
+    parser.add_argument("--documents", default="test_documents/*.pdf")
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.child[1])
+        return
+
+    print(f"{'document':<50} {'mode':<20} {'pages':>6} {'base MB':>9} {'peak MB':>9} {'delta MB':>9}")
+    for path in sorted(glob.glob(args.documents)):
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+            build_document(path, args.repeat, tmp.name)
+            outputs = {
+                mode: subprocess.run(
+                    [sys.executable, "-m", "benchmarks.split_memory", "--child", mode, tmp.name],
+                    check=True, capture_output=True, text=True,
+                ).stdout.strip().splitlines()[-1]
+                for mode in MODES
+            }
+        for mode, output in outputs.items():
+            pages, baseline, peak = output.split("\t")
+            name = os.path.basename(path)[:48]
+            print(f"{name:<50} {mode:<20} {pages:>6} {baseline:>9} {peak:>9} {float(peak) - float(baseline):>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
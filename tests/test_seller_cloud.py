@@ -0,0 +1,45 @@
+"""
+Tests for the incremental Seller Cloud order sync.
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import utils.seller_cloud as seller_cloud
+from benchmarks.fakes import FakeSellerCloud, FakeSellerCloudClient
+from utils.store import LocalStore
+
+
+@pytest.fixture
+def store():
+    store = LocalStore(":memory:")
+    yield store
+    store.close()
+
+
+def test_sync_over_cap_fails_and_keeps_watermark(store, monkeypatch):
+    monkeypatch.setattr(seller_cloud, "MAX_INCREMENTAL_ORDERS", 120)
+    server = FakeSellerCloud(latency=0, match_rate=1)
+    for number in range(400):
+        server.register(f"PO{number}")
+    watermark = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
+    store.set_state(seller_cloud.ORDERS_WATERMARK_KEY, watermark)
+
+    with pytest.raises(seller_cloud.OrderSyncIncomplete):
+        seller_cloud.sync_orders(FakeSellerCloudClient(server), store)
+
+    # Pages fetched before the cap are kept, the watermark is not moved past the rest
+    assert store.count_orders() == 150
+    assert store.get_state(seller_cloud.ORDERS_WATERMARK_KEY) == watermark
+    assert server.requests["GET Orders"] == 3
+
+
+def test_sync_under_cap_advances_watermark(store):
+    server = FakeSellerCloud(latency=0, match_rate=1)
+    for number in range(120):
+        server.register(f"PO{number}")
+    watermark = (datetime.now(timezone.utc) - timedelta(days=30)).isoformat()
+    store.set_state(seller_cloud.ORDERS_WATERMARK_KEY, watermark)
+
+    assert seller_cloud.sync_orders(FakeSellerCloudClient(server), store) == 120
+    assert store.get_state(seller_cloud.ORDERS_WATERMARK_KEY) > watermark
@@ -7,17 +7,26 @@ sharing them.
 """
 
 import logging
-from oauth2client.service_account import ServiceAccountCredentials as SAC
-from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload,MediaIoBaseDownload
 import io
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse, parse_qs
 import base64
 import requests
 
+from utils.google_clients import get_credentials, get_drive_service
+
 logger = logging.getLogger(__name__)
 
+# Uploads larger than this are sent as resumable uploads in RESUMABLE_CHUNK_SIZE chunks
+RESUMABLE_THRESHOLD = 5 * 1024 * 1024
+RESUMABLE_CHUNK_SIZE = 5 * 1024 * 1024
+# Retries for 429/5xx responses, with randomized exponential backoff between attempts
+UPLOAD_RETRIES = 5
+
 class DriveClient:
     """
     Class for connecting to Google Drive and performing operations on it.
@@ -28,17 +37,28 @@ class DriveClient:
             'https://www.googleapis.com/auth/drive',
             'https://www.googleapis.com/auth/drive.file'
         ]
-        self.credentials = SAC.from_json_keyfile_name(self.credentials_file_path, self.scope)
-        self.service = build('drive', 'v3', credentials=self.credentials)
+        self.credentials = get_credentials(self.credentials_file_path, self.scope)
+
+    @property
+    def service(self):
+        """
+        The Drive service for the calling thread, shared through utils.google_clients.
+        """
+        return get_drive_service(self.credentials_file_path, self.scope)
 
-    def upload_pdf(self, file_data, file_name, parent_folder_id=None):
+    def upload_pdf(self, file_data, file_name, parent_folder_id=None, num_retries=UPLOAD_RETRIES):
         """
         Uploads a PDF to Google Drive and returns the file link.
+
+        Files larger than RESUMABLE_THRESHOLD are sent as a resumable upload in
+        chunks. 429 and 5xx responses are retried up to num_retries times with
+        randomized exponential backoff (handled by googleapiclient).
         
         Args:
-        - file_data: Binary data of the PDF file.
+        - file_data: Binary data of the PDF file, or a binary file object that is streamed from.
         - file_name: The full name of the file to be saved.
         - parent_folder_id: The ID of the parent folder where the file should be uploaded. (Optional)
+        - num_retries: Number of retries for transient errors. (Optional)
         
         Returns:
         - The link to the uploaded PDF.
@@ -47,13 +67,26 @@ class DriveClient:
 
         file_metadata = {'name': file_name, 'mimeType': 'application/pdf', 'parents': [parent_folder_id]}
         
-        media = MediaIoBaseUpload(io.BytesIO(file_data), mimetype='application/pdf')
+        stream = io.BytesIO(file_data) if isinstance(file_data, (bytes, bytearray)) else file_data
+        size = stream.seek(0, io.SEEK_END)
+        stream.seek(0)
+        resumable = size > RESUMABLE_THRESHOLD
+        media = MediaIoBaseUpload(stream, mimetype='application/pdf',
+                                  chunksize=RESUMABLE_CHUNK_SIZE, resumable=resumable)
         
-        file = self.service.files().create(
+        request = self.service.files().create(
             body=file_metadata,
             media_body=media,
             fields='id, webViewLink'
-        ).execute()
+        )
+        if resumable:
+            file = None
+            while file is None:
+                status, file = request.next_chunk(num_retries=num_retries)
+                if status:
+                    logger.info(f"Upload {int(status.progress() * 100)}%.")
+        else:
+            file = request.execute(num_retries=num_retries)
 
         logger.info(f"Uploaded file '{file_name}' with file ID '{file.get('id')}'")
         logger.info(f"File link: {file.get('webViewLink')}")
@@ -211,3 +244,57 @@ class DriveClient:
             return self.file_to_base64(file_content),self.get_file_id_from_url(file_url)
         return None
 
+
+class DriveUploader:
+    """
+    Uploads PDFs to Google Drive on a bounded thread pool, so Drive I/O overlaps with
+    the rest of the pipeline. Each worker thread uses its own Drive service from the
+    shared client registry.
+    """
+
+    def __init__(self, drive_client, max_workers=4):
+        self.drive_client = drive_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="drive-upload")
+        self.latencies = []
+        self.failures = 0
+        self._lock = threading.Lock()
+
+    def _upload(self, file_data, file_name, parent_folder_id):
+        start = time.perf_counter()
+        try:
+            return self.drive_client.upload_pdf(file_data, file_name, parent_folder_id=parent_folder_id)
+        except Exception:
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            latency = time.perf_counter() - start
+            with self._lock:
+                self.latencies.append(latency)
+            logger.info(f"Drive upload of '{file_name}' took {latency:.2f}s")
+
+    def submit(self, file_data, file_name, parent_folder_id=None):
+        """
+        Schedule an upload and return a Future that resolves to the file link.
+        """
+        return self.executor.submit(self._upload, file_data, file_name, parent_folder_id)
+
+    def stats(self):
+        """
+        Return the upload count, failures and latency percentiles in seconds.
+        """
+        with self._lock:
+            latencies = sorted(self.latencies)
+            failures = self.failures
+        if not latencies:
+            return {"uploads": 0, "failures": failures}
+        return {
+            "uploads": len(latencies),
+            "failures": failures,
+            "p50": latencies[len(latencies) // 2],
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "max": latencies[-1],
+        }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -6,15 +6,25 @@ description: This module contains the EmailAttachmentExtractor class for connect
 an email inbox via IMAP4 and extracting attachments from emails.
 """
 
+import asyncio
 import imaplib
 import email
+import hashlib
+import io
 import os
 from email.header import decode_header
 import traceback
 import logging
 
+from utils.imap_parser import StreamDecoder, parse_fetch_response, pdf_parts
+
 logger = logging.getLogger(__name__)
 
+# Attachment parts are downloaded in slices of this many encoded bytes
+FETCH_CHUNK_SIZE = 1024 * 1024
+# Messages whose small PDF parts are fetched together in one command
+FETCH_BATCH_SIZE = 25
+
 class EmailAttachmentExtractor:
     """
     Class for connecting to an email inbox via IMAP4 and extracting attachments from emails.
@@ -27,6 +37,9 @@ class EmailAttachmentExtractor:
         Password of the account to connect to.
     imap_server : str
         IMAP server to connect to.
+    store : LocalStore
+        Optional store holding the UID watermark and the ledger of processed
+        messages and attachments. Without it every matching email is downloaded.
 
     Methods
     -------
@@ -36,17 +49,34 @@ class EmailAttachmentExtractor:
         Close the connection to the IMAP server.
     extract_pdf_attachments(directory_to_save, num_emails=5)
         Extract PDF attachments from the latest emails that have 'pdf' in their subject.
+    aiter_pdf_attachments(...)
+        Stream the same attachments asynchronously over a reusable connection.
+    mark_processed()
+        Record the emails returned by the last extraction in the ledger.
     """
 
-    def __init__(self, email_address, password, imap_server="imap.gmail.com"):
+    def __init__(self, email_address, password, imap_server="imap.gmail.com", store=None):
         self.email_address = email_address
         self.password = password
         self.imap_server = imap_server
+        self.store = store
+        self.uidvalidity = None
+        self._pending = None
+        self._lock = asyncio.Lock()
         self.mail = imaplib.IMAP4_SSL(self.imap_server)
 
+    def _is_alive(self):
+        if self.mail.state not in ("AUTH", "SELECTED"):
+            return False
+        try:
+            return self.mail.noop()[0] == "OK"
+        except (imaplib.IMAP4.abort, OSError):
+            return False
+
     def connect(self):
         """
-        Connect to the IMAP server and log in.
+        Connect to the IMAP server and log in. An already authenticated
+        connection is reused; a dropped or logged out one is replaced.
 
         Returns
         -------
@@ -54,13 +84,25 @@ class EmailAttachmentExtractor:
             True if the connection was successful, False otherwise.
         """
         try:
+            if self._is_alive():
+                logger.info("Reusing IMAP connection for %s", self.email_address)
+                return True
+            if self.mail.state != "NONAUTH":
+                self.mail = imaplib.IMAP4_SSL(self.imap_server)
             self.mail.login(self.email_address, self.password)
             logger.info("Successfully logged in to email account %s", self.email_address)
             return True
-        except imaplib.IMAP4.error as e:
+        except (imaplib.IMAP4.error, OSError) as e:
             logger.error("Login failed: %s", e)
             return False
 
+    def _close_mailbox(self):
+        if self.mail.state == "SELECTED":
+            try:
+                self.mail.close()
+            except (imaplib.IMAP4.error, OSError) as e:
+                logger.warning("Failed to close mailbox: %s", e)
+
     def close_connection(self):
         """
         Close the connection to the IMAP server.
@@ -69,10 +111,211 @@ class EmailAttachmentExtractor:
         -------
         None
         """
-        self.mail.close()
+        self._close_mailbox()
         self.mail.logout()
         logger.info("Successfully logged out from email account %s", self.email_address)
 
+    def _state_key(self, mailbox, name):
+        return f"imap:{self.email_address}:{mailbox}:{name}"
+
+    def _last_seen_uid(self, mailbox):
+        """
+        Return the highest UID already processed in the selected mailbox, or 0 when
+        there is no ledger or the mailbox's UIDVALIDITY changed since the last run.
+        """
+        _, data = self.mail.response("UIDVALIDITY")
+        self.uidvalidity = data[0].decode() if data and data[0] else None
+        if self.store is None:
+            return 0
+        if self.store.get_state(self._state_key(mailbox, "uidvalidity")) != self.uidvalidity:
+            logger.info("UIDVALIDITY of %s is new or changed, scanning from the first UID", mailbox)
+            return 0
+        return int(self.store.get_state(self._state_key(mailbox, "last_uid"), 0))
+
+    def _fetch_structures(self, uids):
+        """
+        Fetch the BODYSTRUCTURE and the Message-ID and Subject headers of the
+        given UIDs in a single command, without downloading any message body.
+        """
+        status, data = self.mail.uid(
+            "FETCH",
+            ",".join(str(uid) for uid in uids),
+            "(UID BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (MESSAGE-ID SUBJECT)])",
+        )
+        if status != "OK":
+            logger.error("Failed to fetch message structures: %s", data)
+            return {}
+        structures = {}
+        for uid, items in parse_fetch_response(data).items():
+            header = next((v for k, v in items.items() if k.startswith("BODY[HEADER")), None) or b""
+            header = email.message_from_bytes(header)
+            subject = header["Subject"] or ""
+            if subject:
+                subject, encoding = decode_header(subject)[0]
+                if isinstance(subject, bytes):
+                    subject = subject.decode(encoding or "utf-8", "replace")
+            structures[uid] = {
+                "message_id": (header["Message-ID"] or "").strip(),
+                "subject": subject,
+                "parts": pdf_parts(items.get("BODYSTRUCTURE") or []),
+            }
+        return structures
+
+    def _fetch_part(self, uid, part):
+        """
+        Download a single body section in FETCH_CHUNK_SIZE slices, decoding each
+        slice as it arrives.
+        """
+        decoder = StreamDecoder(part["encoding"])
+        buffer = io.BytesIO()
+        offset = 0
+        while True:
+            status, data = self.mail.uid(
+                "FETCH", str(uid), f"(UID BODY.PEEK[{part['section']}]<{offset}.{FETCH_CHUNK_SIZE}>)"
+            )
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"Failed to fetch part {part['section']} of UID {uid}: {data}")
+            items = parse_fetch_response(data).get(uid, {})
+            chunk = next((v for k, v in items.items() if k.startswith("BODY[")), None) or b""
+            buffer.write(decoder.feed(chunk))
+            offset += len(chunk)
+            if len(chunk) < FETCH_CHUNK_SIZE:
+                break
+        buffer.write(decoder.finish())
+        return buffer.getvalue()
+
+    def _fetch_small_parts(self, uids, structures):
+        """
+        Download the PDF parts of several messages that fit in one slice with one
+        UID FETCH per distinct section number, instead of one command per part.
+
+        Returns
+        -------
+        dict
+            Decoded part bodies keyed by (uid, section).
+        """
+        sections = {}
+        for uid in uids:
+            for part in structures[uid]["parts"]:
+                if part["size"] <= FETCH_CHUNK_SIZE:
+                    sections.setdefault(part["section"], {})[uid] = part
+        bodies = {}
+        for section, parts in sections.items():
+            status, data = self.mail.uid(
+                "FETCH", ",".join(str(uid) for uid in parts), f"(UID BODY.PEEK[{section}])"
+            )
+            if status != "OK":
+                raise imaplib.IMAP4.error(f"Failed to fetch part {section} of UIDs {list(parts)}: {data}")
+            for uid, items in parse_fetch_response(data).items():
+                if uid not in parts:
+                    continue
+                body = next((v for k, v in items.items() if k.startswith("BODY[")), None) or b""
+                decoder = StreamDecoder(parts[uid]["encoding"])
+                bodies[(uid, section)] = decoder.feed(body) + decoder.finish()
+        return bodies
+
+    def iter_pdf_attachments(
+        self,
+        directory_to_save=None,
+        num_emails=5,
+        subject_contains="pdf",
+        date_from=None,
+        date_to=None,
+        mailbox="INBOX",
+    ):
+        """
+        Yield PDF attachments one at a time as they are downloaded. Takes the same
+        parameters as extract_pdf_attachments and leaves the connection open.
+        """
+        self._pending = None
+        self.mail.select(mailbox)
+        last_uid = self._last_seen_uid(mailbox)
+
+        # Search for emails with pdf_contains in their subject in the mailbox and
+        # were received between date_from and date_to
+        criteria = []
+        if subject_contains:
+            criteria.append(f'SUBJECT "{subject_contains}"')
+        if date_from:
+            criteria.append(f"SINCE {date_from}")
+        if date_to:
+            criteria.append(f"BEFORE {date_to}")
+        if last_uid:
+            criteria.append(f"UID {last_uid + 1}:*")
+        search_criteria = " ".join(criteria) if criteria else "ALL"
+        logger.info("Searching emails with criteria: %s", search_criteria)
+
+        status, messages = self.mail.uid("SEARCH", None, search_criteria)
+        if status != "OK":
+            logger.error("Failed to search emails: %s", messages)
+            return
+
+        # "UID n:*" always matches the newest message, even below n
+        uids = [int(uid) for uid in messages[0].split() if int(uid) > last_uid]
+        if not uids:
+            logger.warning(
+                "No new emails found with subject containing '%s' between %s and %s", subject_contains, date_from, date_to
+            )
+            return
+
+        # The oldest 'num_emails' new emails, so a backlog drains in UID order
+        # without the watermark jumping over emails left for the next run
+        latest_uids = sorted(uids)[:num_emails]
+        self._pending = {"mailbox": mailbox, "last_uid": last_uid, "uids": latest_uids, "completed": set(),
+                         "messages": [], "attachments": []}
+
+        structures = self._fetch_structures(latest_uids)
+        if self.store is not None:
+            seen = self.store.processed_message_ids(
+                m["message_id"] for m in structures.values() if m["message_id"]
+            )
+            if seen:
+                logger.info("Skipping %d already processed emails", len(seen))
+            for uid in latest_uids:
+                if structures.get(uid, {}).get("message_id") in seen:
+                    self._pending["completed"].add(uid)
+            latest_uids = [uid for uid in latest_uids if uid not in self._pending["completed"]]
+        latest_uids = [uid for uid in latest_uids if uid in structures]
+
+        seen_attachments = set()
+
+        for start in range(0, len(latest_uids), FETCH_BATCH_SIZE):
+            batch = latest_uids[start:start + FETCH_BATCH_SIZE]
+            bodies = self._fetch_small_parts(batch, structures)
+            for uid in batch:
+                structure = structures[uid]
+                message_id = structure["message_id"] or f"uid:{self.uidvalidity}:{uid}"
+                logger.info("Processing email subject: %s", structure["subject"])
+
+                # Only the PDF attachment parts are downloaded
+                for part in structure["parts"]:
+                    file_name = part["filename"]
+                    key = (uid, part["section"])
+                    binary_data = bodies.pop(key) if key in bodies else self._fetch_part(uid, part)
+                    sha256 = hashlib.sha256(binary_data).hexdigest()
+                    if sha256 in seen_attachments or (
+                        self.store is not None and self.store.is_attachment_processed(sha256)
+                    ):
+                        logger.info("Skipping already processed attachment: %s", file_name)
+                        continue
+                    seen_attachments.add(sha256)
+                    self._pending["attachments"].append((sha256, file_name))
+                    logger.info("Found PDF attachment: %s", file_name)
+                    if directory_to_save:
+                        file_path = os.path.join(directory_to_save, file_name)
+                        with open(file_path, "wb") as f:
+                            f.write(binary_data)
+                        logger.info("Saved attachment: %s", file_path)
+                    yield {
+                        "file_name": file_name,
+                        "binary_data": binary_data,
+                        "message_id": message_id,
+                        "sha256": sha256,
+                    }
+                # Only a message whose parts were all handed out counts as processed
+                self._pending["messages"].append((message_id, uid))
+                self._pending["completed"].add(uid)
+
     def extract_pdf_attachments(
         self,
         directory_to_save=None,
@@ -80,11 +323,17 @@ class EmailAttachmentExtractor:
         subject_contains="pdf",
         date_from=None,
         date_to=None,
+        mailbox="INBOX",
     ):
         """
         Extract PDF attachments from the latest emails that have subject_contains in
         their subject and were received between date_from and date_to.
 
+        With a store, only messages with a UID above the last processed one are
+        searched, messages whose Message-ID is in the ledger are not downloaded and
+        attachments whose hash is in the ledger are skipped. Call mark_processed()
+        once the returned PDFs are handled to advance the ledger.
+
         Parameters
         ----------
         directory_to_save : str
@@ -97,80 +346,78 @@ class EmailAttachmentExtractor:
             Date in the format 'dd-mm-yyyy' to search for emails received after this date.
         date_to : str
             Date in the format 'dd-mm-yyyy' to search for emails received before this date.
+        mailbox : str
+            Mailbox to search in; 'INBOX' by default.
         """
         try:
-            # Select the mailbox to search in; 'INBOX' by default
-            self.mail.select("INBOX")
-
-            # Search for emails with pdf_contains in their subject in the mailbox and
-            # were received between date_from and date_to
-            criteria = []
-            if subject_contains:
-                criteria.append(f'SUBJECT "{subject_contains}"')
-            if date_from:
-                criteria.append(f"SINCE {date_from}")
-            if date_to:
-                criteria.append(f"BEFORE {date_to}")
-            search_criteria = " ".join(criteria) if criteria else "ALL"
-            logger.info("Searching emails with criteria: %s", search_criteria)
-
-            status, messages = self.mail.search(None, search_criteria)
-            if status != "OK":
-                logger.error("Failed to search emails: %s", messages)
-                return
-
-            # The search returns a list of email IDs; we'll get the latest 'num_emails' emails
-            messages = messages[0].split(b" ")
-            if not messages or messages == [b""]:
-                logger.warning(
-                    "No emails found with subject containing '%s' between %s and %s", subject_contains, date_from, date_to
-                )
-                return
-
-            latest_emails = messages[-num_emails:]
-
-            pdfs = []
-
-            for mail in latest_emails:
-                # Fetch the email by ID
-                status, data = self.mail.fetch(mail, "(RFC822)")
-                for response_part in data:
-                    if isinstance(response_part, tuple):
-                        # Parse the email content
-                        msg = email.message_from_bytes(response_part[1])
-                        subject, encoding = decode_header(msg["Subject"])[0]
-                        if isinstance(subject, bytes):
-                            subject = subject.decode(encoding)
-                        logger.info("Processing email subject: %s", subject)
-
-                        # Check if the email has any attachments
-                        for part in msg.walk():
-                            if (
-                                part.get_content_maintype() == "multipart"
-                                or part.get("Content-Disposition") is None
-                            ):
-                                continue
-                            if "attachment" in part.get("Content-Disposition"):
-                                file_name = part.get_filename()
-                                if file_name and file_name.endswith(".pdf"):
-                                    binary_data = part.get_payload(decode=True)
-                                    pdf = {
-                                        "file_name": file_name,
-                                        "binary_data": binary_data,
-                                    }
-                                    pdfs.append(pdf)
-                                    logger.info("Found PDF attachment: %s", file_name)
-                                    if directory_to_save:
-                                        file_path = os.path.join(
-                                            directory_to_save, file_name
-                                        )
-                                        with open(file_path, "wb") as f:
-                                            f.write(binary_data)
-                                        logger.info("Saved attachment: %s", file_path)
-            return pdfs
-
+            return list(self.iter_pdf_attachments(
+                directory_to_save, num_emails, subject_contains, date_from, date_to, mailbox
+            ))
         except Exception as e:
+            self._fail_pending()
             logger.error("An error occurred: %s", e)
             traceback.print_exc()
         finally:
-            self.close_connection()
\ No newline at end of file
+            self.close_connection()
+
+    async def aiter_pdf_attachments(self, *args, **kwargs):
+        """
+        Async version of iter_pdf_attachments for the scheduler. IMAP commands run
+        in a worker thread and every attachment is yielded as soon as it is
+        downloaded, so OCR can start on the first PDF while the rest are fetched.
+
+        The connection stays logged in afterwards so the next run can reuse it;
+        only the mailbox is closed.
+        """
+        async with self._lock:
+            attachments = self.iter_pdf_attachments(*args, **kwargs)
+            done = object()
+            try:
+                while True:
+                    pdf = await asyncio.to_thread(next, attachments, done)
+                    if pdf is done:
+                        break
+                    yield pdf
+            except Exception as e:
+                # The attachments fetched so far are still processed, but the run
+                # must not be recorded as complete
+                self._fail_pending()
+                logger.error("An error occurred: %s", e)
+                traceback.print_exc()
+            finally:
+                await asyncio.to_thread(attachments.close)
+                await asyncio.to_thread(self._close_mailbox)
+
+    def _fail_pending(self):
+        if self._pending is not None:
+            self._pending["failed"] = True
+
+    def mark_processed(self):
+        """
+        Record the messages and attachments returned by the last
+        extract_pdf_attachments call in the ledger and advance the mailbox's UID
+        watermark, so the next run only downloads newer messages.
+
+        Nothing is recorded when the fetch failed partway. The watermark only moves
+        over messages that were completely downloaded, in UID order; a message left unfinished keeps it below, so the next run
+        searches from there and the ledger skips the ones done since.
+        """
+        if self.store is None or self._pending is None:
+            return
+        pending, self._pending = self._pending, None
+        if pending.get("failed"):
+            logger.warning("Fetching emails failed partway; the ledger and UID watermark are left as they were")
+            return
+        self.store.mark_processed(pending["messages"], pending["attachments"])
+        last_uid = pending["last_uid"]
+        for uid in pending["uids"]:
+            if uid not in pending["completed"]:
+                break
+            last_uid = uid
+        mailbox = pending["mailbox"]
+        self.store.set_state(self._state_key(mailbox, "uidvalidity"), self.uidvalidity)
+        self.store.set_state(self._state_key(mailbox, "last_uid"), str(last_uid))
+        logger.info(
+            "Marked %d emails and %d attachments as processed (last UID %s)",
+            len(pending["messages"]), len(pending["attachments"]), last_uid,
+        )
@@ -0,0 +1,95 @@
+"""
+This module contains a process-wide registry of Google API clients.
+
+Service-account credentials, gspread clients and the Drive discovery document are
+created once and shared by every DriveClient and SheetsClient. The googleapiclient
+Drive service wraps an httplib2 connection, which is not thread-safe, so one
+service is kept per thread instead of one per process.
+"""
+
+import json
+import logging
+import threading
+
+import gspread
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from oauth2client.service_account import ServiceAccountCredentials as SAC
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Size of the keep-alive connection pool on the shared gspread session
+HTTP_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_local = threading.local()
+_credentials = {}
+_gspread_clients = {}
+_discovery_documents = {}
+
+
+def get_credentials(credentials_file_path, scope):
+    """
+    Return the service-account credentials for a key file and scope, loading the
+    key file only the first time.
+    """
+    key = (credentials_file_path, tuple(scope))
+    with _lock:
+        if key not in _credentials:
+            _credentials[key] = SAC.from_json_keyfile_name(credentials_file_path, list(scope))
+            logger.info("Loaded service account credentials from '%s'", credentials_file_path)
+        return _credentials[key]
+
+
+def get_discovery_document(service_name, version):
+    """
+    Return the parsed discovery document bundled with google-api-python-client.
+    """
+    key = (service_name, version)
+    with _lock:
+        if key not in _discovery_documents:
+            _discovery_documents[key] = json.loads(get_static_doc(service_name, version))
+        return _discovery_documents[key]
+
+
+def get_drive_service(credentials_file_path, scope):
+    """
+    Return the Drive v3 service for the calling thread, building it on first use.
+    """
+    services = getattr(_local, "drive_services", None)
+    if services is None:
+        services = _local.drive_services = {}
+    key = (credentials_file_path, tuple(scope))
+    if key not in services:
+        credentials = get_credentials(credentials_file_path, scope)
+        services[key] = build_from_document(get_discovery_document("drive", "v3"), credentials=credentials)
+    return services[key]
+
+
+def get_gspread_client(credentials_file_path, scope):
+    """
+    Return the shared gspread client for a key file and scope. All callers reuse its
+    HTTP session, so connections to the Sheets API are kept alive between calls.
+    """
+    key = (credentials_file_path, tuple(scope))
+    with _lock:
+        client = _gspread_clients.get(key)
+    if client is None:
+        client = gspread.authorize(get_credentials(credentials_file_path, scope))
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        client.http_client.session.mount("https://", adapter)
+        with _lock:
+            client = _gspread_clients.setdefault(key, client)
+    return client
+
+
+def clear():
+    """
+    Drop all cached clients and credentials, e.g. after rotating the key file.
+    """
+    with _lock:
+        _credentials.clear()
+        _gspread_clients.clear()
+        _discovery_documents.clear()
+    _local.__dict__.clear()
@@ -0,0 +1,225 @@
+"""
+This module contains helpers to parse IMAP FETCH responses as returned by
+imaplib, walk a BODYSTRUCTURE to find PDF attachment parts and decode their
+transfer encoding incrementally.
+"""
+import binascii
+import re
+from email.header import decode_header, make_header
+
+_TOKEN = re.compile(
+    rb"""\s*(?:
+        (?P<open>\()
+      | (?P<close>\))
+      | "(?P<quoted>(?:[^"\\]|\\.)*)"
+      | \{(?P<literal>\d+)\}$
+      | (?P<atom>[^\s()"\[\]{}]+(?:\[[^\]]*\](?:<\d+>)?)?)
+    )""",
+    re.VERBOSE,
+)
+
+
+class _Literal:
+    def __init__(self, data):
+        self.data = data
+
+
+def _segments(data):
+    """
+    Flatten imaplib's response list, where every literal comes as the second item
+    of a (prefix, literal) tuple, into text and _Literal segments.
+    """
+    for item in data:
+        if isinstance(item, tuple):
+            yield item[0]
+            yield _Literal(item[1])
+        elif item:
+            yield item
+
+
+def _tokenize(data):
+    for segment in _segments(data):
+        if isinstance(segment, _Literal):
+            yield "literal", segment.data
+            continue
+        pos = 0
+        while pos < len(segment):
+            match = _TOKEN.match(segment, pos)
+            if not match or match.end() == pos:
+                if segment[pos:].strip():
+                    raise ValueError(f"Unexpected IMAP response data: {segment[pos:]!r}")
+                break
+            pos = match.end()
+            kind = match.lastgroup
+            if kind == "literal":
+                # The literal itself follows as the next segment
+                continue
+            yield kind, match.group(kind)
+
+
+def _parse(tokens):
+    """
+    Parse tokens into nested lists of bytes, with NIL as None.
+    """
+    stack = [[]]
+    for kind, value in tokens:
+        if kind == "open":
+            stack.append([])
+        elif kind == "close":
+            if len(stack) == 1:
+                raise ValueError("Unbalanced parenthesis in IMAP response")
+            closed = stack.pop()
+            stack[-1].append(closed)
+        elif kind == "quoted":
+            stack[-1].append(re.sub(rb"\\(.)", rb"\1", value))
+        elif kind == "atom" and value.upper() == b"NIL":
+            stack[-1].append(None)
+        else:
+            stack[-1].append(value)
+    if len(stack) != 1:
+        raise ValueError("Unbalanced parenthesis in IMAP response")
+    return stack[0]
+
+
+def parse_fetch_response(data):
+    """
+    Parse the data of a UID FETCH command into {uid: {item name: value}}.
+
+    Item names are upper-cased strings such as "BODYSTRUCTURE" or
+    "BODY[HEADER.FIELDS (MESSAGE-ID)]"; values are nested lists of bytes.
+    """
+    parsed = _parse(_tokenize(data))
+    messages = {}
+    # Each response is "<sequence number> (<name> <value> ...)"
+    for attributes in parsed:
+        if not isinstance(attributes, list):
+            continue
+        items = {}
+        for name, value in zip(attributes[0::2], attributes[1::2]):
+            items[name.decode("ascii").upper()] = value
+        if "UID" in items:
+            messages[int(items["UID"])] = items
+    return messages
+
+
+def _text(value):
+    return value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {_text(k).lower(): _text(v) for k, v in zip(value[0::2], value[1::2])}
+
+
+def _decode_filename(name):
+    if not name:
+        return name
+    try:
+        return str(make_header(decode_header(name)))
+    except Exception:
+        return name
+
+
+def _single_part(body, section):
+    """
+    Describe a non-multipart body: type, subtype, params, id, description,
+    encoding, size, then type-specific fields before the extension data.
+    """
+    maintype, subtype = _text(body[0]).lower(), _text(body[1]).lower()
+    if maintype == "text":
+        extension = 8
+    elif maintype == "message" and subtype == "rfc822":
+        extension = 10
+    else:
+        extension = 7
+    # The extension data starts with the MD5, followed by the disposition
+    disposition = body[extension + 1] if len(body) > extension + 1 else None
+    disposition_type, disposition_params = None, {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = _text(disposition[0]).lower()
+        disposition_params = _params(disposition[1] if len(disposition) > 1 else None)
+    return {
+        "section": section,
+        "content_type": f"{maintype}/{subtype}",
+        "encoding": (_text(body[5]) or "7bit").lower(),
+        "size": int(body[6]) if body[6] is not None else 0,
+        "disposition": disposition_type,
+        "filename": _decode_filename(disposition_params.get("filename") or _params(body[2]).get("name")),
+    }
+
+
+def iter_parts(body, prefix=""):
+    """
+    Yield a description of every leaf part in a parsed BODYSTRUCTURE with its
+    section number, e.g. "2" or "1.3". Attached messages (message/rfc822, e.g. a
+    forwarded email) are walked too, with sections below the attachment's own,
+    e.g. "2.1" or "2.1.2".
+    """
+    if body and isinstance(body[0], list):
+        # Multipart: child bodies come first, followed by the subtype and
+        # extension data
+        for index, child in enumerate(body):
+            if not isinstance(child, list):
+                break
+            yield from iter_parts(child, f"{prefix}{index + 1}.")
+        return
+    part = _single_part(body, prefix.rstrip(".") or "1")
+    # The body of an attached message follows its envelope
+    nested = body[8] if part["content_type"] == "message/rfc822" and len(body) > 8 else None
+    if isinstance(nested, list) and nested:
+        if isinstance(nested[0], list):
+            yield from iter_parts(nested, f"{part['section']}.")
+        else:
+            # A non-multipart message has its single part at <section>.1
+            yield from iter_parts(nested, f"{part['section']}.1.")
+        return
+    yield part
+
+
+def pdf_parts(bodystructure):
+    """
+    Return the parts of a message that are PDF attachments, i.e. parts with an
+    attachment disposition and a file name ending in .pdf.
+    """
+    return [
+        part for part in iter_parts(bodystructure)
+        if part["disposition"] == "attachment" and part["filename"] and part["filename"].endswith(".pdf")
+    ]
+
+
+class StreamDecoder:
+    """
+    Decode a Content-Transfer-Encoding one chunk at a time, so a part can be
+    fetched in slices without holding its encoded form in memory.
+    """
+
+    def __init__(self, encoding):
+        self.encoding = (encoding or "7bit").lower()
+        self._pending = b""
+
+    def feed(self, chunk):
+        data = self._pending + chunk
+        if self.encoding == "base64":
+            data = re.sub(rb"[^A-Za-z0-9+/=]", b"", data)
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            return binascii.a2b_base64(data[:usable]) if usable else b""
+        if self.encoding == "quoted-printable":
+            # Only decode up to the last line break so soft breaks and escapes
+            # are never split
+            cut = data.rfind(b"\n") + 1
+            self._pending = data[cut:]
+            return binascii.a2b_qp(data[:cut])
+        self._pending = b""
+        return data
+
+    def finish(self):
+        data, self._pending = self._pending, b""
+        if not data:
+            return b""
+        if self.encoding == "base64":
+            return binascii.a2b_base64(data + b"=" * (-len(data) % 4))
+        if self.encoding == "quoted-printable":
+            return binascii.a2b_qp(data)
+        return data
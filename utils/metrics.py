@@ -0,0 +1,241 @@
+"""
+This module contains a small in-process metrics registry for the pipeline:
+counters and latency histograms with labels, rendered in the Prometheus text
+exposition format for the /metrics route, and per-run summaries built from the
+difference between two snapshots.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds; covers IMAP and Drive calls as well as multi-minute Sheets writes
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._render_samples())
+        return lines
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing value, e.g. pages processed or bytes uploaded.
+    """
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _render_samples(self):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+                for key, value in sorted(self._values.items())]
+
+    def snapshot(self):
+        with self._lock:
+            return {key: value for key, value in self._values.items()}
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, e.g. the duration of the last run.
+    """
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. per-item latency of a stage.
+    """
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _render_samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+    def snapshot(self):
+        with self._lock:
+            return {key: (sum(counts), total) for key, (counts, total) in self._values.items()}
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Metric {metric.name} is already registered")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Return every metric in the Prometheus text exposition format.
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.snapshot() for metric in metrics if not isinstance(metric, Gauge)}
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    "invoice_ocr_stage_seconds", "Time spent on one item in each pipeline stage.", ["stage"])
+ITEMS = REGISTRY.counter(
+    "invoice_ocr_items_total", "Items completed by each pipeline stage.", ["stage"])
+ERRORS = REGISTRY.counter(
+    "invoice_ocr_errors_total", "Items that failed in each pipeline stage.", ["stage"])
+BYTES = REGISTRY.counter(
+    "invoice_ocr_bytes_total", "Bytes handled, by kind of payload.", ["kind"])
+TOKENS = REGISTRY.counter(
+    "invoice_ocr_tokens_total", "Model tokens used for extraction.", ["model", "type"])
+OCR_RETRIES = REGISTRY.counter(
+    "invoice_ocr_model_retries_total", "OCR model requests retried, by reason.", ["reason"])
+OCR_CONCURRENCY_LIMIT = REGISTRY.gauge(
+    "invoice_ocr_model_concurrency_limit", "Current adaptive limit of OCR requests in flight.")
+LAST_RUN_TIMESTAMP = REGISTRY.gauge(
+    "invoice_ocr_last_run_timestamp_seconds", "Unix time the last scheduler run finished.")
+LAST_RUN_DURATION = REGISTRY.gauge(
+    "invoice_ocr_last_run_duration_seconds", "Wall time of the last scheduler run.")
+
+
+@contextmanager
+def track(stage):
+    """
+    Time a unit of work of a stage and count it as completed, or as an error if it
+    raises.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        ERRORS.inc(stage=stage)
+        raise
+    else:
+        ITEMS.inc(stage=stage)
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, stage=stage)
+
+
+def run_summary(before, after):
+    """
+    Summarize what happened between two registry snapshots: items, errors, seconds
+    and average latency per stage, bytes per kind and tokens per model.
+    """
+    def delta(name):
+        old = before.get(name, {})
+        return {key: value for key, value in (
+            (key, _subtract(value, old.get(key))) for key, value in after.get(name, {}).items()
+        ) if _nonzero(value)}
+
+    stages = {}
+    for (stage,), (count, seconds) in delta(STAGE_SECONDS.name).items():
+        stages[stage] = {"count": count, "seconds": round(seconds, 3),
+                         "avg_seconds": round(seconds / count, 3) if count else 0.0}
+    for (stage,), value in delta(ITEMS.name).items():
+        stages.setdefault(stage, {})["items"] = value
+    for (stage,), value in delta(ERRORS.name).items():
+        stages.setdefault(stage, {})["errors"] = value
+    return {
+        "stages": stages,
+        "bytes": {kind: value for (kind,), value in delta(BYTES.name).items()},
+        "tokens": {f"{model}:{kind}": value for (model, kind), value in delta(TOKENS.name).items()},
+    }
+
+
+def _subtract(value, old):
+    if old is None:
+        return value
+    if isinstance(value, tuple):
+        return tuple(a - b for a, b in zip(value, old))
+    return value - old
+
+
+def _nonzero(value):
+    return any(value) if isinstance(value, tuple) else bool(value)
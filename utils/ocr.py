@@ -1,38 +1,198 @@
-from typing import Optional
+import asyncio
+import hashlib
+import json
+import logging
+from typing import List
 from dotenv import load_dotenv
 
-from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.messages import HumanMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_openai import ChatOpenAI
 
+from utils.metrics import ERRORS, TOKENS
+from utils.ocr_cache import make_cache_key
+from utils.ocr_limiter import OCR_CACHED, OCRLimiter, OCRResult
+from utils.render import DEFAULT_PROFILE
 from utils.schema import Shipment
 
 
 load_dotenv()
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = "gpt-4o"
+DEFAULT_MIME_TYPE = DEFAULT_PROFILE.mime_type
 
 prompt = ChatPromptTemplate.from_messages(
     [
         ("system", "You are an OCR tool that can extract structured data from Bills of Lading (BOLs). Extract the data from the BOL below. Return None if any data is missing."),
         (
             "user",
-            [{"type": "image_url", "image_url": "data:image/jpeg;base64,{image_data}"}],
+            [{"type": "image_url", "image_url": "{image_url}"}],
         ),
     ]
 )
 
-model = ChatOpenAI(model="gpt-4o")
-llm = model.with_structured_output(Shipment)
+# Retries are left to OCRLimiter, which needs to see every 429 to adapt
+model = ChatOpenAI(model=MODEL_NAME, max_retries=0)
+# include_raw keeps the model message next to the parsed Shipment, for its token usage
+llm = model.with_structured_output(Shipment, include_raw=True)
 
 runnable = prompt | llm
 
+# Pages from generated PDFs carry a text layer; those are extracted from the text
+# alone, which is much cheaper than sending the rendered page to the vision model.
+text_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", "You are a tool that can extract structured data from Bills of Lading (BOLs). Extract the data from the text of the BOL below. Return None if any data is missing."),
+        ("user", "{text}"),
+    ]
+)
+
+text_runnable = text_prompt | llm
+
+# Multi-page BOLs are sent as one request with every page, as an image or as
+# its text layer, in page order
+group_prompt = ChatPromptTemplate.from_messages(
+    [
+        ("system", "You are an OCR tool that can extract structured data from Bills of Lading (BOLs). The pages below are consecutive pages of a single BOL. Extract the data from the BOL. Return None if any data is missing."),
+        MessagesPlaceholder("pages"),
+    ]
+)
+
+group_runnable = group_prompt | llm
+
+# Fingerprints of everything besides the image that determines the OCR output;
+# they are part of the cache key so prompt or schema changes invalidate the cache.
+PROMPT_VERSION = hashlib.sha256(repr(prompt.messages).encode("utf-8")).hexdigest()[:16]
+TEXT_PROMPT_VERSION = hashlib.sha256(repr(text_prompt.messages).encode("utf-8")).hexdigest()[:16]
+GROUP_PROMPT_VERSION = hashlib.sha256(repr(group_prompt.messages).encode("utf-8")).hexdigest()[:16]
+SCHEMA_VERSION = hashlib.sha256(json.dumps(Shipment.schema(), sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+def to_data_url(image_data: str, mime_type: str = DEFAULT_MIME_TYPE) -> str:
+    """
+    Wrap a base64 encoded page image in a data URL for the model.
+    """
+    return f"data:{mime_type};base64,{image_data}"
+
+
+def parse_response(response):
+    """
+    Record the token usage of a structured-output response and return the
+    extracted Shipment as a dict with the tokens used. Raises if the model output
+    could not be parsed.
+    """
+    tokens = 0
+    if isinstance(response, dict) and "parsed" in response:
+        usage = getattr(response.get("raw"), "usage_metadata", None) or {}
+        TOKENS.inc(usage.get("input_tokens", 0), model=MODEL_NAME, type="input")
+        TOKENS.inc(usage.get("output_tokens", 0), model=MODEL_NAME, type="output")
+        tokens = usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+        if response.get("parsing_error") is not None:
+            raise response["parsing_error"]
+        response = response["parsed"]
+        if response is None:
+            raise ValueError("The model returned no shipment")
+    return response.dict(), tokens
+
+
+def to_group_message(pages: List[dict]) -> HumanMessage:
+    """
+    Build the user message for a multi-page BOL from page dicts that carry either
+    "text" or "image" and "mime_type".
+    """
+    content = []
+    for page in pages:
+        if "text" in page:
+            content.append({"type": "text", "text": page["text"]})
+        else:
+            content.append({"type": "image_url",
+                            "image_url": {"url": to_data_url(page["image"], page.get("mime_type", DEFAULT_MIME_TYPE))}})
+    return HumanMessage(content=content)
+
+
 class OCRTool:
-    def __init__(self):
+    """
+    Extract Shipments from BOL pages with the model. Every method returns an
+    OCRResult; requests go through `limiter`, which keeps them within the
+    provider's limits and retries rate-limited and failed ones.
+    """
+
+    def __init__(self, cache=None, limiter=None):
         self.runnable = runnable
+        self.text_runnable = text_runnable
+        self.group_runnable = group_runnable
+        self.cache = cache
+        self.limiter = limiter or OCRLimiter()
+
+    def _cached(self, key):
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return OCRResult(OCR_CACHED, shipment=cached)
+        return None
+
+    def _finish(self, key, result):
+        if result.ok:
+            if self.cache is not None:
+                self.cache.set(key, result.shipment)
+        else:
+            ERRORS.inc(stage="ocr_request")
+            logger.warning("OCR request failed (%s) after %d attempts: %s", result.status, result.attempts,
+                           result.error)
+        return result
+
+    def _execute(self, runnable, payload, key) -> OCRResult:
+        return self._cached(key) or self._finish(key, self.limiter.run(runnable.invoke, payload, parse_response))
+
+    async def _aexecute(self, runnable, payload, key) -> OCRResult:
+        if self.cache is None:
+            return self._finish(key, await self.limiter.arun(runnable.ainvoke, payload, parse_response))
+        # Cache lookups and writes are SQLite calls, kept off the event loop
+        cached = await asyncio.to_thread(self._cached, key)
+        if cached is not None:
+            return cached
+        result = await self.limiter.arun(runnable.ainvoke, payload, parse_response)
+        return await asyncio.to_thread(self._finish, key, result)
+
+    def cache_key(self, image_data: str, mime_type: str = DEFAULT_MIME_TYPE) -> str:
+        return make_cache_key(image_data, MODEL_NAME, PROMPT_VERSION, SCHEMA_VERSION, mime_type)
+
+    def run(self, image_data: str, mime_type: str = DEFAULT_MIME_TYPE) -> OCRResult:
+        return self._execute(self.runnable, {"image_url": to_data_url(image_data, mime_type)},
+                             self.cache_key(image_data, mime_type))
+
+    async def arun(self, image_data: str, mime_type: str = DEFAULT_MIME_TYPE) -> OCRResult:
+        return await self._aexecute(self.runnable, {"image_url": to_data_url(image_data, mime_type)},
+                                    self.cache_key(image_data, mime_type))
+
+    def text_cache_key(self, text: str) -> str:
+        return make_cache_key(text, MODEL_NAME, TEXT_PROMPT_VERSION, SCHEMA_VERSION)
+
+    def run_text(self, text: str) -> OCRResult:
+        """
+        Extract a Shipment from the text layer of a page instead of its image.
+        """
+        return self._execute(self.text_runnable, {"text": text}, self.text_cache_key(text))
+
+    async def arun_text(self, text: str) -> OCRResult:
+        return await self._aexecute(self.text_runnable, {"text": text}, self.text_cache_key(text))
+
+    def group_cache_key(self, pages: List[dict]) -> str:
+        parts = "\0".join(page.get("text") or page["image"] for page in pages)
+        return make_cache_key(parts, MODEL_NAME, GROUP_PROMPT_VERSION, SCHEMA_VERSION)
+
+    def run_group(self, pages: List[dict]) -> OCRResult:
+        """
+        Extract one Shipment from several pages of the same BOL in a single request.
+        Pages that all have a text layer go through the text path as one text.
+        """
+        if all("text" in page for page in pages):
+            return self.run_text("\n\n".join(page["text"] for page in pages))
+        return self._execute(self.group_runnable, {"pages": [to_group_message(pages)]}, self.group_cache_key(pages))
 
-    def run(self, image_data: str) -> Optional[Shipment]:
-        try:
-            response = self.runnable.invoke({"image_data": image_data})
-            result = response.dict()
-            return result
-        except Exception as e:
-            print(e)
-            return None
\ No newline at end of file
+    async def arun_group(self, pages: List[dict]) -> OCRResult:
+        if all("text" in page for page in pages):
+            return await self.arun_text("\n\n".join(page["text"] for page in pages))
+        return await self._aexecute(self.group_runnable, {"pages": [to_group_message(pages)]},
+                                    self.group_cache_key(pages))
@@ -0,0 +1,137 @@
+"""
+This module contains a persistent, content-addressed cache for OCR results.
+
+Entries are keyed by a hash of the page image together with the prompt and the
+Shipment schema, so changing either of them invalidates old results.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Inserts between evictions; the cache may exceed max_entries by this many entries
+EVICT_EVERY = 100
+
+
+def make_cache_key(image_data, *fingerprints):
+    """
+    Build a cache key from the page image and any number of version fingerprints.
+    """
+    digest = hashlib.sha256()
+    for fingerprint in fingerprints:
+        digest.update(str(fingerprint).encode("utf-8"))
+        digest.update(b"\0")
+    digest.update(image_data.encode("utf-8") if isinstance(image_data, str) else image_data)
+    return digest.hexdigest()
+
+
+class OCRCache:
+    """
+    SQLite-backed store of OCR results with TTL and size based eviction.
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite database file.
+    ttl : int
+        Seconds after which an entry is considered stale. None or 0 disables expiry.
+    max_entries : int
+        Maximum number of entries to keep; least recently used entries are evicted first.
+    hits, misses : int
+        Lookup counters for the lifetime of this instance.
+    evict_every : int
+        Inserts between evictions; set runs evict on every insert when 1.
+    """
+
+    def __init__(self, path, ttl=None, max_entries=None, evict_every=EVICT_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.evict_every = max(1, evict_every)
+        self.hits = 0
+        self.misses = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS ocr_cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_ocr_cache_accessed ON ocr_cache (accessed_at)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_ocr_cache_created ON ocr_cache (created_at)")
+        self.conn.commit()
+
+    def get(self, key):
+        """
+        Return the cached result for key, or None if it is missing or expired.
+        """
+        now = time.time()
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT value, created_at FROM ocr_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or (self.ttl and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE ocr_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Store a result. None results are not cached so failed pages are retried.
+        The cache is evicted every `evict_every` inserts.
+        """
+        if value is None:
+            return
+        now = time.time()
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO ocr_cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now),
+            )
+            self.conn.commit()
+            self._inserts += 1
+            due = self._inserts % self.evict_every == 0
+        if due:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop expired entries and trim the cache down to max_entries.
+        """
+        with self._lock:
+            if self.ttl:
+                self.conn.execute("DELETE FROM ocr_cache WHERE created_at < ?", (time.time() - self.ttl,))
+            if self.max_entries:
+                excess = self.conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    self.conn.execute(
+                        "DELETE FROM ocr_cache WHERE key IN ("
+                        " SELECT key FROM ocr_cache ORDER BY accessed_at LIMIT ?)",
+                        (excess,),
+                    )
+            self.conn.commit()
+
+    def stats(self):
+        """
+        Return hit/miss counters and the current number of entries.
+        """
+        with self._lock:
+            size = self.conn.execute("SELECT COUNT(*) FROM ocr_cache").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": size}
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,340 @@
+"""
+This module contains the execution layer for OCR model requests: requests- and
+tokens-per-minute budgets, a concurrency limit that adapts to the provider (AIMD:
+it grows by one slot per window of fast successful requests and is cut on 429s
+and slow responses) and retries with jittered exponential backoff.
+
+Requests that still fail are reported as OCRResult objects carrying the reason,
+so callers can tell a page the model could not read from one whose request
+failed, e.g. on the rate limit or a rejected API key, and should be tried again
+later.
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import openai
+
+from utils.metrics import OCR_CONCURRENCY_LIMIT, OCR_RETRIES
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of an OCR request
+OCR_OK = "ok"
+OCR_CACHED = "cached"
+OCR_RATE_LIMITED = "rate_limited"
+OCR_UNAVAILABLE = "unavailable"
+OCR_INVALID = "invalid"
+OCR_ERROR = "error"
+# Requests interrupted by the caller; only used to release their slot
+_CANCELLED = "cancelled"
+# Failures worth trying again in a later run: everything but an answer that did
+# not parse. OCR_ERROR (e.g. a rejected API key, but also a 400 that will never
+# succeed) is not retried within the run, and the pipeline gives up on a page
+# after it failed that way in a few runs
+RETRYABLE = (OCR_RATE_LIMITED, OCR_UNAVAILABLE, OCR_ERROR)
+
+# Prompt tokens assumed for one page image before the actual usage is known;
+# gpt-4o bills a high-detail letter page at 765-1105 tokens
+IMAGE_TOKENS = 1105
+# Completion tokens reserved for a Shipment
+OUTPUT_TOKENS = 600
+# Seconds to wait between checks while every concurrency slot is taken
+_SLOT_POLL = 0.05
+
+
+@dataclass
+class OCRResult:
+    """
+    Outcome of one OCR request.
+
+    Attributes
+    ----------
+    status : str
+        One of OCR_OK, OCR_CACHED, OCR_RATE_LIMITED, OCR_UNAVAILABLE, OCR_INVALID or OCR_ERROR.
+    shipment : dict
+        The extracted Shipment, when the request succeeded.
+    error : str
+        Description of the last error otherwise.
+    attempts : int
+        Model requests made, retries included.
+    tokens : int
+        Tokens used by the successful request, as reported by the model.
+    """
+    status: str
+    shipment: Optional[dict] = None
+    error: Optional[str] = None
+    attempts: int = 0
+    tokens: int = 0
+
+    @property
+    def ok(self):
+        return self.shipment is not None
+
+    @property
+    def retryable(self):
+        return self.status in RETRYABLE
+
+
+def estimate_tokens(payload):
+    """
+    Estimate the tokens of a request from its payload: IMAGE_TOKENS per image,
+    four characters per token of text and OUTPUT_TOKENS for the answer.
+    """
+    def prompt_tokens(value):
+        if isinstance(value, dict):
+            if value.get("type") == "image_url" or "url" in value:
+                return IMAGE_TOKENS
+            return sum(prompt_tokens(item) for item in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(prompt_tokens(item) for item in value)
+        if hasattr(value, "content"):
+            return prompt_tokens(value.content)
+        if isinstance(value, str):
+            return IMAGE_TOKENS if value.startswith("data:") else len(value) // 4
+        return 0
+
+    return prompt_tokens(payload) + OUTPUT_TOKENS
+
+
+def classify_error(error):
+    """
+    Map an exception raised by a model request to an OCR status.
+    """
+    status_code = getattr(error, "status_code", None)
+    if isinstance(error, openai.RateLimitError) or status_code == 429:
+        return OCR_RATE_LIMITED
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError,
+                          asyncio.TimeoutError, ConnectionError)) or (status_code or 0) >= 500:
+        return OCR_UNAVAILABLE
+    return OCR_ERROR
+
+
+def _retry_after(error):
+    """
+    Seconds the provider asked to wait, from the Retry-After header of a 429.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class _Budget:
+    """
+    Token bucket holding up to `per_minute` units, refilled continuously.
+    """
+
+    def __init__(self, per_minute):
+        self.per_minute = per_minute
+        self.available = float(per_minute or 0)
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.per_minute:
+            self.available = min(self.per_minute,
+                                 self.available + (now - self._updated) * self.per_minute / 60)
+        self._updated = now
+
+    def wait_time(self, amount, now):
+        """
+        Seconds until `amount` units are available; 0 when they are now.
+        """
+        if not self.per_minute:
+            return 0.0
+        self._refill(now)
+        # A request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.per_minute)
+        return max(0.0, (amount - self.available) * 60 / self.per_minute)
+
+    def take(self, amount, now):
+        if self.per_minute:
+            self._refill(now)
+            # Corrections for actual usage may push the bucket below zero
+            self.available -= amount
+
+
+class OCRLimiter:
+    """
+    Shared by every OCR request of a process, so all workers draw on the same
+    provider limits. Safe to use from threads and from coroutines.
+
+    Args:
+    - requests_per_minute, tokens_per_minute: provider budgets; 0 disables either.
+    - max_concurrency: most requests in flight; the adaptive limit starts here.
+    - min_concurrency: floor of the adaptive limit.
+    - latency_target: seconds; slower responses shrink the limit like a 429 does.
+      0 or None disables the latency check.
+    - cooldown: seconds; limit cuts within this time of the last one count as the
+      same congestion event, so a burst of in-flight 429s halves the limit once.
+    - max_retries: retries of a rate-limited or failed request.
+    - backoff_base, backoff_max: bounds in seconds of the jittered backoff.
+    """
+
+    def __init__(self, requests_per_minute=0, tokens_per_minute=0, max_concurrency=4, min_concurrency=1,
+                 latency_target=60.0, cooldown=30.0, max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        self.requests = _Budget(requests_per_minute)
+        self.tokens = _Budget(tokens_per_minute)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = max(1, min(int(min_concurrency), self.max_concurrency))
+        self.latency_target = latency_target
+        self.cooldown = cooldown or 0.0
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self._paused_until = 0.0
+        self._last_decrease = float("-inf")
+        self._lock = threading.Lock()
+        OCR_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _try_acquire(self, estimated_tokens):
+        """
+        Take a slot and the budgets for one request; returns 0 on success or the
+        seconds to wait before trying again.
+        """
+        now = time.monotonic()
+        with self._lock:
+            wait = max(self._paused_until - now,
+                       self.requests.wait_time(1, now),
+                       self.tokens.wait_time(estimated_tokens, now))
+            if wait > 0:
+                return wait
+            if self.in_flight >= int(self.limit):
+                return _SLOT_POLL
+            self.in_flight += 1
+            self.requests.take(1, now)
+            self.tokens.take(estimated_tokens, now)
+            return 0.0
+
+    def _release(self, started, estimated_tokens, used_tokens=None, error_status=None, retry_after=None):
+        now = time.monotonic()
+        with self._lock:
+            self.in_flight -= 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - estimated_tokens, now)
+            if error_status == OCR_RATE_LIMITED:
+                self.throttled += 1
+                self._decrease(0.5, now)
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+            elif error_status is None and self.latency_target and now - started > self.latency_target:
+                self._decrease(0.75, now)
+            elif error_status is None and self.limit < self.max_concurrency:
+                # About one more slot per window of `limit` successful requests
+                self.limit = min(self.max_concurrency, self.limit + 1 / self.limit)
+            OCR_CONCURRENCY_LIMIT.set(self.limit)
+
+    def _decrease(self, factor, now):
+        # Requests that were already in flight report the same congestion
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        limit = max(self.min_concurrency, self.limit * factor)
+        if int(limit) < int(self.limit):
+            logger.info("OCR concurrency limit lowered to %d", int(limit))
+        self.limit = limit
+
+    def _backoff(self, attempt, retry_after=None):
+        # Full jitter, so retries of a burst of 429s spread out instead of colliding
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        return max(delay, retry_after or 0.0)
+
+    def _failure(self, error, attempt):
+        """
+        Record a failed attempt; returns its status, the seconds to wait before the
+        next attempt, or None when it should not be retried.
+        """
+        status = classify_error(error)
+        retry_after = _retry_after(error)
+        if status == OCR_ERROR or attempt >= self.max_retries:
+            return status, retry_after, None
+        OCR_RETRIES.inc(reason=status)
+        return status, retry_after, self._backoff(attempt, retry_after)
+
+    async def arun(self, call, payload, parse):
+        """
+        Await `call(payload)` within the limits, retrying rate-limited and failed
+        requests, and turn the response into an OCRResult with `parse`, which
+        returns (shipment, tokens used).
+        """
+        estimated = estimate_tokens(payload)
+        attempt = 0
+        while True:
+            wait = self._try_acquire(estimated)
+            while wait:
+                await asyncio.sleep(wait)
+                wait = self._try_acquire(estimated)
+            started = time.monotonic()
+            try:
+                response = await call(payload)
+            except Exception as e:
+                status, retry_after, delay = self._failure(e, attempt)
+                self._release(started, estimated, error_status=status, retry_after=retry_after)
+                attempt += 1
+                if delay is None:
+                    return OCRResult(status, error=str(e), attempts=attempt)
+                logger.warning("OCR request failed (%s), retrying in %.1fs: %s", status, delay, e)
+                await asyncio.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled mid-request: give the slot back, the provider is not to blame
+                self._release(started, estimated, error_status=_CANCELLED)
+                raise
+            attempt += 1
+            result = self._parsed(parse, response, attempt)
+            self._release(started, estimated, used_tokens=result.tokens or None)
+            return result
+
+    def run(self, call, payload, parse):
+        """
+        Blocking version of arun for the synchronous OCRTool methods.
+        """
+        estimated = estimate_tokens(payload)
+        attempt = 0
+        while True:
+            wait = self._try_acquire(estimated)
+            while wait:
+                time.sleep(wait)
+                wait = self._try_acquire(estimated)
+            started = time.monotonic()
+            try:
+                response = call(payload)
+            except Exception as e:
+                status, retry_after, delay = self._failure(e, attempt)
+                self._release(started, estimated, error_status=status, retry_after=retry_after)
+                attempt += 1
+                if delay is None:
+                    return OCRResult(status, error=str(e), attempts=attempt)
+                logger.warning("OCR request failed (%s), retrying in %.1fs: %s", status, delay, e)
+                time.sleep(delay)
+                continue
+            except BaseException:
+                # Cancelled mid-request: give the slot back, the provider is not to blame
+                self._release(started, estimated, error_status=_CANCELLED)
+                raise
+            attempt += 1
+            result = self._parsed(parse, response, attempt)
+            self._release(started, estimated, used_tokens=result.tokens or None)
+            return result
+
+    @staticmethod
+    def _parsed(parse, response, attempts):
+        try:
+            shipment, tokens = parse(response)
+        except Exception as e:
+            # The model answered, but not with a Shipment; asking again rarely helps
+            return OCRResult(OCR_INVALID, error=str(e), attempts=attempts)
+        return OCRResult(OCR_OK, shipment=shipment, attempts=attempts, tokens=tokens)
+
+    def stats(self):
+        with self._lock:
+            return {"limit": int(self.limit), "in_flight": self.in_flight, "throttled": self.throttled}
@@ -1,54 +1,311 @@
+import asyncio
 import fitz
 import base64
+import math
+import os
+import re
+import tempfile
+import threading
+from collections import deque
 from tqdm import tqdm
 import logging
 
+from utils.render import DEFAULT_PROFILE
+
 logger = logging.getLogger(__name__)
 
+# MuPDF is not thread-safe: fitz calls made from threads of the scheduler process
+# hold this lock. Process-pool workers each have their own MuPDF
+FITZ_LOCK = threading.RLock()
 
-def split_pdf(pdf_data):
-    logger.info("Splitting PDF")
-    doc = fitz.open(stream=pdf_data, filetype="pdf")
-    bol_info_list = []
-
-    for page_num in range(doc.page_count):
-        page = doc.load_page(page_num)
-
-        # Create a new PDF document for this page
-        new_doc = fitz.open()
-        new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num)
-        
-        # Save the new PDF to a bytes buffer
-        pdf_bytes = new_doc.write()
+# Largest page range rendered by one process-pool task in asplit_pdf_parallel
+PARALLEL_MAX_PAGES_PER_TASK = 16
+# Page range rendered by one task in aiter_pages_parallel; its pages are held until
+# the consumer takes them, so ranges stay small
+STREAM_PAGES_PER_TASK = 2
+
+# Single-page PDFs are written with unreferenced objects dropped, duplicates
+# merged and streams compressed, so a page does not carry copies of resources
+# it does not use
+PAGE_WRITE_OPTIONS = {"garbage": 3, "deflate": True}
+
+# Later pages of a multi-page BOL, e.g. "Page 2 of 3", are OCR'd together with
+# the pages before them, up to this many pages per BOL
+PAGE_OF_RE = re.compile(r"\bpage\s*(\d+)\s*(?:of|/)\s*(\d+)\b", re.IGNORECASE)
+MAX_GROUP_PAGES = 4
+
+# Pages with at least this many characters of extractable text skip rendering and
+# go through the text-only extraction path
+TEXT_LAYER_MIN_CHARS = 200
+
+
+def write_page_pdf(doc, page_num, path=None, last_page_num=None):
+    """
+    Extract page `page_num` of `doc` (through `last_page_num` for a multi-page BOL)
+    as a PDF, written with PAGE_WRITE_OPTIONS. Returns the PDF bytes, or saves it
+    straight to `path` when given, so the page never exists as a Python bytes object.
+    """
+    new_doc = fitz.open()
+    try:
+        new_doc.insert_pdf(doc, from_page=page_num, to_page=page_num if last_page_num is None else last_page_num)
+        if path is None:
+            return new_doc.write(**PAGE_WRITE_OPTIONS)
+        new_doc.save(path, **PAGE_WRITE_OPTIONS)
+        return path
+    finally:
         new_doc.close()
 
 
-         # Get the page as an image
-        pix = page.get_pixmap()
-        img_bytes = pix.tobytes()
-        image_base64 = base64.b64encode(img_bytes).decode("utf-8")
+def iter_pages(pdf_data, profile=None, text_min_chars=TEXT_LAYER_MIN_CHARS, skip_pages=None, page_range=None,
+               with_pdf=True):
+    """
+    Lazily split a PDF, yielding one page at a time as a dict with the page number,
+    a base64 image of the page (rendered with `profile`), its mime type and a
+    single-page PDF. Nothing is rendered until the consumer asks for the next page,
+    so memory stays bounded by what the consumer holds.
+
+    Pages whose text layer has at least `text_min_chars` characters are not rendered;
+    they carry a "text" entry instead of "image". Pass text_min_chars=0 to always render.
+    Page numbers in `skip_pages` are not rendered or yielded, and `page_range` (a
+    (start, stop) pair) limits the pages visited. `pdf_data` may also be a file path.
+    With with_pdf=False the single-page PDF is left out, for callers that extract
+    it later with write_page_pdf. Pages whose text marks them as a continuation
+    ("Page 2 of 3") are flagged with "continues" for group_pages.
+    """
+    profile = profile or DEFAULT_PROFILE
+    doc = fitz.open(pdf_data) if isinstance(pdf_data, str) else fitz.open(stream=pdf_data, filetype="pdf")
+    try:
+        start, stop = page_range or (0, doc.page_count)
+        for page_num in range(start, min(stop, doc.page_count)):
+            if skip_pages and page_num in skip_pages:
+                continue
+            page = doc.load_page(page_num)
+
+            bol_info = {"page_num": page_num}
+            if with_pdf:
+                bol_info["pdf"] = write_page_pdf(doc, page_num)
+            text = page.get_text("text").strip()
+            if is_continuation_page(text):
+                bol_info["continues"] = True
+            if text_min_chars and len(text) >= text_min_chars:
+                bol_info["text"] = text
+            else:
+                # Get the page as an image
+                img_bytes = profile.render(page)
+                bol_info["image"] = base64.b64encode(img_bytes).decode("utf-8")
+                bol_info["mime_type"] = profile.mime_type
+
+            # MuPDF keeps decoded page resources in a global store (up to 256MB);
+            # pages are visited once, so release them instead of caching.
+            fitz.TOOLS.store_shrink(100)
+
+            yield bol_info
+    finally:
+        doc.close()
+
 
-        # Add BoL info to the list
-        bol_info_list.append({
-            "image": image_base64,
-            "pdf": pdf_bytes
-        })
-    doc.close()
+def is_continuation_page(text):
+    """
+    True if a page's text marks it as a later page of a multi-page document, e.g.
+    "Page 2 of 3" or "Page 2/3".
+    """
+    for match in PAGE_OF_RE.finditer(text):
+        page, total = int(match.group(1)), int(match.group(2))
+        if 1 < page <= total:
+            return True
+    return False
+
+
+def group_pages(bol_info_list, max_pages=MAX_GROUP_PAGES):
+    """
+    Group the pages from iter_pages into BOLs: a page flagged as a continuation
+    joins the BOL of the page right before it, up to max_pages pages per BOL.
+    Scanned pages have no text to go by, so each of them stays its own BOL.
+
+    Returns
+    -------
+    list
+        Lists of consecutive page dicts, in page order.
+    """
+    groups = []
+    for bol_info in bol_info_list:
+        if groups and _continues(groups[-1], bol_info, max_pages):
+            groups[-1].append(bol_info)
+        else:
+            groups.append([bol_info])
+    return groups
+
+
+async def agroup_pages(pages, max_pages=MAX_GROUP_PAGES):
+    """
+    Same as group_pages for an async iterable of pages; each BOL is yielded as soon
+    as the page after it shows that it is complete.
+    """
+    group = None
+    async for bol_info in pages:
+        if group and _continues(group, bol_info, max_pages):
+            group.append(bol_info)
+            continue
+        if group:
+            yield group
+        group = [bol_info]
+    if group:
+        yield group
+
+
+def _continues(group, bol_info, max_pages):
+    return (
+        bol_info.get("continues")
+        and group[-1]["page_num"] == bol_info["page_num"] - 1
+        and len(group) < max_pages
+    )
+
+
+def split_pdf(pdf_data, profile=None, text_min_chars=TEXT_LAYER_MIN_CHARS, skip_pages=None):
+    logger.info("Splitting PDF")
+    bol_info_list = list(iter_pages(pdf_data, profile, text_min_chars, skip_pages))
     logger.info("PDF Splitting complete. Found %d BoLs", len(bol_info_list))
     return bol_info_list
 
-def process_pdf(pdf_bytes, ocr_tool, pdf_name=""):
-    bol_info_list = split_pdf(pdf_bytes)
-    for bol_info in tqdm(bol_info_list, desc=f"Processing BOLs from {pdf_name}"):
-        page_num = bol_info_list.index(bol_info)    
-        img = bol_info["image"]
-        shipment_info = ocr_tool.run(img)
-        if shipment_info is None:
-            logger.warning("No shipment info found for BoL in %s at page %d", pdf_name, page_num)
-            continue
-        order_number = shipment_info.get("customer_order_information", {}).get("order_number", "")
-        shipment_id = shipment_info.get("customer_order_information", {}).get("shipment_id", "")
-        file_name = f"Order {order_number} - Shipment {shipment_id}.pdf"
-        bol_info["shipment_info"] = shipment_info
-        bol_info["file_name"] = file_name
-    return bol_info_list
\ No newline at end of file
+def _split_range(path, page_range, profile, text_min_chars, skip_pages, with_pdf):
+    # Runs in a worker process, which opens the document from the shared temp file
+    return list(iter_pages(path, profile, text_min_chars, skip_pages, page_range, with_pdf))
+
+
+def _write_temp_pdf(pdf_data):
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
+        tmp.write(pdf_data)
+    with FITZ_LOCK, fitz.open(tmp.name) as doc:
+        return tmp.name, doc.page_count
+
+
+def _page_ranges(page_count, workers, max_pages=PARALLEL_MAX_PAGES_PER_TASK):
+    size = max(1, min(max_pages, math.ceil(page_count / max(1, workers))))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+async def aiter_pages_parallel(pdf_data, executor, workers, profile=None, text_min_chars=TEXT_LAYER_MIN_CHARS,
+                               skip_pages=None, with_pdf=True, pages_per_task=STREAM_PAGES_PER_TASK):
+    """
+    Render page ranges of `pages_per_task` pages on a ProcessPoolExecutor, like
+    asplit_pdf_parallel, but yield the pages in order as their ranges complete.
+    At most 2 * `workers` ranges are submitted ahead of the consumer, so the pages
+    held in memory are bounded by that window rather than by the document size.
+    """
+    loop = asyncio.get_running_loop()
+    path, page_count = await asyncio.to_thread(_write_temp_pdf, pdf_data)
+    ranges = iter(_page_ranges(page_count, workers, pages_per_task))
+    pending = deque()
+    try:
+        while True:
+            # Keep the pool busy while the consumer works on the pages already yielded
+            while len(pending) < 2 * max(1, workers):
+                page_range = next(ranges, None)
+                if page_range is None:
+                    break
+                pending.append(loop.run_in_executor(executor, _split_range, path, page_range, profile,
+                                                    text_min_chars, skip_pages, with_pdf))
+            if not pending:
+                return
+            for bol_info in await pending.popleft():
+                yield bol_info
+    finally:
+        for future in pending:
+            future.cancel()
+        os.unlink(path)
+
+
+async def asplit_pdf_parallel(pdf_data, executor, workers, profile=None,
+                              text_min_chars=TEXT_LAYER_MIN_CHARS, skip_pages=None, with_pdf=True):
+    """
+    Same as split_pdf, but renders page ranges concurrently on a
+    ProcessPoolExecutor with `workers` processes. The PDF is written once to a
+    temporary file that every worker opens by path, so the document bytes are not
+    pickled to each task. Pages keep their original order.
+    """
+    loop = asyncio.get_running_loop()
+    path, page_count = await asyncio.to_thread(_write_temp_pdf, pdf_data)
+    try:
+        ranges = _page_ranges(page_count, workers)
+        results = await asyncio.gather(*(
+            loop.run_in_executor(executor, _split_range, path, page_range, profile, text_min_chars, skip_pages,
+                                 with_pdf)
+            for page_range in ranges
+        ))
+    finally:
+        os.unlink(path)
+    bol_info_list = [bol_info for pages in results for bol_info in pages]
+    logger.info("PDF Splitting complete. Found %d BoLs in %d ranges", len(bol_info_list), len(ranges))
+    return bol_info_list
+
+
+def _attach_shipment_info(bol_info, result, pdf_name, page_num):
+    if not result.ok:
+        # Kept on the page so callers can retry rate-limited pages later
+        bol_info["ocr_status"] = result.status
+        bol_info["ocr_error"] = result.error
+        logger.warning("No shipment info found for BoL in %s at page %d (%s)", pdf_name, page_num, result.status)
+        return
+    shipment_info = result.shipment
+    order_number = shipment_info.get("customer_order_information", {}).get("order_number", "")
+    shipment_id = shipment_info.get("customer_order_information", {}).get("shipment_id", "")
+    file_name = f"Order {order_number} - Shipment {shipment_id}.pdf"
+    bol_info["shipment_info"] = shipment_info
+    bol_info["file_name"] = file_name
+
+
+def _ocr_page(ocr_tool, bol_info, stats=None):
+    if stats is not None:
+        stats["text" if "text" in bol_info else "vision"] += 1
+    if "text" in bol_info:
+        return ocr_tool.run_text(bol_info["text"])
+    return ocr_tool.run(bol_info["image"], bol_info["mime_type"])
+
+
+async def _aocr_page(ocr_tool, bol_info, stats=None):
+    if stats is not None:
+        stats["text" if "text" in bol_info else "vision"] += 1
+    if "text" in bol_info:
+        return await ocr_tool.arun_text(bol_info["text"])
+    return await ocr_tool.arun(bol_info["image"], bol_info["mime_type"])
+
+
+async def aocr_page(ocr_tool, bol_info, pdf_name="", stats=None):
+    """
+    OCR one page from iter_pages in place: attach its shipment info and file name
+    and drop the page image or text, leaving the page PDF.
+    """
+    result = await _aocr_page(ocr_tool, bol_info, stats)
+    bol_info.pop("image", None)
+    bol_info.pop("text", None)
+    _attach_shipment_info(bol_info, result, pdf_name, bol_info["page_num"])
+    return bol_info
+
+
+async def aocr_group(ocr_tool, pages, pdf_name="", stats=None):
+    """
+    OCR a BOL from group_pages with a single model request covering all of its
+    pages. The first page's dict is returned with the shipment info and
+    "last_page_num" set; the other pages are folded into it.
+    """
+    if len(pages) == 1:
+        return await aocr_page(ocr_tool, pages[0], pdf_name, stats)
+    head = pages[0]
+    if stats is not None:
+        stats["text" if all("text" in page for page in pages) else "vision"] += 1
+        stats["grouped"] += len(pages) - 1
+    result = await ocr_tool.arun_group(pages)
+    for page in pages:
+        page.pop("image", None)
+        page.pop("text", None)
+    head["last_page_num"] = pages[-1]["page_num"]
+    _attach_shipment_info(head, result, pdf_name, head["page_num"])
+    return head
+
+
+def process_pdf(pdf_bytes, ocr_tool, pdf_name="", profile=None, text_min_chars=TEXT_LAYER_MIN_CHARS, stats=None):
+    bol_info_list = split_pdf(pdf_bytes, profile, text_min_chars)
+    for page_num, bol_info in enumerate(tqdm(bol_info_list, desc=f"Processing BOLs from {pdf_name}")):
+        result = _ocr_page(ocr_tool, bol_info, stats)
+        _attach_shipment_info(bol_info, result, pdf_name, page_num)
+    return bol_info_list
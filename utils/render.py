@@ -0,0 +1,87 @@
+"""
+This module contains the render profile used to turn PDF pages into the images
+that are sent to the OCR model.
+"""
+from dataclasses import dataclass
+
+import fitz
+import numpy as np
+
+# Resolution of the thumbnail used to find the content bounding box
+_CROP_PROBE_DPI = 36
+# Gray level (0-255) below which a probe pixel counts as content
+_CROP_INK_THRESHOLD = 200
+
+
+# gpt-4o scales high-detail images down to 768px on the short side, which a letter
+# page reaches at roughly 90 DPI; rendering much finer only grows the payload.
+@dataclass(frozen=True)
+class RenderProfile:
+    """
+    How a PDF page is rasterized for OCR.
+
+    Attributes
+    ----------
+    dpi : int
+        Render resolution.
+    grayscale : bool
+        Render a single gray channel instead of RGB.
+    jpeg_quality : int
+        JPEG quality (1-100). 0 encodes the page as PNG instead.
+    crop_to_content : bool
+        Trim blank margins around the content before rendering.
+    margin : float
+        Padding in PDF points kept around the content when cropping.
+    """
+    dpi: int = 100
+    grayscale: bool = True
+    jpeg_quality: int = 75
+    crop_to_content: bool = False
+    margin: float = 12
+
+    @property
+    def mime_type(self):
+        return "image/jpeg" if self.jpeg_quality else "image/png"
+
+    @property
+    def name(self):
+        colorspace = "gray" if self.grayscale else "rgb"
+        encoding = f"jpeg{self.jpeg_quality}" if self.jpeg_quality else "png"
+        crop = "-crop" if self.crop_to_content else ""
+        return f"{self.dpi}dpi-{colorspace}-{encoding}{crop}"
+
+    def content_rect(self, page):
+        """
+        Return the bounding box of the non-blank area of the page, in page coordinates.
+        Works for scanned pages too, since it looks at rendered pixels rather than
+        at the PDF content stream.
+        """
+        probe = page.get_pixmap(dpi=_CROP_PROBE_DPI, colorspace=fitz.csGRAY)
+        pixels = np.frombuffer(probe.samples, dtype=np.uint8).reshape(probe.height, probe.stride)[:, :probe.width]
+        rows = np.flatnonzero((pixels < _CROP_INK_THRESHOLD).any(axis=1))
+        cols = np.flatnonzero((pixels < _CROP_INK_THRESHOLD).any(axis=0))
+        if rows.size == 0:
+            return page.rect
+        scale = 72 / _CROP_PROBE_DPI
+        # Both the probe and the get_pixmap clip use the rotated page coordinates of page.rect
+        rect = fitz.Rect(
+            cols[0] * scale - self.margin,
+            rows[0] * scale - self.margin,
+            (cols[-1] + 1) * scale + self.margin,
+            (rows[-1] + 1) * scale + self.margin,
+        )
+        return rect & page.rect
+
+    def render(self, page):
+        """
+        Render a fitz page and return the encoded image bytes.
+        """
+        clip = self.content_rect(page) if self.crop_to_content else None
+        colorspace = fitz.csGRAY if self.grayscale else fitz.csRGB
+        pix = page.get_pixmap(dpi=self.dpi, colorspace=colorspace, clip=clip)
+        if self.jpeg_quality:
+            return pix.tobytes("jpeg", jpg_quality=self.jpeg_quality)
+        return pix.tobytes("png")
+
+
+DEFAULT_PROFILE = RenderProfile()
@@ -1,9 +1,15 @@
 import requests
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 from oauth2client.service_account import ServiceAccountCredentials as SAC
 import pandas as pd
 import logging
+from datetime import datetime, timezone, timedelta
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 
 
@@ -69,4 +75,229 @@ def upload_to_sellercloud(api_key,order_id, file_content, file_name):
         "fileContent": file_content
     }
     response = requests.post(url, headers=headers, json=payload)
-    return response.status_code
\ No newline at end of file
+    return response.status_code
+
+ORDERS_PAGE_SIZE = 50
+# Query parameter of GET /Orders that filters on the last update time. Not yet
+# checked against the live API; MAX_INCREMENTAL_ORDERS guards against it being ignored
+ORDERS_UPDATED_FROM_PARAM = 'model.lastUpdateDateFrom'
+# Date range preset used before a watermark exists (the window the scheduler always fetched)
+ORDERS_BOOTSTRAP_RANGE = 9
+# Watermarks are moved back by this much to cover clock skew, time zone differences
+# with the API and in-flight updates; re-fetched orders are idempotent upserts
+SYNC_OVERLAP = timedelta(days=1)
+ORDERS_WATERMARK_KEY = 'seller_cloud_orders_watermark'
+# Most orders an incremental sync is expected to return. More than this means the
+# update filter was most likely ignored and the whole order history is being paged
+MAX_INCREMENTAL_ORDERS = 5000
+
+
+class OrderSyncIncomplete(ValueError):
+    """
+    Raised when an incremental order sync stops paging at MAX_INCREMENTAL_ORDERS.
+    """
+
+
+class _RateLimiter:
+    """
+    Spaces calls at least 1/rate seconds apart across all threads.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class _Retry(Retry):
+    """
+    Retry that repeats idempotent requests on 429/502/503/504, but a POST only when
+    the server certainly did not process it: on 429, or on 503 with a Retry-After.
+    A 502 or 504 may come from a gateway that timed out while the API stored the
+    upload, and repeating that POST would attach the document twice.
+    """
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() in Retry.DEFAULT_ALLOWED_METHODS:
+            return super().is_retry(method, status_code, has_retry_after)
+        return bool(self.total) and (status_code == 429 or (status_code == 503 and has_retry_after))
+
+
+class SellerCloudClient:
+    """
+    Client for the Seller Cloud REST API with a pooled keep-alive session, request
+    rate limiting, retries on 429/5xx and token refresh on 401.
+    """
+    BASE_URL = 'https://cvi.api.sellercloud.com/rest/api'
+
+    def __init__(self, username=None, password=None, pool_size=10, max_retries=3, requests_per_second=None):
+        self.username = username or os.getenv('SELLER_EMAIL_ADDRESS')
+        self.password = password or os.getenv('SELLER_PWD')
+        self.session = requests.Session()
+        # Read errors are only retried for idempotent methods; see _Retry for statuses
+        retry = _Retry(
+            total=max_retries,
+            backoff_factor=0.5,
+            status_forcelist=[429, 502, 503, 504],
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount('https://', adapter)
+        self.rate_limiter = _RateLimiter(requests_per_second)
+        self._token = None
+        self._token_lock = threading.RLock()
+
+    def get_access_token(self, refresh=False):
+        """
+        Return a bearer token, requesting a new one if there is none yet or refresh is True.
+        """
+        with self._token_lock:
+            if self._token is None or refresh:
+                data = {"Username": self.username, "Password": self.password}
+                try:
+                    response = self.session.post(f'{self.BASE_URL}/token', json=data)
+                except requests.RequestException as e:
+                    logger.error(f"Failed to get Seller Cloud access token: {e}")
+                    return None
+                if response.status_code != 200:
+                    logger.error(f"Failed to get Seller Cloud access token: HTTP {response.status_code}")
+                    return None
+                self._token = response.json()['access_token']
+            return self._token
+
+    def _request(self, method, path, **kwargs):
+        token = self.get_access_token()
+        for attempt in range(2):
+            self.rate_limiter.wait()
+            headers = {
+                "accept": "application/json",
+                "content-type": "application/json",
+                "Authorization": f"Bearer {token}",
+            }
+            response = self.session.request(method, f'{self.BASE_URL}/{path}', headers=headers, **kwargs)
+            if response.status_code != 401 or attempt:
+                return response
+            logger.info("Seller Cloud token rejected, refreshing")
+            token = self._refresh_token(token)
+        return response
+
+    def _refresh_token(self, rejected_token):
+        with self._token_lock:
+            # Another thread may already have replaced the rejected token
+            if self._token == rejected_token:
+                return self.get_access_token(refresh=True)
+            return self._token
+
+    def iter_orders(self, updated_since=None, page_size=ORDERS_PAGE_SIZE):
+        """
+        Yield pages of orders, following pagination until every result is fetched.
+
+        Args:
+        - updated_since: Only return orders updated at or after this datetime. When
+          None, the fixed ORDERS_BOOTSTRAP_RANGE window is used instead. Paging stops
+          with OrderSyncIncomplete once MAX_INCREMENTAL_ORDERS orders have been returned.
+        - page_size: Number of orders per request.
+        """
+        params = {'model.pageSize': page_size}
+        if updated_since is None:
+            params['model.updatedFromDateRange'] = ORDERS_BOOTSTRAP_RANGE
+        else:
+            params[ORDERS_UPDATED_FROM_PARAM] = updated_since.strftime('%Y-%m-%dT%H:%M:%S')
+        page_number = 1
+        fetched = 0
+        while True:
+            params['model.pageNumber'] = page_number
+            response = self._request('GET', 'Orders', params=params)
+            if response.status_code != 200:
+                raise ValueError(f"Failed to retrieve orders page {page_number}: HTTP {response.status_code}")
+            data = response.json()
+            items = data.get("Items") or []
+            fetched += len(items)
+            yield items
+            total = data.get("TotalResults")
+            if len(items) < page_size or (total is not None and fetched >= total):
+                return
+            if updated_since is not None and fetched >= MAX_INCREMENTAL_ORDERS:
+                raise OrderSyncIncomplete(
+                    f"Incremental order sync stopped after {fetched} of {total} orders; check that "
+                    f"{ORDERS_UPDATED_FROM_PARAM} is applied by the API")
+            page_number += 1
+
+    def upload_document(self, order_id, file_content, file_name):
+        """
+        Upload a base64 encoded document to an order and return the HTTP status code.
+        """
+        payload = {"fileName": file_name, "fileContent": file_content}
+        response = self._request('POST', f'Orders/{order_id}/UploadDocument', json=payload)
+        return response.status_code
+
+    def upload_documents(self, items, prepare, max_workers=4):
+        """
+        Prepare and upload documents concurrently. Each worker runs the whole
+        prepare -> upload chain for one item, so downloads and encoding for some
+        items overlap with uploads for others.
+
+        Args:
+        - items: The items to upload.
+        - prepare: Called with an item in a worker thread; returns an
+          (order_id, base64_content, file_name) tuple, or None to skip the item.
+        - max_workers: Number of items processed at the same time.
+
+        Returns:
+        - The upload status code for each item in input order, or None if the
+          item was skipped or failed.
+        """
+        def run(item):
+            try:
+                prepared = prepare(item)
+                if prepared is None:
+                    return None
+                return self.upload_document(*prepared)
+            except Exception as e:
+                logger.error(f"Failed to upload document for item {item}: {e} - Seller Cloud")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="sellercloud") as executor:
+            return list(executor.map(run, items))
+
+
+def sync_orders(client, store):
+    """
+    Incrementally sync Seller Cloud orders into the local store. Only orders updated
+    since the stored watermark are fetched; they are upserted by order ID and the
+    watermark is advanced once every page has been processed. When iter_orders
+    stops early the pages already fetched are kept, the watermark is not moved and
+    OrderSyncIncomplete is raised, so no updates are skipped silently.
+
+    Returns:
+    - Number of orders that were new or changed.
+    """
+    watermark = store.get_state(ORDERS_WATERMARK_KEY)
+    updated_since = datetime.fromisoformat(watermark) if watermark else None
+    sync_started = datetime.now(timezone.utc)
+    logger.info(f"Syncing Seller Cloud orders updated since {watermark or 'bootstrap window'}")
+
+    fetched = 0
+    changed = 0
+    for items in client.iter_orders(updated_since=updated_since):
+        orders = data_parse({"Items": items})
+        if orders is None:
+            raise ValueError("Failed to parse Seller Cloud orders")
+        fetched += len(orders)
+        changed += store.upsert_orders(orders)
+
+    store.set_state(ORDERS_WATERMARK_KEY, (sync_started - SYNC_OVERLAP).isoformat())
+    logger.info(f"Fetched {fetched} orders, {changed} new or changed - Seller Cloud")
+    return changed
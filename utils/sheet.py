@@ -6,18 +6,152 @@ description: This module contains functions for creating, reading, updating, and
 sharing Google Sheets.
 """
 
+import asyncio
+import hashlib
+import math
+import re
 import time
 import logging
-from oauth2client.service_account import ServiceAccountCredentials as SAC
 from datetime import datetime
 import gspread
 import pandas as pd
-import gspread_dataframe as gd
+
+from utils.google_clients import get_credentials, get_gspread_client
+from utils.store import UPLOADED_STATUSES
 
 
 logger = logging.getLogger(__name__)
 
 
+def _cell_text(value):
+    """
+    The text a value is written as, e.g. None or NaN -> '' and 12345.0 -> '12345'.
+    """
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _row_hash(values):
+    return hashlib.sha1("\x1f".join(values).encode("utf-8")).hexdigest()
+
+
+class SheetSnapshot:
+    """
+    Cell values of a worksheet as read from the API, with a content hash per row.
+    """
+
+    def __init__(self, rows):
+        self.rows = [[_cell_text(value) for value in row] for row in rows]
+        self.hashes = [_row_hash(row) for row in self.rows]
+
+
+def plan_updates(snapshot, rows, first_row=1, first_col=1):
+    """
+    Compute the cell ranges that turn the block of cells in `snapshot` into `rows`
+    (lists of cell texts). Both start at the cell (first_row, first_col), A1 by
+    default.
+
+    Rows whose hash matches the snapshot are skipped; in the others only changed
+    cells are written, as runs of adjacent cells, and runs covering the same
+    columns on consecutive rows are merged into one range. Rows past the end of the
+    snapshot are appends. Cells outside `rows` are left as they are.
+
+    Returns
+    -------
+    list
+        batch_update data: dicts with an A1 'range' and its 'values'.
+    """
+    runs = []
+    for row_index, row in enumerate(rows):
+        if row_index < len(snapshot.hashes) and snapshot.hashes[row_index] == _row_hash(row):
+            continue
+        old = snapshot.rows[row_index] if row_index < len(snapshot.rows) else []
+        start = None
+        for col_index in range(len(row) + 1):
+            changed = col_index < len(row) and row[col_index] != (old[col_index] if col_index < len(old) else '')
+            if changed and start is None:
+                start = col_index
+            elif not changed and start is not None:
+                runs.append((row_index, start, col_index))
+                start = None
+
+    # Stack runs over the same columns of consecutive rows
+    ranges = []
+    for row_index, start, end in runs:
+        previous = ranges[-1] if ranges else None
+        if previous and previous[1:3] == [start, end] and previous[3] == row_index - 1:
+            previous[3] = row_index
+        else:
+            ranges.append([row_index, start, end, row_index])
+    return [
+        {
+            'range': f"{gspread.utils.rowcol_to_a1(first + first_row, start + first_col)}:"
+                     f"{gspread.utils.rowcol_to_a1(last + first_row, end + first_col - 1)}",
+            'values': [rows[row_index][start:end] for row_index in range(first, last + 1)],
+        }
+        for first, start, end, last in ranges
+    ]
+
+
+def _normalize_key(value):
+    """
+    Stringify an identifier, undoing the float conversion of numeric cells
+    (e.g. '12345.0' -> '12345').
+    """
+    return re.sub(r'\.0$', '', str(value))
+
+
+def match_status(df1, df2, tab1_column, tab2_column):
+    """
+    Match the rows of df1 against df2 on tab1_column == tab2_column and update
+    df1's 'status' column: unmatched rows become 'Unmatched', matched rows that are
+    not already 'Uploaded'/'TRUE' become 'Not Uploaded' and are returned for upload.
+
+    This is a hash join: df2 is indexed once by its key column and the first df2
+    row wins for duplicate keys, so the cost is O(n + m) instead of O(n * m).
+
+    Returns
+    -------
+    tuple
+        The updated copy of df1 and a list of dicts with 'order_id', 'pdf_link'
+        and 'order_number' for the rows to upload, in df1 order.
+    """
+    df1 = df1.copy()
+    # Ensure the 'Status' column exists
+    if 'status' not in df1.columns:
+        df1['status'] = 'Not Uploaded'
+    df1['status'] = df1['status'].astype(object)
+
+    lookup = (
+        df2.dropna(subset=[tab2_column])
+        .drop_duplicates(subset=[tab2_column], keep='first')
+        .set_index(tab2_column)['order_id']
+    )
+    keys = df1[tab1_column]
+    matched = keys.notna() & keys.isin(lookup.index)
+    already_uploaded = (df1['status'] == 'Uploaded') | (df1['status'] == 'TRUE')
+    to_upload = matched & ~already_uploaded
+
+    df1.loc[~matched, 'status'] = 'Unmatched'
+    df1.loc[to_upload, 'status'] = 'Not Uploaded'
+
+    order_ids = keys[to_upload].map(lookup)
+    matched_ids = [
+        {
+            'order_id': str(order_id).replace(".0", ""),
+            'pdf_link': pdf_link,
+            'order_number': order_number,
+        }
+        for order_id, pdf_link, order_number in zip(
+            order_ids, df1.loc[to_upload, 'pdf_link'], df1.loc[to_upload, 'order_number']
+        )
+    ]
+    return df1, matched_ids
+
+
 class SheetsClient:
     """
     Class for connecting to a Google Sheet and performing operations on it.
@@ -28,8 +162,8 @@ class SheetsClient:
             'https://spreadsheets.google.com/feeds',
             'https://www.googleapis.com/auth/drive'
             ]
-        self.credentials = SAC.from_json_keyfile_name(self.credentials_file_path, self.scope)
-        self.gc = gspread.authorize(self.credentials)
+        self.credentials = get_credentials(self.credentials_file_path, self.scope)
+        self.gc = get_gspread_client(self.credentials_file_path, self.scope)
 
     def get_or_create_sheet(self, sheet_name, spreadsheet_name, obj=False, size='0'):
         """
@@ -80,36 +214,27 @@ class SheetsClient:
         sheet.append_row(row)
         return True
 
-    def add_dataframe(self, sheet_name, spreadsheet_name, data_frame, append=True):
+    def append_dataframe(self, sheet_name, spreadsheet_name, data_frame):
         """
-        Add dataframe to sheet or append to existing data
+        Append rows to a sheet without reading its data. Only the header row is read
+        to align columns; an empty sheet gets the DataFrame's header first.
         """
+        if data_frame.empty:
+            return 0
         sheet, _ = self.get_or_create_sheet(sheet_name, spreadsheet_name, obj=True)
-        existing_values = gd.get_as_dataframe(sheet)
+        header = sheet.row_values(1)
         data_frame = data_frame.astype(str)
-        data_frame['current_datetime'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        data_frame['reviewed'] = 'FALSE'
-        existing_values.dropna(how='all', inplace=True)
-        existing_values.dropna(axis=1, how='all', inplace=True)
-        existing_values = existing_values.astype(str)
-        if append:
-            if existing_values.empty:
-                gd.set_with_dataframe(sheet, data_frame)
-                logger.info("Appended dataframe to an empty sheet")
-            else:
-                existing_order_numbers = set(existing_values['order_number'].unique())
-                new_order_numbers = set(data_frame['order_number'].unique())
-                duplicates = existing_order_numbers.intersection(new_order_numbers)
-                data_frame = data_frame[~data_frame['order_number'].isin(duplicates)]
-                df_combined = pd.concat([existing_values, data_frame])
-                df_combined = df_combined.astype(str)
-                df_combined = df_combined.reset_index(drop=True)
-                gd.set_with_dataframe(sheet, df_combined)
-                logger.info("Appended dataframe to an existing sheet")    
+        if not header:
+            header = list(data_frame.columns)
+            rows = [header] + data_frame.values.tolist()
         else:
-            gd.set_with_dataframe(sheet, data_frame)
-            logger.info("Added dataframe to an existing sheet")
-        return True
+            missing_columns = set(data_frame.columns) - set(header)
+            if missing_columns:
+                raise ValueError(f"Columns {sorted(missing_columns)} not found in sheet '{sheet_name}'.")
+            rows = data_frame.reindex(columns=header, fill_value='').values.tolist()
+        sheet.append_rows(rows, value_input_option='USER_ENTERED')
+        logger.info("Appended %d rows to sheet '%s'", len(data_frame), sheet_name)
+        return len(data_frame)
 
     def share_sheet(self, spreadsheet_id, email):
         """
@@ -119,85 +244,6 @@ class SheetsClient:
         sh.share(email, perm_type='user', role='writer')
         return True
     
-    def add_seller_cloud_dataframe(self, sheet_name, spreadsheet_name, data_frame, append=True):
-        """
-        Add dataframe to sheet or append to existing data
-        """
-        sheet, _ = self.get_or_create_sheet(sheet_name, spreadsheet_name, obj=True)
-        existing_values = gd.get_as_dataframe(sheet)
-        data_frame['current_datetime'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # data_frame = data_frame.astype(str)
-        existing_values.dropna(how='all', inplace=True)
-        existing_values.dropna(axis=1, how='all', inplace=True)
-        existing_values = existing_values.astype(str)
-        if append:
-            if existing_values.empty:
-                gd.set_with_dataframe(sheet, data_frame)
-                logger.info("Appended dataframe to an empty sheet")
-                print("Appended dataframe to an empty sheet")
-            else:
-                existing_order_numbers = set(existing_values['order_number'].unique())
-                print(existing_order_numbers)
-                new_order_numbers = set(data_frame['order_number'].unique())
-                print(new_order_numbers)
-                duplicates = existing_order_numbers.intersection(new_order_numbers)
-                data_frame = data_frame[~data_frame['order_number'].isin(duplicates)]
-                df_combined = pd.concat([existing_values, data_frame])
-                df_combined = df_combined.astype(str)
-                df_combined = df_combined.reset_index(drop=True)
-                gd.set_with_dataframe(sheet, df_combined)
-                logger.info("Appended dataframe to an existing sheet")   
-        else:
-            gd.set_with_dataframe(sheet, data_frame)
-            logger.info("Added dataframe to an existing sheet")
-        return True
-    
-    def match_and_update_status(self, sheet1_name, sheet2_name, spreadsheet_name, tab1_column, tab2_column):
-        """
-        Match and update status between two sheets based on specified columns.
-        """
-        matched_ids=[]
-        try:
-            # Fetch DataFrames for both sheets
-            sheet1, _ = self.get_or_create_sheet(sheet1_name, spreadsheet_name, obj=True)
-            sheet2, _ = self.get_or_create_sheet(sheet2_name, spreadsheet_name, obj=True)
-            df1 = gd.get_as_dataframe(sheet1)
-            df2 = gd.get_as_dataframe(sheet2)
-            # Ensure the 'Status' column exists
-            if 'status' not in df1.columns:
-                df1['status'] = 'Not Uploaded'
-            matched_ids=[]
-            # Perform matching and update the 'Status' column
-            for index, row in df1.iterrows():
-                match = df2[df2[tab2_column] == row[tab1_column]]
-                if not match.empty :
-                    if not (df1.at[index, 'status'] == 'Uploaded' or df1.at[index, 'status']=='TRUE') :
-                        df1.at[index, 'status'] = 'Not Uploaded'
-                        matched_row = match.iloc[0]
-                        matched_ids.append({
-                                        'order_id': str(matched_row['order_id']).replace(".0", ""),
-                                        'pdf_link': row['pdf_link'],# From df1
-                                        'order_number': row['order_number']    # From df1
-                                    })
-                else:
-                    df1.at[index, 'status'] = 'Unmatched'
-
-            # Update the sheet with the new DataFrame
-            df1 = df1.reset_index(drop=True)
-            gd.set_with_dataframe(sheet1, df1)
-            logger.info("Updated statuses in sheet '%s'", sheet1_name)
-            return True,matched_ids
-
-        except KeyError as e:
-            logger.error(f"Error in matching: Column '{tab1_column}' or '{tab2_column}' not found: {e}")
-            # return False,matched_ids
-            raise
-        except Exception as e:
-            logger.error(f"Error in matching and updating status: {e}")
-            # return False, matched_ids
-            raise
-
     def get_dataframe_with_row_ids(self, sheet_name, spreadsheet_name):
         """
         Retrieve the sheet data as a DataFrame with row IDs.
@@ -214,48 +260,184 @@ class SheetsClient:
         df['row_id'] = range(2, len(df) + 2)  # Start from 2 to account for header row
         return df
 
-    def update_column_by_identifier(self, sheet_name, spreadsheet_name, identifier_column, identifier_value, update_column, update_value):
+
+def prepare_bol_row(row):
+    """
+    Stringify a new BOL row and add the bookkeeping columns.
+    """
+    row = {column: str(value) for column, value in row.items()}
+    row['current_datetime'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    row['reviewed'] = 'FALSE'
+    return row
+
+
+def _first_appended_row(response):
+    """
+    Row number of the first row written by an append, from the updatedRange of
+    the API response (e.g. "'BOL'!A12:S20" -> 12).
+    """
+    updated_range = ((response or {}).get('updates') or {}).get('updatedRange') or ''
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+
+class SheetExporter:
+    """
+    Exports the BOL rows of a LocalStore, the system of record, to a sheet. Rows are
+    only ever added locally and then change status, so an export appends the rows
+    that are new since the last one and rewrites the status cell of the rows whose
+    status changed, instead of reading and rewriting the whole sheet.
+
+    The first export takes over the rows already in the sheet (see seed()).
+    """
+
+    def __init__(self, sheets_client, store, sheet_name, spreadsheet_name,
+                 key_column='order_number', status_column='status'):
+        self.sheets_client = sheets_client
+        self.store = store
+        self.sheet_name = sheet_name
+        self.spreadsheet_name = spreadsheet_name
+        self.key_column = key_column
+        self.status_column = status_column
+
+    @property
+    def _seeded_key(self):
+        return f"sheet:{self.spreadsheet_name}:{self.sheet_name}:seeded"
+
+    def seed(self):
         """
-        Update a specific column in a row based on a unique identifier.
+        Import the rows of the sheet into the store, once, so BOLs recorded before
+        the store existed keep their status and position and are not appended again.
 
-        Args:
-        sheet_name (str): Name of the worksheet.
-        spreadsheet_name (str): Name of the spreadsheet.
-        identifier_column (str): Name of the column used as the unique identifier.
-        identifier_value: The value to look for in the identifier column.
-        update_column (str): Name of the column to update.
-        update_value: The new value to set in the update_column.
+        Returns
+        -------
+        int
+            Number of rows imported.
+        """
+        if self.store.get_state(self._seeded_key):
+            return 0
+        sheet, _ = self.sheets_client.get_or_create_sheet(self.sheet_name, self.spreadsheet_name, obj=True)
+        values = sheet.get_all_values()
+        header = values[0] if values else []
+        rows = []
+        if self.key_column in header:
+            for sheet_row, cells in enumerate(values[1:], start=2):  # Start from 2 to account for header row
+                if any(cells):
+                    rows.append((sheet_row, dict(zip(header, cells))))
+        self.store.import_bol_rows(rows)
+        self.store.set_state(self._seeded_key, "1")
+        logger.info("Imported %d rows of sheet '%s' into the local store", len(rows), self.sheet_name)
+        return len(rows)
 
-        Returns:
-        bool: True if update was successful, False otherwise.
+    def _read_keys(self, sheet):
         """
-        try:
-            df = self.get_dataframe_with_row_ids(sheet_name, spreadsheet_name)
-            
-            if identifier_column not in df.columns:
-                raise ValueError(f"Identifier column '{identifier_column}' not found in the sheet.")
-
-            if update_column not in df.columns:
-                raise ValueError(f"Update column '{update_column}' not found in the sheet.")
-
-            row_to_update = df[df[identifier_column] == identifier_value]
-            
-            if row_to_update.empty:
-                logger.warning(f"No row found with {identifier_column} = {identifier_value}")
-                return False
-
-            row_id = row_to_update.iloc[0]['row_id']
-            col_index = df.columns.get_loc(update_column) + 1  # +1 because gspread is 1-indexed
-            
-            sheet, _ = self.get_or_create_sheet(sheet_name, spreadsheet_name, obj=True)
-            sheet.update_cell(row_id, col_index, update_value)
-
-            logger.info(f"Updated '{update_column}' for row with {identifier_column} = {identifier_value}")
-            return True
-
-        except gspread.exceptions.APIError as e:
-            logger.error(f"API error while updating column: {e}")
-            return False
-        except Exception as e:
-            logger.error(f"Error updating column: {e}")
-            return False
\ No newline at end of file
+        Read the header and the key and status columns of the sheet, with two
+        requests however long the sheet is.
+
+        Returns
+        -------
+        tuple
+            (header, keys, statuses); keys[i] and statuses[i] are the cells of sheet
+            row i + 2.
+        """
+        header = sheet.row_values(1)
+        if self.key_column not in header:
+            return header, [], []
+        columns = [column for column in (self.key_column, self.status_column) if column in header]
+        ranges = [f"{letter}:{letter}" for letter in
+                  (gspread.utils.rowcol_to_a1(1, header.index(column) + 1)[:-1] for column in columns)]
+        values = [[cells[0] if cells else '' for cells in column[1:]] for column in sheet.batch_get(ranges)]
+        keys = [_normalize_key(key) for key in values[0]]
+        statuses = values[1] if len(values) > 1 else []
+        return header, keys, statuses
+
+    def pull(self):
+        """
+        Bring hand edits of the sheet into the store before rows are matched: rows
+        marked as uploaded in the sheet (UPLOADED_STATUSES, e.g. TRUE) are taken as
+        uploaded and are not pushed to Seller Cloud again. Seeds the store first.
+
+        Returns
+        -------
+        int
+            Number of rows whose status was taken from the sheet.
+        """
+        self.seed()
+        sheet, _ = self.sheets_client.get_or_create_sheet(self.sheet_name, self.spreadsheet_name, obj=True)
+        _, keys, statuses = self._read_keys(sheet)
+        marked = {key: status for key, status in zip(keys, statuses) if key and status in UPLOADED_STATUSES}
+        taken = self.store.import_bol_statuses(marked)
+        if taken:
+            logger.info("Took %d statuses marked as uploaded by hand from sheet '%s'", taken, self.sheet_name)
+        return taken
+
+    def export(self):
+        """
+        Push new and changed BOL rows to the sheet with at most one append and one
+        batch_update, which only holds the status cells that differ from the sheet.
+
+        Changed rows are located by their key in the sheet as it is now, since rows
+        may have been sorted, inserted or deleted by hand since the last export; the
+        row number recorded at the last export is only used when it still holds the
+        same key, e.g. to pick the right one of duplicate keys.
+
+        Returns
+        -------
+        int
+            Number of rows written.
+        """
+        self.seed()
+        rows = self.store.bol_rows_to_export()
+        if not rows:
+            logger.info("Sheet '%s' is up to date", self.sheet_name)
+            return 0
+        sheet, _ = self.sheets_client.get_or_create_sheet(self.sheet_name, self.spreadsheet_name, obj=True)
+        header, keys, statuses = self._read_keys(sheet)
+        columns = list(dict.fromkeys(column for row in rows for column in row['row'])) + [self.status_column]
+        data = []
+        missing_columns = [column for column in columns if column not in header]
+        if missing_columns:
+            header = header + missing_columns
+            # Sheets rejects writes past the grid, so a narrow sheet is widened first
+            if len(header) > sheet.col_count:
+                sheet.add_cols(len(header) - sheet.col_count)
+            data.append({'range': f"A1:{gspread.utils.rowcol_to_a1(1, len(header))}", 'values': [header]})
+
+        new_rows = [row for row in rows if row['exported_version'] is None]
+        changed_rows = [row for row in rows if row['exported_version'] is not None]
+        row_ids = {}
+        for row_id, key in enumerate(keys, start=2):  # Start from 2 to account for header row
+            row_ids.setdefault(key, row_id)
+        status_index = header.index(self.status_column) + 1
+        new_statuses = list(statuses) + [''] * (len(keys) - len(statuses))
+        for row in changed_rows:
+            hint = row['sheet_row']
+            if not (hint and 2 <= hint < len(keys) + 2 and keys[hint - 2] == row['order_number']):
+                row['sheet_row'] = row_ids.get(row['order_number'])
+            if row['sheet_row'] is None:
+                logger.warning(f"No row found with {self.key_column} = {row['order_number']}")
+                continue
+            new_statuses[row['sheet_row'] - 2] = row['status']
+        # Only status cells that differ from the sheet are sent, runs of rows as one range
+        data += plan_updates(SheetSnapshot([[status] for status in statuses]),
+                             [[status] for status in new_statuses], first_row=2, first_col=status_index)
+        if data:
+            sheet.batch_update(data, value_input_option='USER_ENTERED')
+
+        if new_rows:
+            values = [[{**row['row'], self.status_column: row['status']}.get(column, '') for column in header]
+                      for row in new_rows]
+            response = sheet.append_rows(values, value_input_option='USER_ENTERED', table_range='A1')
+            first_row = _first_appended_row(response)
+            for i, row in enumerate(new_rows):
+                row['sheet_row'] = first_row + i if first_row is not None else None
+        self.store.mark_bol_rows_exported(
+            (row['order_number'], row['version'], row['sheet_row']) for row in new_rows + changed_rows)
+        logger.info("Exported %d new and %d changed rows to sheet '%s'", len(new_rows), len(changed_rows), self.sheet_name)
+        return len(new_rows) + len(changed_rows)
+
+    async def aexport(self):
+        """
+        Run export() in a worker thread.
+        """
+        return await asyncio.to_thread(self.export)
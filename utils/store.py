@@ -0,0 +1,582 @@
+"""
+This module contains the local SQLite store that keeps pipeline state between
+scheduler runs: sync watermarks, the index of Seller Cloud orders, the ledger
+of processed emails and attachments, the durable queue of BOL documents, the
+failed OCR attempts of its pages, the BOL rows with their upload status and a summary record of every scheduler run.
+
+The store is the system of record for BOL rows and Seller Cloud orders; dedup and
+matching run here, and the Google Sheets tabs are exported views of it.
+
+Every document moves through the stages below and every stage is checkpointed,
+so a restarted run resumes each document where it stopped instead of paying for
+OCR again:
+
+    fetched -> split (pages OCR'd) -> drive -> sheets -> seller_cloud
+"""
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Document stages
+STAGE_FETCHED = "fetched"
+STAGE_SPLIT = "split"
+# Page stages
+STAGE_OCR = "ocr"
+STAGE_DRIVE = "drive"
+STAGE_SHEETS = "sheets"
+STAGE_SELLER_CLOUD = "seller_cloud"
+
+# Statuses of BOL rows, as shown in the BOL sheet
+STATUS_NOT_UPLOADED = "Not Uploaded"
+STATUS_UNMATCHED = "Unmatched"
+STATUS_UPLOADED = "Uploaded"
+# Rows marked TRUE by hand in the sheet count as uploaded
+UPLOADED_STATUSES = (STATUS_UPLOADED, "TRUE")
+
+
+def _row_key(value):
+    # The order number as the BOL sheet shows it (see utils.sheet._cell_text), so keys
+    # match the key column read back from the sheet: None -> '' and 12345.0 -> '12345'
+    return re.sub(r'\.0$', '', str(value if value is not None else ""))
+
+
+def _has_key(row, description):
+    # bol_rows is keyed on the order number; rows without one would all collapse into
+    # a single row, so they are left out
+    if _row_key(row.get('order_number')):
+        return True
+    logger.warning(f"Skipping BOL row without an order number: {description}")
+    return False
+
+
+class LocalStore:
+    """
+    Small SQLite-backed store shared by the pipeline stages.
+
+    Attributes
+    ----------
+    path : str
+        Location of the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS sync_state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS seller_cloud_orders (
+                id INTEGER PRIMARY KEY,
+                order_number TEXT,
+                updated_at REAL NOT NULL,
+                exported INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE INDEX IF NOT EXISTS ix_seller_cloud_orders_order_number ON seller_cloud_orders (order_number);
+            CREATE INDEX IF NOT EXISTS ix_seller_cloud_orders_exported ON seller_cloud_orders (exported);
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                message_id TEXT PRIMARY KEY,
+                uid INTEGER,
+                processed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS processed_attachments (
+                sha256 TEXT PRIMARY KEY,
+                file_name TEXT,
+                processed_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS documents (
+                sha256 TEXT PRIMARY KEY,
+                file_name TEXT,
+                message_id TEXT,
+                stage TEXT NOT NULL,
+                pdf BLOB,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_documents_stage ON documents (stage);
+            CREATE TABLE IF NOT EXISTS pages (
+                sha256 TEXT NOT NULL,
+                page_num INTEGER NOT NULL,
+                stage TEXT NOT NULL,
+                bol TEXT,
+                pdf BLOB,
+                pdf_link TEXT,
+                order_number TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (sha256, page_num)
+            );
+            CREATE INDEX IF NOT EXISTS ix_pages_stage ON pages (stage);
+            CREATE INDEX IF NOT EXISTS ix_pages_order_number ON pages (order_number);
+            CREATE TABLE IF NOT EXISTS ocr_failures (
+                sha256 TEXT NOT NULL,
+                page_num INTEGER NOT NULL,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (sha256, page_num)
+            );
+            CREATE TABLE IF NOT EXISTS bol_rows (
+                order_number TEXT PRIMARY KEY,
+                shipment_id TEXT,
+                pdf_link TEXT,
+                row TEXT NOT NULL,
+                status TEXT NOT NULL,
+                version INTEGER NOT NULL DEFAULT 1,
+                exported_version INTEGER,
+                sheet_row INTEGER,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS ix_bol_rows_shipment_id ON bol_rows (shipment_id);
+            CREATE INDEX IF NOT EXISTS ix_bol_rows_status ON bol_rows (status);
+            CREATE TABLE IF NOT EXISTS runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                started_at REAL NOT NULL,
+                duration REAL NOT NULL,
+                summary TEXT NOT NULL
+            );
+            """
+        )
+        self.conn.commit()
+
+    def get_state(self, key, default=None):
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else default
+
+    def set_state(self, key, value):
+        with self._lock:
+            self.conn.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+            self.conn.commit()
+
+    def upsert_orders(self, orders, exported=False):
+        """
+        Insert or update (order_id, order_number) pairs. Orders whose order number
+        changed are flagged for export again.
+
+        Returns
+        -------
+        int
+            Number of orders that were new or changed.
+        """
+        now = time.time()
+        changed = 0
+        with self._lock:
+            for order_id, order_number in orders:
+                row = self.conn.execute(
+                    "SELECT order_number FROM seller_cloud_orders WHERE id = ?", (int(order_id),)
+                ).fetchone()
+                if row is not None and row["order_number"] == order_number:
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO seller_cloud_orders (id, order_number, updated_at, exported)"
+                    " VALUES (?, ?, ?, ?)",
+                    (int(order_id), order_number, now, int(exported)),
+                )
+                changed += 1
+            self.conn.commit()
+        return changed
+
+    def unexported_orders(self):
+        """
+        Return (order_id, order_number) pairs that have not been written to the sheet yet.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, order_number FROM seller_cloud_orders WHERE exported = 0 ORDER BY id"
+            ).fetchall()
+        return [(row["id"], row["order_number"]) for row in rows]
+
+    def mark_orders_exported(self, order_ids):
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE seller_cloud_orders SET exported = 1 WHERE id = ?", [(int(i),) for i in order_ids]
+            )
+            self.conn.commit()
+
+    def count_orders(self):
+        with self._lock:
+            return self.conn.execute("SELECT COUNT(*) FROM seller_cloud_orders").fetchone()[0]
+
+    def upsert_bol_rows(self, rows, status=STATUS_NOT_UPLOADED):
+        """
+        Add BOL sheet rows, keyed by their order number. Rows whose order number is
+        already known are dropped, matching the dedup of the BOL sheet; rows without
+        an order number (e.g. pages the model could not read) are skipped with a warning.
+
+        Returns
+        -------
+        int
+            Number of rows added.
+        """
+        now = time.time()
+        added = 0
+        with self._lock:
+            for row in rows:
+                if not _has_key(row, f"PDF {row.get('pdf_link')}"):
+                    continue
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO bol_rows (order_number, shipment_id, pdf_link, row, status, updated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (_row_key(row.get('order_number')), row.get('shipment_id'), row.get('pdf_link'),
+                     json.dumps(row), status, now),
+                )
+                added += cursor.rowcount
+            self.conn.commit()
+        return added
+
+    def import_bol_rows(self, rows):
+        """
+        Take over (sheet_row, row) pairs read from an existing BOL sheet as rows that
+        are already exported at that position. Their status comes from the row.
+        Rows without an order number are skipped with a warning.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO bol_rows (order_number, shipment_id, pdf_link, row, status, version,"
+                " exported_version, sheet_row, updated_at) VALUES (?, ?, ?, ?, ?, 1, 1, ?, ?)",
+                [(_row_key(row.get('order_number')), row.get('shipment_id'), row.get('pdf_link'),
+                  json.dumps({k: v for k, v in row.items() if k != 'status'}),
+                  row.get('status') or STATUS_NOT_UPLOADED, sheet_row, now)
+                 for sheet_row, row in rows if _has_key(row, f"sheet row {sheet_row}")],
+            )
+            self.conn.commit()
+
+    def match_bol_rows(self):
+        """
+        Match BOL rows against the Seller Cloud orders, like utils.sheet.match_status:
+        unmatched rows become 'Unmatched', matched rows that are not uploaded yet
+        become 'Not Uploaded' and are returned for upload.
+
+        Returns
+        -------
+        list
+            Dicts with 'order_id', 'pdf_link' and 'order_number', in insertion order.
+            The first synced order wins for duplicate order numbers.
+        """
+        now = time.time()
+        matched = "order_number IN (SELECT order_number FROM seller_cloud_orders WHERE order_number IS NOT NULL)"
+        with self._lock:
+            self.conn.execute(
+                f"UPDATE bol_rows SET status = ?, version = version + 1, updated_at = ? WHERE status != ? AND NOT {matched}",
+                (STATUS_UNMATCHED, now, STATUS_UNMATCHED),
+            )
+            self.conn.execute(
+                f"UPDATE bol_rows SET status = ?, version = version + 1, updated_at = ?"
+                f" WHERE status NOT IN (?, ?, ?) AND {matched}",
+                (STATUS_NOT_UPLOADED, now, STATUS_NOT_UPLOADED, *UPLOADED_STATUSES),
+            )
+            self.conn.commit()
+            rows = self.conn.execute(
+                "SELECT b.order_number, b.pdf_link, MIN(o.id) AS order_id FROM bol_rows b"
+                " JOIN seller_cloud_orders o ON o.order_number = b.order_number"
+                " WHERE b.status = ? GROUP BY b.order_number ORDER BY b.rowid",
+                (STATUS_NOT_UPLOADED,),
+            ).fetchall()
+        return [{'order_id': str(row["order_id"]), 'pdf_link': row["pdf_link"], 'order_number': row["order_number"]}
+                for row in rows]
+
+    def import_bol_statuses(self, statuses):
+        """
+        Take over statuses set by hand in the BOL sheet, as {order_number: status}.
+        They are already in the sheet, so the rows are not due for export again.
+        A row that is already uploaded keeps its status.
+
+        Returns
+        -------
+        int
+            Number of rows updated.
+        """
+        now = time.time()
+        updated = 0
+        with self._lock:
+            for order_number, status in statuses.items():
+                cursor = self.conn.execute(
+                    "UPDATE bol_rows SET status = ?, version = version + 1, exported_version = version + 1,"
+                    " updated_at = ? WHERE order_number = ? AND status NOT IN (?, ?)",
+                    (status, now, _row_key(order_number), *UPLOADED_STATUSES),
+                )
+                updated += cursor.rowcount
+            self.conn.commit()
+        return updated
+
+    def set_bol_status(self, order_numbers, status):
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE bol_rows SET status = ?, version = version + 1, updated_at = ? WHERE order_number = ? AND status != ?",
+                [(status, now, _row_key(order_number), status) for order_number in order_numbers],
+            )
+            self.conn.commit()
+
+    def bol_rows_to_export(self):
+        """
+        Return the BOL rows that are new or changed since they were last exported, as
+        dicts with order_number, row, status, version, exported_version and sheet_row.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT order_number, row, status, version, exported_version, sheet_row FROM bol_rows"
+                " WHERE exported_version IS NULL OR exported_version != version ORDER BY rowid"
+            ).fetchall()
+        return [{"order_number": row["order_number"], "row": json.loads(row["row"]), "status": row["status"],
+                 "version": row["version"], "exported_version": row["exported_version"],
+                 "sheet_row": row["sheet_row"]} for row in rows]
+
+    def mark_bol_rows_exported(self, rows):
+        """
+        Record (order_number, version, sheet_row) triples as exported. A row changed
+        again since `version` was read stays due for export.
+        """
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE bol_rows SET exported_version = ?, sheet_row = COALESCE(?, sheet_row) WHERE order_number = ?",
+                [(version, sheet_row, order_number) for order_number, version, sheet_row in rows],
+            )
+            self.conn.commit()
+
+    def count_bol_rows_by_status(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) AS n FROM bol_rows GROUP BY status").fetchall()
+        return {row["status"]: row["n"] for row in rows}
+
+    def processed_message_ids(self, message_ids):
+        """
+        Return the subset of message_ids that are already in the processed ledger.
+        """
+        message_ids = list(message_ids)
+        found = set()
+        with self._lock:
+            for i in range(0, len(message_ids), 500):
+                chunk = message_ids[i:i + 500]
+                rows = self.conn.execute(
+                    f"SELECT message_id FROM processed_messages WHERE message_id IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(row["message_id"] for row in rows)
+        return found
+
+    def is_attachment_processed(self, sha256):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT 1 FROM processed_attachments WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+        return row is not None
+
+    def mark_processed(self, messages, attachments):
+        """
+        Record processed messages as (message_id, uid) pairs and attachments as
+        (sha256, file_name) pairs.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed_messages (message_id, uid, processed_at) VALUES (?, ?, ?)",
+                [(message_id, uid, now) for message_id, uid in messages],
+            )
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed_attachments (sha256, file_name, processed_at) VALUES (?, ?, ?)",
+                [(sha256, file_name, now) for sha256, file_name in attachments],
+            )
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def enqueue_document(self, sha256, file_name, message_id, pdf):
+        """
+        Add a fetched PDF to the queue.
+
+        Returns
+        -------
+        bool
+            False if the document was already queued, in any stage.
+        """
+        with self._lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO documents (sha256, file_name, message_id, stage, pdf, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (sha256, file_name, message_id, STAGE_FETCHED, pdf, time.time()),
+            )
+            self.conn.commit()
+        return cursor.rowcount == 1
+
+    def documents_in_stage(self, stage):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT sha256, file_name, message_id, pdf FROM documents WHERE stage = ? ORDER BY updated_at",
+                (stage,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def queued_pages(self, sha256):
+        """
+        Return the page numbers of a document that are already OCR'd, including the
+        later pages of multi-page BOLs.
+        """
+        with self._lock:
+            rows = self.conn.execute("SELECT page_num, bol FROM pages WHERE sha256 = ?", (sha256,)).fetchall()
+        pages = set()
+        for row in rows:
+            last_page_num = json.loads(row["bol"]).get("last_page_num") or row["page_num"]
+            pages.update(range(row["page_num"], last_page_num + 1))
+        return pages
+
+    def save_page(self, sha256, page_num, bol, pdf, order_number=None):
+        """
+        Checkpoint an OCR'd page, ready for the Drive upload. `pdf` is the page's
+        single-page PDF, or None when it is extracted from the document on upload.
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (sha256, page_num, stage, bol, pdf, order_number, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sha256, page_num, STAGE_OCR, json.dumps(bol, default=str), pdf, order_number, time.time()),
+            )
+            self.conn.execute("DELETE FROM ocr_failures WHERE sha256 = ? AND page_num = ?", (sha256, page_num))
+            self.conn.commit()
+
+    def record_ocr_failure(self, sha256, page_num, error=None):
+        """
+        Count a run in which a page could not be OCR'd; the count is cleared when the
+        page is saved.
+
+        Returns
+        -------
+        int
+            Number of runs the page has failed in, this one included.
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO ocr_failures (sha256, page_num, attempts, error, updated_at) VALUES (?, ?, 1, ?, ?)"
+                " ON CONFLICT (sha256, page_num) DO UPDATE SET attempts = attempts + 1, error = excluded.error,"
+                " updated_at = excluded.updated_at",
+                (sha256, page_num, error, time.time()),
+            )
+            self.conn.commit()
+            row = self.conn.execute(
+                "SELECT attempts FROM ocr_failures WHERE sha256 = ? AND page_num = ?", (sha256, page_num)
+            ).fetchone()
+        return row["attempts"]
+
+    def complete_document(self, sha256, release=True):
+        """
+        Mark a document as split once all of its pages are saved. Its PDF is dropped
+        unless release is False, for pages that are extracted from it at upload time.
+        """
+        with self._lock:
+            self.conn.execute(
+                "UPDATE documents SET stage = ?, pdf = CASE WHEN ? THEN NULL ELSE pdf END, updated_at = ?"
+                " WHERE sha256 = ?",
+                (STAGE_SPLIT, int(release), time.time(), sha256),
+            )
+            self.conn.commit()
+
+    def document_pdf(self, sha256):
+        with self._lock:
+            row = self.conn.execute("SELECT pdf FROM documents WHERE sha256 = ?", (sha256,)).fetchone()
+        return row["pdf"] if row else None
+
+    def release_documents(self):
+        """
+        Drop the PDF of split documents that have no pages waiting for upload.
+        """
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE documents SET pdf = NULL WHERE stage = ? AND pdf IS NOT NULL AND NOT EXISTS"
+                " (SELECT 1 FROM pages WHERE pages.sha256 = documents.sha256 AND pages.stage = ?)",
+                (STAGE_SPLIT, STAGE_OCR),
+            )
+            self.conn.commit()
+        return cursor.rowcount
+
+    def pages_in_stage(self, stage):
+        """
+        Return the pages in a stage as dicts with sha256, page_num, bol and pdf. The
+        Drive link, once known, is set on the bol.
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT sha256, page_num, bol, pdf, pdf_link FROM pages WHERE stage = ? ORDER BY updated_at, page_num",
+                (stage,),
+            ).fetchall()
+        pages = []
+        for row in rows:
+            bol = json.loads(row["bol"])
+            if row["pdf_link"]:
+                bol["pdf_link"] = row["pdf_link"]
+            pages.append({"sha256": row["sha256"], "page_num": row["page_num"], "bol": bol, "pdf": row["pdf"]})
+        return pages
+
+    def set_page_link(self, sha256, page_num, pdf_link):
+        """
+        Record the Drive link of an uploaded page and drop its PDF.
+        """
+        with self._lock:
+            self.conn.execute(
+                "UPDATE pages SET stage = ?, pdf_link = ?, pdf = NULL, updated_at = ? WHERE sha256 = ? AND page_num = ?",
+                (STAGE_DRIVE, pdf_link, time.time(), sha256, page_num),
+            )
+            self.conn.commit()
+
+    def set_pages_stage(self, pages, stage):
+        """
+        Move (sha256, page_num) pairs to a stage.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE pages SET stage = ?, updated_at = ? WHERE sha256 = ? AND page_num = ?",
+                [(stage, now, sha256, page_num) for sha256, page_num in pages],
+            )
+            self.conn.commit()
+
+    def mark_orders_pushed(self, order_numbers):
+        """
+        Move the pages written to the sheet for these order numbers to the final stage
+        once their documents are uploaded to Seller Cloud.
+        """
+        now = time.time()
+        with self._lock:
+            self.conn.executemany(
+                "UPDATE pages SET stage = ?, updated_at = ? WHERE order_number = ? AND stage = ?",
+                [(STAGE_SELLER_CLOUD, now, str(order_number), STAGE_SHEETS) for order_number in order_numbers],
+            )
+            self.conn.commit()
+
+    def count_pages_by_stage(self):
+        with self._lock:
+            rows = self.conn.execute("SELECT stage, COUNT(*) AS n FROM pages GROUP BY stage").fetchall()
+        return {row["stage"]: row["n"] for row in rows}
+
+    def record_run(self, started_at, duration, summary):
+        """
+        Keep the metrics summary of a scheduler run for capacity planning.
+        """
+        with self._lock:
+            self.conn.execute(
+                "INSERT INTO runs (started_at, duration, summary) VALUES (?, ?, ?)",
+                (started_at, duration, json.dumps(summary, default=str)),
+            )
+            self.conn.commit()
+
+    def recent_runs(self, limit=10):
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT started_at, duration, summary FROM runs ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [{"started_at": row["started_at"], "duration": row["duration"], "summary": json.loads(row["summary"])}
+                for row in rows]